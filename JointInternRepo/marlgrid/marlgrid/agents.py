@@ -63,6 +63,14 @@ class GridAgentInterface(GridAgent):
         )
         if observation_style == 'image':
             self.observation_space = image_space
+        elif observation_style == 'symbolic':
+            # (type, color, state) encoding of each cell in view, see WorldObj.encode.
+            self.observation_space = gym.spaces.Box(
+                low=0,
+                high=255,
+                shape=(view_size, view_size, 3),
+                dtype="uint8",
+            )
         elif observation_style == 'rich':
             obs_space = {
                 'pov': image_space,
@@ -75,7 +83,7 @@ class GridAgentInterface(GridAgent):
                 obs_space['orientation'] = gym.spaces.Discrete(n=4)
             self.observation_space = gym.spaces.Dict(obs_space)
         else:
-            raise ValueError(f"{self.__class__.__name__} kwarg 'observation_style' must be one of 'image', 'rich'.")
+            raise ValueError(f"{self.__class__.__name__} kwarg 'observation_style' must be one of 'image', 'symbolic', 'rich'.")
 
         if self.restrict_actions:
             self.action_space = gym.spaces.Discrete(3)
@@ -301,7 +309,9 @@ def occlude_mask(grid, agent_pos):
     mask[agent_pos[0], agent_pos[1]] = True
     width, height = grid.shape[:2]
 
-    for j in range(agent_pos[1]+1,0,-1):
+    # Rows from the agent's up. (This used to start one row below the agent,
+    #  which reads past the grid when the agent is on its last row.)
+    for j in range(agent_pos[1],0,-1):
         for i in range(agent_pos[0], width):
             if mask[i,j] and grid[i,j]:
                 if i < width - 1:
@@ -340,4 +350,44 @@ def occlude_mask(grid, agent_pos):
                     if i > 0:
                         mask[i - 1, j + 1] = True
                     
-    return mask
\ No newline at end of file
+    return mask
+
+
+@numba.njit
+def occlude_masks(transparent, worlds, positions, dirs, view_sizes, view_offsets):
+    '''
+    Visibility masks of several agents, in their egocentric orientation (the one
+        of MultiGrid.slice with rot_k=dir+1), computed in one call from the
+        transparency of whole worlds rather than from sliced and rotated views.
+
+    transparent: (num_worlds, width, height) boolean array, cells outside of the
+        worlds are transparent.
+    worlds, positions, dirs, view_sizes, view_offsets: world index, (x, y)
+        position, direction, view size and view offset of each agent.
+
+    Returns a (num_agents, max_view_size, max_view_size) boolean array, the mask of
+        agent a is masks[a, :view_sizes[a], :view_sizes[a]].
+    '''
+    n = len(dirs)
+    max_size = view_sizes.max()
+    width, height = transparent.shape[1:]
+    masks = np.zeros((n, max_size, max_size), dtype=numba.boolean)
+    view = np.ones((max_size, max_size), dtype=numba.boolean)
+    for a in range(n):
+        size = view_sizes[a]
+        view_pos = (size // 2, size - 1 - view_offsets[a])
+        # dir_vec, right_vec and the world position of view cell (0, 0).
+        dx, dy = ((1, 0), (0, 1), (-1, 0), (0, -1))[dirs[a]]
+        rx, ry = -dy, dx
+        x0 = positions[a, 0] - view_pos[0] * rx + view_pos[1] * dx
+        y0 = positions[a, 1] - view_pos[0] * ry + view_pos[1] * dy
+        for u in range(size):
+            for v in range(size):
+                x = x0 + u * rx - v * dx
+                y = y0 + u * ry - v * dy
+                if x >= 0 and x < width and y >= 0 and y < height:
+                    view[u, v] = transparent[worlds[a], x, y]
+                else:
+                    view[u, v] = True
+        masks[a, :size, :size] = occlude_mask(view[:size, :size], view_pos)
+    return masks
@@ -0,0 +1,81 @@
+import unittest
+
+import numpy as np
+
+from .agents import GridAgentInterface, occlude_mask, occlude_masks
+from .envs import CollectorMultiGrid
+
+
+class OccludeMasksTest(unittest.TestCase):
+    def test_matches_sliced_views(self):
+        '''The batched masks are the masks of the agents' sliced views, see MultiGridEnv.gen_obs_grid.'''
+        rng = np.random.RandomState(0)
+        for view_offset in (0, 1, 2):
+            env = CollectorMultiGrid(
+                agents=[
+                    GridAgentInterface(color=c, view_size=v, view_tile_size=1, view_offset=min(view_offset, v // 2))
+                    for c, v in [('red', 7), ('blue', 5), ('purple', 9)]
+                ],
+                grid_size=15,
+                clutter_density=0.3,
+                seed=view_offset,
+            )
+            env.reset()
+            for t in range(50):
+                env.step(list(rng.randint(0, 3, size=len(env.agents))))
+                # Directions are drawn so that every view size sees every direction.
+                for agent in env.agents:
+                    agent.dir = rng.randint(4)
+                for agent, mask in zip(env.agents, env.gen_vis_masks()):
+                    grid, _ = env.gen_obs_grid(agent)
+                    with self.subTest(view_offset=view_offset, t=t, view_size=agent.view_size, dir=agent.dir):
+                        np.testing.assert_array_equal(mask, agent.process_vis(grid.opacity))
+
+    def test_views_outside_grid(self):
+        '''Cells outside the worlds are transparent, like the empty cells MultiGrid.slice pads views with.'''
+        rng = np.random.RandomState(1)
+        transparent = rng.rand(2, 6, 8) > 0.3
+        positions = np.array([[0, 0], [5, 7], [2, 3], [5, 0]])
+        for view_size, view_offset in ((3, 0), (5, 1), (7, 3)):
+            for dir in range(4):
+                masks = occlude_masks(
+                    transparent,
+                    np.array([0, 1, 0, 1]),
+                    positions,
+                    np.full(4, dir),
+                    np.full(4, view_size),
+                    np.full(4, view_offset),
+                )
+                view_pos = (view_size // 2, view_size - 1 - view_offset)
+                padded = np.pad(transparent, ((0, 0), (view_size, view_size), (view_size, view_size)), constant_values=True)
+                for a, (world, (x, y)) in enumerate(zip([0, 1, 0, 1], positions)):
+                    # The view in egocentric orientation, built cell by cell.
+                    dx, dy = [(1, 0), (0, 1), (-1, 0), (0, -1)][dir]
+                    rx, ry = -dy, dx
+                    view = np.zeros((view_size, view_size), dtype=bool)
+                    for u in range(view_size):
+                        for v in range(view_size):
+                            i = x + (u - view_pos[0]) * rx + (view_pos[1] - v) * dx
+                            j = y + (u - view_pos[0]) * ry + (view_pos[1] - v) * dy
+                            view[u, v] = padded[world, i + view_size, j + view_size]
+                    with self.subTest(view_size=view_size, view_offset=view_offset, dir=dir, agent=a):
+                        np.testing.assert_array_equal(masks[a], occlude_mask(view, view_pos))
+
+    def test_agent_on_last_row(self):
+        '''
+        occlude_mask only reads the view: with the agent on the last row (view_offset=0),
+            the memory that follows the view must not change the mask.
+        '''
+        rng = np.random.RandomState(2)
+        for _ in range(20):
+            backing = np.empty((7, 8), dtype=bool)
+            backing[:, :7] = rng.rand(7, 7) > 0.4
+            masks = []
+            for next_row in (False, True):
+                backing[:, 7] = next_row
+                masks.append(occlude_mask(backing[:, :7], (3, 6)))
+            np.testing.assert_array_equal(masks[0], masks[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
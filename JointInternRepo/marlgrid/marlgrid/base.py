@@ -9,7 +9,7 @@ import math
 import warnings
 
 from .objects import WorldObj, Wall, Goal, Lava, GridAgent, BonusTile, BulkObj, COLORS
-from .agents import GridAgentInterface
+from .agents import GridAgentInterface, occlude_masks
 from .rendering import SimpleImageViewer
 from gym_minigrid.rendering import fill_coords, point_in_rect, downsample, highlight_img
 
@@ -26,26 +26,58 @@ class ObjectRegistry:
         self.key_to_obj_map = {}
         self.obj_to_key_map = {}
         self.max_num_objects = max_num_objects
+        # Keys are handed out from a counter, and keys of removed objects are
+        #  reused first, so that allocating a key doesn't scan the registry.
+        self.next_key = 0
+        self.free_keys = []
+        # see_behind() of the object of each key, so that grid opacity is a
+        # single lookup rather than a method call per cell. Empty keys and None
+        # are transparent.
+        self.see_behind = np.ones(max_num_objects, dtype=bool)
+        # encode() of the object of each key, for symbolic observations, and its
+        #  type/color/state columns.
+        self.encodings = np.zeros((max_num_objects, 3), dtype=np.uint8)
+        self.types = self.encodings[:, 0]
+        self.colors = self.encodings[:, 1]
+        self.states = self.encodings[:, 2]
         for obj in objs:
             self.add_object(obj)
 
     def get_next_key(self):
-        for k in range(self.max_num_objects):
-            if k not in self.key_to_obj_map:
-                break
-        else:
+        if self.free_keys:
+            return self.free_keys.pop()
+        if self.next_key >= self.max_num_objects:
             raise ValueError("Object registry full.")
-        return k
+        self.next_key += 1
+        return self.next_key - 1
 
     def __len__(self):
-        return len(self.id_to_obj_map)
+        return len(self.key_to_obj_map)
 
     def add_object(self, obj):
         new_key = self.get_next_key()
         self.key_to_obj_map[new_key] = obj
         self.obj_to_key_map[obj] = new_key
+        self.update_object(obj)
         return new_key
 
+    def remove_object(self, obj):
+        key = self.obj_to_key_map.pop(obj)
+        del self.key_to_obj_map[key]
+        self.see_behind[key] = True
+        self.encodings[key] = 0
+        self.free_keys.append(key)
+
+    def update_object(self, obj):
+        '''
+        Refreshes the cached properties of a registered object. Must be called
+            after the state of an object changes in a way that affects them
+            (e.g. a door being opened or closed, an agent turning).
+        '''
+        key = self.obj_to_key_map[obj]
+        self.see_behind[key] = obj.see_behind() if hasattr(obj, 'see_behind') else True
+        self.encodings[key] = obj.encode() if obj is not None else 0
+
     def contains_object(self, obj):
         return obj in self.obj_to_key_map
 
@@ -102,8 +134,7 @@ class MultiGrid:
 
     @property
     def opacity(self):
-        transparent_fun = np.vectorize(lambda k: (self.obj_reg.key_to_obj_map[k].see_behind() if hasattr(self.obj_reg.key_to_obj_map[k], 'see_behind') else True))
-        return ~transparent_fun(self.grid)
+        return ~self.obj_reg.see_behind[self.grid]
 
     def __getitem__(self, *args, **kwargs):
         return self.__class__(
@@ -197,20 +228,9 @@ class MultiGrid:
         """
         Produce a compact numpy encoding of the grid
         """
-
-        if vis_mask is None:
-            vis_mask = np.ones((self.width, self.height), dtype=bool)
-
-        array = np.zeros((self.width, self.height, 3), dtype="uint8")
-
-        for i in range(self.width):
-            for j in range(self.height):
-                if vis_mask[i, j]:
-                    v = self.get(i, j)
-                    if v is None:
-                        array[i, j, :] = 0
-                    else:
-                        array[i, j, :] = v.encode()
+        array = self.obj_reg.encodings[self.grid]
+        if vis_mask is not None:
+            array *= vis_mask[..., None]
         return array
 
     @classmethod
@@ -302,30 +322,30 @@ class MultiGrid:
         return img
 
     def render(self, tile_size, highlight_mask=None, visible_mask=None, top_agent=None):
-        width_px = self.width * tile_size
-        height_px = self.height * tile_size
-
-        img = np.zeros(shape=(height_px, width_px), dtype=np.uint8)[...,None]+COLORS['shadow']
-
-        for j in range(0, self.height):
-            for i in range(0, self.width):
-                if visible_mask is not None and not visible_mask[i,j]:
-                    continue
-                obj = self.get(i, j)
-
-                tile_img = MultiGrid.render_tile(
-                    obj,
-                    tile_size=tile_size,
-                    top_agent=top_agent
-                )
+        # Each distinct key in the grid is rendered once into a tile atlas, whose
+        #  last tile is the shadow drawn over cells that aren't visible. The image
+        #  is then a single gather of atlas tiles followed by a transpose.
+        keys, tile_idx = np.unique(self.grid, return_inverse=True)
+        tile_idx = tile_idx.reshape(self.grid.shape)
+        if visible_mask is not None:
+            tile_idx = np.where(visible_mask, tile_idx, len(keys))
+
+        atlas = np.empty((len(keys) + 1, tile_size, tile_size, 3), dtype=np.uint8)
+        for n, key in enumerate(keys):
+            atlas[n] = MultiGrid.render_tile(
+                self.obj_reg.key_to_obj_map[key],
+                tile_size=tile_size,
+                top_agent=top_agent
+            )
+        atlas[-1] = COLORS['shadow']
+        # rotate_grid acts on the first two axes, so move the tile axes there to
+        #  rotate all the tiles at once.
+        atlas = np.moveaxis(rotate_grid(np.moveaxis(atlas, 0, 2), self.orientation), 2, 0)
 
-                ymin = j * tile_size
-                ymax = (j + 1) * tile_size
-                xmin = i * tile_size
-                xmax = (i + 1) * tile_size
+        # (width, height, tile_y, tile_x, 3) -> (height * tile_y, width * tile_x, 3)
+        img = atlas[tile_idx].transpose(1, 2, 0, 3, 4).reshape(
+            self.height * tile_size, self.width * tile_size, 3)
 
-                img[ymin:ymax, xmin:xmax, :] = rotate_grid(tile_img, self.orientation)
-        
         if highlight_mask is not None:
             hm = np.kron(highlight_mask.T, np.full((tile_size, tile_size), 255, dtype=np.uint16)
                 )[...,None] # arcane magic.
@@ -429,7 +449,7 @@ class MultiGridEnv(gym.Env):
         obs = self.gen_obs()
         return obs
 
-    def gen_obs_grid(self, agent):
+    def gen_obs_grid(self, agent, vis_mask=None):
         # If the agent is inactive, return an empty grid and a visibility mask that hides everything.
         if not agent.active:
             # below, not sure orientation is correct but as of 6/27/2020 that doesn't matter because
@@ -444,9 +464,9 @@ class MultiGridEnv(gym.Env):
             topX, topY, agent.view_size, agent.view_size, rot_k=agent.dir + 1
         )
 
-        # Process occluders and visibility
-        # Note that this incurs some slight performance cost
-        vis_mask = agent.process_vis(grid.opacity)
+        # Process occluders and visibility, unless done for all agents by gen_vis_masks.
+        if vis_mask is None:
+            vis_mask = agent.process_vis(grid.opacity)
 
         # Warning about the rest of the function:
         #  Allows masking away objects that the agent isn't supposed to see.
@@ -464,11 +484,13 @@ class MultiGridEnv(gym.Env):
 
         return grid, vis_mask
 
-    def gen_agent_obs(self, agent):
+    def gen_agent_obs(self, agent, vis_mask=None):
         """
         Generate the agent's view (partially observable, low-resolution encoding)
         """
-        grid, vis_mask = self.gen_obs_grid(agent)
+        grid, vis_mask = self.gen_obs_grid(agent, vis_mask)
+        if agent.observation_style=='symbolic':
+            return grid.encode(vis_mask=vis_mask)
         grid_image = grid.render(tile_size=agent.view_tile_size, visible_mask=vis_mask, top_agent=agent)
         if agent.observation_style=='image':
             return grid_image
@@ -485,7 +507,35 @@ class MultiGridEnv(gym.Env):
             return ret
 
     def gen_obs(self):
-        return [self.gen_agent_obs(agent) for agent in self.agents]
+        # Agents turn and respawn every step, refresh their cached encodings.
+        for agent in self.agents:
+            if self.grid.obj_reg.contains_object(agent):
+                self.grid.obj_reg.update_object(agent)
+        vis_masks = self.gen_vis_masks()
+        return [self.gen_agent_obs(agent, vis_mask) for agent, vis_mask in zip(self.agents, vis_masks)]
+
+    def gen_vis_masks(self):
+        '''
+        Visibility masks of all the agents, computed with a single call of the
+            occlusion kernel. None for agents that don't need one (inactive agents
+            and agents that see through walls).
+        '''
+        occluded = [k for k, agent in enumerate(self.agents) if agent.active and not agent.see_through_walls]
+        vis_masks = [None] * len(self.agents)
+        if not occluded:
+            return vis_masks
+        agents = [self.agents[k] for k in occluded]
+        masks = occlude_masks(
+            (~self.grid.opacity)[None],
+            np.zeros(len(agents), dtype=np.int64),
+            np.array([agent.pos for agent in agents], dtype=np.int64),
+            np.array([agent.dir for agent in agents], dtype=np.int64),
+            np.array([agent.view_size for agent in agents], dtype=np.int64),
+            np.array([agent.view_offset for agent in agents], dtype=np.int64),
+        )
+        for k, agent, mask in zip(occluded, agents, masks):
+            vis_masks[k] = mask[:agent.view_size, :agent.view_size]
+        return vis_masks
 
     def __str__(self):
         return self.grid.__str__()
@@ -589,6 +639,8 @@ class MultiGridEnv(gym.Env):
                         # Rewards can be got iff. fwd_cell has a "get_reward" method
                         if hasattr(fwd_cell, 'get_reward'):
                             rwd = fwd_cell.get_reward(agent)
+                            # Collecting a bonus changes its encoding.
+                            self.grid.obj_reg.update_object(fwd_cell)
                             if bool(self.reward_decay):
                                 rwd *= (1.0-0.9*(self.step_count/self.max_steps))
                             step_rewards[agent_no] += rwd
@@ -623,6 +675,7 @@ class MultiGridEnv(gym.Env):
                 elif action == agent.actions.toggle:
                     if fwd_cell:
                         wasted = bool(fwd_cell.toggle(agent, fwd_pos))
+                        self.grid.obj_reg.update_object(fwd_cell)
                     else:
                         pass
 
@@ -662,7 +715,7 @@ class MultiGridEnv(gym.Env):
         # The episode overall is done if all the agents are done, or if it exceeds the step limit.
         done = (self.step_count >= self.max_steps) or all([agent.done for agent in self.agents])
 
-        obs = [self.gen_agent_obs(agent) for agent in self.agents]
+        obs = self.gen_obs()
 
         return obs, step_rewards, done, {}
 
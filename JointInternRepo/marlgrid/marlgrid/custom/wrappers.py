@@ -98,7 +98,8 @@ def upload_logs(local_logdir, remote_logdir):
     while True:
         local_files = tf.io.gfile.listdir(local_logdir)
         remote_files = tf.io.gfile.listdir(remote_logdir)
-        diff = list(set(local_files) - set(remote_files))
+        # Hidden files are exports that aren't complete yet.
+        diff = [f for f in set(local_files) - set(remote_files) if not f.startswith('.')]
         for f in diff:
             tf.io.gfile.copy(os.path.join(local_logdir, f),
                              os.path.join(remote_logdir, f))
@@ -7,6 +7,7 @@ from .goalcycle import ClutteredGoalCycleEnv
 from .viz_test import VisibilityTestEnv
 
 from .collector import CollectorMultiGrid
+from .vector_collector import VectorCollectorMultiGrid
 
 from ..agents import GridAgentInterface
 from gym.envs.registration import register as gym_register
@@ -1,3 +1,5 @@
+import numpy as np
+
 from ..base import MultiGridEnv, MultiGrid
 from ..objects import *
 
@@ -27,57 +29,48 @@ class CollectorMultiGrid(MultiGridEnv):
         
 
 
-    def _gen_grid(self, width, height):
+    def _build_template(self, width, height):
+        '''
+        Builds what is shared by all episodes: the grid with its wall border and
+            fixed bonus tiles, the pool of bonus tiles and the clutter wall, all
+            registered once, and the cells left free for random placement.
+        '''
         self.grid = MultiGrid((width, height))
         self.grid.wall_rect(0, 0, width, height)
-        # if getattr(self, 'randomize_goal', True):
-        #     self.place_obj(Goal(color="green", reward=1), max_tries=100)
-        # else:
-        #     self.put_obj(Goal(color="green", reward=1), width - 2, height - 2)
-
-        per_bonus_reward = 1.0 / (self.n_random_bonuses + 5)
-        bonus_id = 0
-        self.put_obj(BonusTile(reward=0.1,
-            penalty=0.0,
-            color='green',
-            bonus_id=bonus_id), 1, 1)
-        bonus_id += 1
-        
-        self.put_obj(BonusTile(reward=0.1,
-            penalty=0.0,
-            color='green',
-            bonus_id=bonus_id), width - 2, 1)
-        bonus_id += 1
-
-        self.put_obj(BonusTile(reward=0.1,
-            penalty=0.0,
-            color='green',
-            bonus_id=bonus_id), 1, height - 2)
-        bonus_id += 1
-
-        self.put_obj(BonusTile(reward=0.1,
-            penalty=0.0,
-            color='green',
-            bonus_id=bonus_id), width - 2, height - 2)
-        bonus_id += 1
-
-        self.put_obj(BonusTile(reward=0.1,
-            penalty=0.0,
-            color='green',
-            bonus_id=bonus_id), width // 2, height // 2)
-        bonus_id += 1
-
-        for i in range(self.n_random_bonuses):
-            self.place_obj(BonusTile(reward=0.1,
-                penalty=0.0,
-                color='green',
-                bonus_id=bonus_id),
-                max_tries=100)
-            bonus_id += 1
 
-        
-        for _ in range(getattr(self, 'n_clutter', 0)):
-            self.place_obj(Wall(), max_tries=100)
+        fixed_positions = [(1, 1), (width - 2, 1), (1, height - 2), (width - 2, height - 2), (width // 2, height // 2)]
+        self.bonus_pool = [
+            BonusTile(reward=0.1, penalty=0.0, color='green', bonus_id=bonus_id)
+            for bonus_id in range(len(fixed_positions) + self.n_random_bonuses)
+        ]
+        for bonus, pos in zip(self.bonus_pool, fixed_positions):
+            self.put_obj(bonus, *pos)
+        self.bonus_keys = np.array([self.grid.obj_reg.get_key(bonus) for bonus in self.bonus_pool])
+        self.clutter_key = self.grid.obj_reg.get_key(Wall())
+
+        self.grid_template = self.grid.grid.copy()
+        self.free_cells = np.flatnonzero(self.grid_template == self.grid.obj_reg.get_key(None))
+
+    def _gen_grid(self, width, height):
+        # The grid is restored from a template and the same objects are reused
+        #  every episode, so only the positions of the random bonuses and of the
+        #  clutter are drawn.
+        if getattr(self, 'grid_template', None) is None or self.grid_template.shape != (width, height):
+            self._build_template(width, height)
+        np.copyto(self.grid.grid, self.grid_template)
+        for bonus in self.bonus_pool:
+            bonus.active = True
+            bonus.agents = []
+            self.grid.obj_reg.update_object(bonus)
+
+        n_fixed = len(self.bonus_pool) - self.n_random_bonuses
+        n_clutter = getattr(self, 'n_clutter', 0)
+        cells = self.np_random.choice(self.free_cells, size=self.n_random_bonuses + n_clutter, replace=False)
+        bonus_cells = cells[:self.n_random_bonuses]
+        self.grid.grid.flat[bonus_cells] = self.bonus_keys[n_fixed:]
+        self.grid.grid.flat[cells[self.n_random_bonuses:]] = self.clutter_key
+        for bonus, cell in zip(self.bonus_pool[n_fixed:], bonus_cells):
+            bonus.set_position(np.unravel_index(cell, (width, height)))
 
         self.agent_spawn_kwargs = {}
         # unused function
@@ -0,0 +1,105 @@
+import unittest
+
+import numpy as np
+
+from ..agents import GridAgentInterface
+from ..base import MultiGrid
+from ..objects import BonusTile, Wall
+from .collector import CollectorMultiGrid
+
+GRID_SIZE = 15
+N_RANDOM_BONUSES = 6
+N_FIXED_BONUSES = 5
+
+
+class LegacyCollectorMultiGrid(CollectorMultiGrid):
+    '''CollectorMultiGrid with the grid generation it had before resets used a template.'''
+    def _gen_grid(self, width, height):
+        self.grid = MultiGrid((width, height))
+        self.grid.wall_rect(0, 0, width, height)
+        fixed_positions = [(1, 1), (width - 2, 1), (1, height - 2), (width - 2, height - 2), (width // 2, height // 2)]
+        for bonus_id, pos in enumerate(fixed_positions):
+            self.put_obj(BonusTile(reward=0.1, penalty=0.0, color='green', bonus_id=bonus_id), *pos)
+        for bonus_id in range(len(fixed_positions), len(fixed_positions) + self.n_random_bonuses):
+            self.place_obj(BonusTile(reward=0.1, penalty=0.0, color='green', bonus_id=bonus_id), max_tries=100)
+        for _ in range(getattr(self, 'n_clutter', 0)):
+            self.place_obj(Wall(), max_tries=100)
+        self.agent_spawn_kwargs = {}
+        self.place_agents(**self.agent_spawn_kwargs)
+
+
+def make_env(cls=CollectorMultiGrid, seed=5):
+    return cls(
+        agents=[GridAgentInterface(color=c, view_size=7, view_tile_size=1) for c in ['red', 'blue', 'purple']],
+        grid_size=GRID_SIZE,
+        clutter_density=0.15,
+        n_random_bonuses=N_RANDOM_BONUSES,
+        seed=seed,
+    )
+
+
+def layout(env):
+    '''The bonus id (-1 for none) and whether there is a wall, for each cell of the grid.'''
+    bonus_ids = np.full((env.width, env.height), -1)
+    walls = np.zeros((env.width, env.height), dtype=bool)
+    for i in range(env.width):
+        for j in range(env.height):
+            obj = env.grid.get(i, j)
+            if isinstance(obj, BonusTile):
+                bonus_ids[i, j] = obj.bonus_id
+            walls[i, j] = isinstance(obj, Wall)
+    return bonus_ids, walls
+
+
+class CollectorMultiGridTest(unittest.TestCase):
+    def test_seeded_resets(self):
+        env, other = make_env(), make_env()
+        for _ in range(5):
+            env.reset()
+            other.reset()
+            np.testing.assert_array_equal(env.grid.grid, other.grid.grid)
+            for bonus, other_bonus in zip(env.bonus_pool, other.bonus_pool):
+                self.assertEqual(tuple(bonus.pos), tuple(other_bonus.pos))
+                self.assertIs(env.grid.get(*bonus.pos), bonus)
+            self.assertEqual([tuple(a.pos) for a in env.agents], [tuple(a.pos) for a in other.agents])
+
+    def test_layout_distribution(self):
+        '''
+        Random bonuses and clutter are placed like before: on distinct cells,
+            uniformly among the cells that are free in the template.
+        '''
+        n_resets = 400
+        for cls in (CollectorMultiGrid, LegacyCollectorMultiGrid):
+            with self.subTest(cls=cls.__name__):
+                env = make_env(cls)
+                bonus_counts = np.zeros((N_FIXED_BONUSES + N_RANDOM_BONUSES, GRID_SIZE, GRID_SIZE))
+                wall_counts = np.zeros((GRID_SIZE, GRID_SIZE))
+                for _ in range(n_resets):
+                    env.reset()
+                    bonus_ids, walls = layout(env)
+                    for bonus_id in range(N_FIXED_BONUSES + N_RANDOM_BONUSES):
+                        self.assertEqual((bonus_ids == bonus_id).sum(), 1)
+                        bonus_counts[bonus_id] += bonus_ids == bonus_id
+                    wall_counts += walls
+
+                free = np.ones((GRID_SIZE, GRID_SIZE), dtype=bool)
+                free[[0, -1], :] = free[:, [0, -1]] = False
+                for bonus_id in range(N_FIXED_BONUSES):
+                    free &= bonus_counts[bonus_id] == 0
+                    self.assertEqual(bonus_counts[bonus_id].max(), n_resets)
+                self.assertEqual(free.sum(), (GRID_SIZE - 2) ** 2 - N_FIXED_BONUSES)
+                # Border walls are always there, and clutter has a fixed size.
+                self.assertTrue((wall_counts[~free] == n_resets * (bonus_counts.sum(0) == 0)[~free]).all())
+                self.assertEqual(wall_counts[free].sum(), n_resets * env.n_clutter)
+
+                # Chi-squared statistics of the per-cell counts against a uniform
+                #  distribution over free cells, with free.sum() - 1 = 163 degrees of
+                #  freedom: a bound of 240 is exceeded with probability < 1e-4.
+                random_counts = bonus_counts[N_FIXED_BONUSES:].sum(0)[free]
+                for counts, n in ((random_counts, N_RANDOM_BONUSES), (wall_counts[free], env.n_clutter)):
+                    expected = n_resets * n / free.sum()
+                    self.assertLess((((counts - expected) ** 2) / expected).sum(), 240)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,380 @@
+import numpy as np
+
+from ..agents import GridAgentInterface, occlude_masks
+from ..base import MultiGrid, rotate_grid
+from ..objects import Wall, BonusTile, COLORS
+
+# Cell contents of the vectorized worlds. Agents are kept apart, as positions.
+EMPTY = 0
+WALL = 1
+BONUS = 2
+BONUS_USED = 3
+NUM_KINDS = 4
+
+BONUS_REWARD = 0.1
+N_FIXED_BONUSES = 5
+
+AGENT_COLORS = ["red", "blue", "purple", "orange", "olive", "pink"]
+
+# GridAgentInterface.dir_vec for each direction.
+DIR_VECS = np.array([[1, 0], [0, 1], [-1, 0], [0, -1]])
+
+
+def view_offsets(view_size, view_offset):
+    '''
+    Offsets from the agent position of the cells of its (rotated) view, for each
+        direction: an array of shape (4, view_size, view_size, 2). This replicates
+        GridAgentInterface.get_view_exts followed by MultiGrid.slice.
+    '''
+    hs = view_size // 2
+    tops = [
+        (-view_offset, -hs),
+        (-hs, -view_offset),
+        (-view_size + 1 + view_offset, -hs),
+        (-hs, -view_size + 1 + view_offset),
+    ]
+    ij = np.stack(np.meshgrid(np.arange(view_size), np.arange(view_size), indexing='ij'), axis=-1)
+    # rotate_grid only acts on the two first axes.
+    return np.stack([rotate_grid(ij + np.array(top), dir + 1) for dir, top in enumerate(tops)])
+
+
+class VectorCollectorMultiGrid:
+    '''
+    A batch of CollectorMultiGrid worlds, stepped together with array operations.
+
+    The worlds are stored as stacked numpy arrays (cell contents, bonus ids, agent
+        positions and directions) rather than as grids of objects, and moves,
+        rotations, bonus collection and observations are computed for all the
+        worlds at once. Agents are only iterated over (in each world's random
+        order) to keep the sequential semantics of MultiGridEnv.step.
+
+    The class exposes the interface of seed_rl's BatchedEnvironment, so it can be
+        used by the actor in place of a batch of wrapped CollectorMultiGrid
+        environments. Observations, rewards and dones match those of
+        MultiWrapper(CollectorMultiGrid(...)): per world, an array of the
+        observations of all the agents, the sum of their rewards, and whether the
+        step limit was reached. Pickup, drop, toggle and done actions have no effect
+        in collector worlds and are ignored.
+
+    Image observations are only supported with view_tile_size=1, for which
+        rendering is a palette lookup. The palette is computed with
+        MultiGrid.render_tile, so pixels are the same as in CollectorMultiGrid.
+    '''
+    def __init__(
+        self,
+        batch_size,
+        n_agents=3,
+        grid_size=15,
+        view_size=7,
+        view_offset=0,
+        observation_style='image',
+        n_clutter=None,
+        clutter_density=None,
+        n_random_bonuses=6,
+        fixed_players=False,
+        max_steps=100,
+        reward_decay=True,
+        ghost_mode=True,
+        see_through_walls=False,
+        seed=1337,
+        id_offset=0,
+        normalization=None,
+        dtype=np.uint8,
+    ):
+        if (n_clutter is None) == (clutter_density is None):
+            raise ValueError("Must provide n_clutter xor clutter_density in environment config.")
+        if observation_style not in ('image', 'symbolic'):
+            raise ValueError(f"{self.__class__.__name__} kwarg 'observation_style' must be one of 'image', 'symbolic'.")
+        assert n_agents <= len(AGENT_COLORS)
+
+        self.batch_size = batch_size
+        self.n_agents = n_agents
+        self.width = self.height = grid_size
+        self.view_size = view_size
+        self.view_offset = view_offset
+        self.observation_style = observation_style
+        if clutter_density is not None:
+            self.n_clutter = int(clutter_density * (self.width-2)*(self.height-2))
+        else:
+            self.n_clutter = n_clutter
+        self.n_random_bonuses = n_random_bonuses
+        self.fixed_players = fixed_players
+        self.max_steps = max_steps
+        self.reward_decay = reward_decay
+        self.ghost_mode = ghost_mode
+        self.see_through_walls = see_through_walls
+        self.normalization = (lambda x: x) if normalization is None else normalization
+        self.env_seed = seed
+        self.np_random = np.random.RandomState(seed)
+        self._env_ids = np.arange(id_offset, id_offset + batch_size, dtype=np.int32)
+
+        self._view_offsets = view_offsets(view_size, view_offset)
+        self._view_pos = (view_size // 2, view_size - 1 - view_offset)
+        self._build_tables()
+
+        shape = (batch_size, self.width, self.height)
+        self.kinds = np.zeros(shape, dtype=np.uint8)
+        self.bonus_ids = np.zeros(shape, dtype=np.uint8)
+        # Number of agents in each cell.
+        self.agent_counts = np.zeros(shape, dtype=np.int32)
+        self.agent_pos = np.zeros((batch_size, n_agents, 2), dtype=np.int64)
+        # Like in MultiGridEnv, the directions of agents carry over between episodes.
+        self.agent_dirs = np.zeros((batch_size, n_agents), dtype=np.int64)
+        # Time at which each agent entered its cell. The agents of a cell are shown
+        #  (and stacked) in the order they entered it.
+        self.agent_arrivals = np.zeros((batch_size, n_agents), dtype=np.int64)
+        self.step_count = np.zeros(batch_size, dtype=np.int64)
+
+        self._obs = np.zeros((batch_size, n_agents, view_size, view_size, 3), dtype=dtype)
+        self._rewards = np.zeros(batch_size, dtype=np.float32)
+
+    def _build_tables(self):
+        '''
+        Computes the symbolic encodings and the tile_size=1 colors of all possible
+            cell contents from actual marlgrid objects.
+        '''
+        agents = [GridAgentInterface(color=c, view_size=self.view_size) for c in AGENT_COLORS[:self.n_agents]]
+        for agent in agents:
+            agent.activate()
+        wall = Wall()
+        bonus = BonusTile(reward=BONUS_REWARD, penalty=0.0, color='green')
+        used_bonus = BonusTile(reward=BONUS_REWARD, penalty=0.0, color='green')
+        used_bonus.active = False
+
+        # Encodings, with the state of bonus tiles (their bonus_id) added per cell.
+        self._kind_encodings = np.zeros((NUM_KINDS, 3), dtype=np.uint8)
+        self._kind_encodings[WALL] = wall.encode()
+        self._kind_encodings[BONUS] = bonus.encode()
+        self._kind_encodings[BONUS_USED] = used_bonus.encode()
+        # Agents' encodings, with their direction as state.
+        self._agent_encodings = np.array([agent.encode() for agent in agents], dtype=np.uint8)
+
+        render = lambda obj, top_agent=None: MultiGrid.render_tile(obj, tile_size=1, top_agent=top_agent)[0, 0]
+        self._kind_colors = np.zeros((NUM_KINDS + 1, 3), dtype=np.uint8)
+        self._kind_colors[EMPTY] = render(None)
+        self._kind_colors[WALL] = render(wall)
+        self._kind_colors[BONUS] = render(bonus)
+        self._kind_colors[BONUS_USED] = render(used_bonus)
+        self._kind_colors[NUM_KINDS] = COLORS['shadow']
+        # Colors of cells showing an agent, indexed by (kind, agent, direction).
+        self._agent_colors = np.zeros((NUM_KINDS, self.n_agents, 4, 3), dtype=np.uint8)
+        for a, agent in enumerate(agents):
+            for dir in range(4):
+                agent.dir = dir
+                self._agent_colors[EMPTY, a, dir] = render(agent)
+                for kind, tile in ((BONUS, bonus), (BONUS_USED, used_bonus)):
+                    tile.agents = [agent]
+                    self._agent_colors[kind, a, dir] = render(tile, top_agent=agent)
+                    tile.agents = []
+
+    @property
+    def env_ids(self):
+        return self._env_ids
+
+    @property
+    def raw_rewards(self):
+        '''Rewards of the last step. Collector rewards are not rescaled, so they are the raw rewards.'''
+        return self._rewards
+
+    def _gen_worlds(self, worlds):
+        '''
+        Generates new episodes in the given worlds, the vectorized counterpart of
+            CollectorMultiGrid._gen_grid followed by the agent placement of
+            MultiGridEnv.reset.
+        '''
+        n = len(worlds)
+        w, h = self.width, self.height
+        kinds = np.zeros((n, w, h), dtype=np.uint8)
+        bonus_ids = np.zeros((n, w, h), dtype=np.uint8)
+        kinds[:, [0, -1], :] = WALL
+        kinds[:, :, [0, -1]] = WALL
+
+        fixed_bonuses = [(1, 1), (w - 2, 1), (1, h - 2), (w - 2, h - 2), (w // 2, h // 2)]
+        for bonus_id, (i, j) in enumerate(fixed_bonuses):
+            kinds[:, i, j] = BONUS
+            bonus_ids[:, i, j] = bonus_id
+
+        # Random bonuses and clutter go to distinct empty cells: sampling without
+        #  replacement, as a sort of random keys.
+        n_placed = self.n_random_bonuses + self.n_clutter
+        keys = self.np_random.rand(n, w * h)
+        keys[kinds.reshape(n, -1) != EMPTY] = np.inf
+        cells = np.argsort(keys, axis=1)[:, :n_placed]
+        rows = np.arange(n)[:, None]
+        flat_kinds = kinds.reshape(n, -1)
+        flat_kinds[rows, cells[:, :self.n_random_bonuses]] = BONUS
+        flat_kinds[rows, cells[:, self.n_random_bonuses:]] = WALL
+        bonus_ids.reshape(n, -1)[rows, cells[:, :self.n_random_bonuses]] = (
+            N_FIXED_BONUSES + np.arange(self.n_random_bonuses))
+
+        counts = np.zeros((n, w, h), dtype=np.int32)
+        pos = np.zeros((n, self.n_agents, 2), dtype=np.int64)
+        if self.fixed_players:
+            for a in range(self.n_agents):
+                i = w // 2 - 1 + a
+                j = h // 2 + (1 if a == self.n_agents // 2 else 0)
+                # Agents are put over whatever was there.
+                kinds[:, i, j] = EMPTY
+                pos[:, a] = (i, j)
+                counts[:, i, j] += 1
+        else:
+            for a in range(self.n_agents):
+                allowed = kinds != WALL
+                if not self.ghost_mode:
+                    allowed &= counts == 0
+                keys = self.np_random.rand(n, w * h)
+                cell = np.argmax(np.where(allowed.reshape(n, -1), keys, -1), axis=1)
+                pos[:, a] = np.stack(np.unravel_index(cell, (w, h)), axis=-1)
+                counts[np.arange(n), pos[:, a, 0], pos[:, a, 1]] += 1
+
+        self.kinds[worlds] = kinds
+        self.bonus_ids[worlds] = bonus_ids
+        self.agent_counts[worlds] = counts
+        self.agent_pos[worlds] = pos
+        self.agent_arrivals[worlds] = np.arange(self.n_agents) - self.n_agents
+        self.step_count[worlds] = 0
+
+    def _first_agents(self, worlds):
+        '''Returns the first agent in each cell of the worlds (-1 for no agent).'''
+        first = np.full((len(worlds), self.width, self.height), -1, dtype=np.int64)
+        rows = np.arange(len(worlds))
+        pos = self.agent_pos[worlds]
+        # Latest arrivals are written first, so that the earliest ones remain.
+        for a in np.argsort(-self.agent_arrivals[worlds], axis=1).T:
+            first[rows, pos[rows, a, 0], pos[rows, a, 1]] = a
+        return first
+
+    def _gen_obs(self, worlds):
+        '''Writes the observations of all the agents of the worlds.'''
+        n = len(worlds)
+        pos = self.agent_pos[worlds]
+        dirs = self.agent_dirs[worlds]
+
+        # World coordinates of the view cells, (n, agents, view, view).
+        offsets = self._view_offsets[dirs]
+        xs = pos[:, :, None, None, 0] + offsets[..., 0]
+        ys = pos[:, :, None, None, 1] + offsets[..., 1]
+        inside = (xs >= 0) & (xs < self.width) & (ys >= 0) & (ys < self.height)
+        xs = np.clip(xs, 0, self.width - 1)
+        ys = np.clip(ys, 0, self.height - 1)
+        rows = np.arange(n)[:, None, None, None]
+        world_rows = worlds[:, None, None, None]
+
+        # Cells outside the grid are empty.
+        kinds = np.where(inside, self.kinds[world_rows, xs, ys], EMPTY)
+        first_agents = np.where(inside, self._first_agents(worlds)[rows, xs, ys], -1)
+
+        if self.see_through_walls:
+            vis = np.ones(kinds.shape, dtype=bool)
+        else:
+            n_views = n * self.n_agents
+            vis = occlude_masks(
+                self.kinds[worlds] != WALL,
+                np.repeat(np.arange(n), self.n_agents),
+                pos.reshape(n_views, 2),
+                dirs.reshape(n_views),
+                np.full(n_views, self.view_size),
+                np.full(n_views, self.view_offset),
+            ).reshape(kinds.shape)
+
+        has_agent = first_agents >= 0
+        agent_dirs = dirs[rows, np.maximum(first_agents, 0)]
+
+        if self.observation_style == 'symbolic':
+            # The encoding of the top object of the cell, see MultiGrid.encode.
+            obs = self._kind_encodings[kinds]
+            obs[..., 2] += self.bonus_ids[world_rows, xs, ys] * (kinds >= BONUS)
+            on_floor = has_agent & (kinds == EMPTY)
+            obs[on_floor] = self._agent_encodings[first_agents[on_floor]]
+            obs[on_floor, 2] = agent_dirs[on_floor]
+            obs *= vis[..., None]
+        else:
+            # Agents see themselves in their own cell, see MultiGrid.render_tile.
+            viewers = np.arange(self.n_agents)
+            first_agents[:, viewers, self._view_pos[0], self._view_pos[1]] = viewers
+            agent_dirs[:, viewers, self._view_pos[0], self._view_pos[1]] = dirs
+            has_agent = first_agents >= 0
+            obs = np.where(
+                has_agent[..., None],
+                self._agent_colors[kinds, np.maximum(first_agents, 0), agent_dirs],
+                self._kind_colors[kinds],
+            )
+            obs[~vis] = self._kind_colors[NUM_KINDS]
+            # Images are indexed (row, column), i.e. (y, x).
+            obs = np.swapaxes(obs, 2, 3)
+
+        self._obs[worlds] = self.normalization(obs)
+
+    def reset(self):
+        worlds = np.arange(self.batch_size)
+        self._gen_worlds(worlds)
+        self._gen_obs(worlds)
+        return self._obs
+
+    def reset_if_done(self, done):
+        worlds = np.flatnonzero(done)
+        if len(worlds):
+            self._gen_worlds(worlds)
+            self._gen_obs(worlds)
+        return self._obs
+
+    def step(self, action_batch):
+        '''
+        Steps all the worlds. Agents act in a random order in each world, like in
+            MultiGridEnv.step, which matters for which agent collects a bonus.
+        '''
+        action_batch = np.asarray(action_batch)
+        worlds = np.arange(self.batch_size)
+        self.step_count += 1
+        rewards = np.zeros(self.batch_size, dtype=np.float32)
+        if self.reward_decay:
+            reward_scale = 1.0 - 0.9 * (self.step_count / self.max_steps)
+        else:
+            reward_scale = np.ones(self.batch_size)
+
+        order = np.argsort(self.np_random.rand(self.batch_size, self.n_agents), axis=1)
+        for k in range(self.n_agents):
+            agents = order[:, k]
+            actions = action_batch[worlds, agents]
+            dirs = self.agent_dirs[worlds, agents]
+            self.agent_dirs[worlds, agents] = np.select(
+                [actions == GridAgentInterface.actions.left, actions == GridAgentInterface.actions.right],
+                [(dirs - 1) % 4, (dirs + 1) % 4],
+                dirs,
+            )
+
+            cur = self.agent_pos[worlds, agents]
+            fwd = cur + DIR_VECS[dirs]
+            fwd_kinds = self.kinds[worlds, fwd[:, 0], fwd[:, 1]]
+            moves = (actions == GridAgentInterface.actions.forward) & (fwd_kinds != WALL)
+            if not self.ghost_mode:
+                # Agents can't move onto agents that aren't on a tile.
+                moves &= ~((fwd_kinds == EMPTY) & (self.agent_counts[worlds, fwd[:, 0], fwd[:, 1]] > 0))
+
+            m = worlds[moves]
+            self.agent_counts[m, cur[moves, 0], cur[moves, 1]] -= 1
+            self.agent_counts[m, fwd[moves, 0], fwd[moves, 1]] += 1
+            self.agent_pos[m, agents[moves]] = fwd[moves]
+            self.agent_arrivals[m, agents[moves]] = self.step_count[m] * self.n_agents + k
+
+            collects = moves & (fwd_kinds == BONUS)
+            self.kinds[worlds[collects], fwd[collects, 0], fwd[collects, 1]] = BONUS_USED
+            rewards[collects] += BONUS_REWARD * reward_scale[collects]
+
+        dones = self.step_count >= self.max_steps
+        self._gen_obs(worlds)
+        infos = [{} for _ in range(self.batch_size)]
+        self._rewards = rewards
+        return self._obs, rewards, dones, infos
+
+    def render(self, mode='rgb_array', **kwargs):
+        '''Returns a full view of the first world, one pixel per cell.'''
+        colors = self._kind_colors[self.kinds[0]]
+        first_agents = self._first_agents(np.array([0]))[0]
+        i, j = np.nonzero(first_agents >= 0)
+        agents = first_agents[i, j]
+        colors[i, j] = self._agent_colors[self.kinds[0, i, j], agents, self.agent_dirs[0, agents]]
+        return np.swapaxes(colors, 0, 1)
+
+    def close(self):
+        pass
@@ -0,0 +1,145 @@
+import unittest
+
+import numpy as np
+
+from ..agents import GridAgentInterface
+from ..objects import BonusTile, Wall
+from .collector import CollectorMultiGrid
+from .vector_collector import (
+    AGENT_COLORS, BONUS, BONUS_USED, EMPTY, WALL, VectorCollectorMultiGrid,
+)
+
+N_AGENTS = 3
+GRID_SIZE = 15
+
+
+def make_envs(observation_style, fixed_players, ghost_mode, max_steps=100, seed=3):
+    '''A CollectorMultiGrid and a single-world VectorCollectorMultiGrid with the same config.'''
+    env = CollectorMultiGrid(
+        agents=[
+            GridAgentInterface(color=c, view_size=7, view_tile_size=1, observation_style=observation_style)
+            for c in AGENT_COLORS[:N_AGENTS]
+        ],
+        grid_size=GRID_SIZE,
+        clutter_density=0.15,
+        n_random_bonuses=6,
+        fixed_players=fixed_players,
+        ghost_mode=ghost_mode,
+        max_steps=max_steps,
+        seed=seed,
+    )
+    vec = VectorCollectorMultiGrid(
+        1,
+        n_agents=N_AGENTS,
+        grid_size=GRID_SIZE,
+        clutter_density=0.15,
+        fixed_players=fixed_players,
+        ghost_mode=ghost_mode,
+        max_steps=max_steps,
+        observation_style=observation_style,
+        seed=seed,
+    )
+    vec.reset()
+    return env, vec
+
+
+def copy_state(env, vec):
+    '''Copies the world of a freshly reset CollectorMultiGrid into the world of vec.'''
+    vec.kinds[0] = EMPTY
+    vec.bonus_ids[0] = 0
+    vec.agent_counts[0] = 0
+    for i in range(env.width):
+        for j in range(env.height):
+            obj = env.grid.get(i, j)
+            if isinstance(obj, Wall):
+                vec.kinds[0, i, j] = WALL
+            elif isinstance(obj, BonusTile):
+                vec.kinds[0, i, j] = BONUS if obj.active else BONUS_USED
+                vec.bonus_ids[0, i, j] = obj.bonus_id
+    for a, agent in enumerate(env.agents):
+        vec.agent_pos[0, a] = agent.pos
+        vec.agent_dirs[0, a] = agent.dir
+        vec.agent_counts[0, agent.pos[0], agent.pos[1]] += 1
+    # At reset, agents are stacked in their order.
+    vec.agent_arrivals[0] = np.arange(N_AGENTS) - N_AGENTS
+    vec.step_count[0] = env.step_count
+    vec._gen_obs(np.array([0]))
+
+
+def random_actions(rng):
+    '''
+    Random actions where at most one agent moves, so that the results don't depend
+        on the order in which the engines iterate over the agents.
+    '''
+    mover = rng.randint(N_AGENTS)
+    actions = np.where(np.arange(N_AGENTS) == mover, rng.randint(0, 3, size=N_AGENTS), rng.randint(0, 2, size=N_AGENTS))
+    # Actions without effect in collector worlds.
+    if rng.rand() < 0.1:
+        actions[rng.randint(N_AGENTS)] = rng.randint(3, 7)
+    return actions
+
+
+class VectorCollectorMultiGridTest(unittest.TestCase):
+    def assert_same_step(self, env, vec, actions):
+        obs, rewards, done, _ = env.step(list(actions))
+        vec_obs, vec_rewards, vec_dones, _ = vec.step(np.asarray(actions)[None])
+        np.testing.assert_array_equal(np.stack(obs), vec_obs[0])
+        self.assertAlmostEqual(float(np.sum(rewards)), float(vec_rewards[0]), places=5)
+        np.testing.assert_array_equal(vec_rewards, vec.raw_rewards)
+        self.assertEqual(done, vec_dones[0])
+        return float(np.sum(rewards)), done
+
+    def check_random_episodes(self, observation_style, fixed_players, ghost_mode):
+        env, vec = make_envs(observation_style, fixed_players, ghost_mode, max_steps=60)
+        rng = np.random.RandomState(1)
+        for _ in range(2):
+            env.reset()
+            # Collector worlds reuse their bonus tiles, which must be active again.
+            self.assertTrue(all(bonus.active for bonus in env.bonus_pool))
+            copy_state(env, vec)
+            np.testing.assert_array_equal(np.stack(env.gen_obs()), vec._obs[0])
+            done = False
+            while not done:
+                _, done = self.assert_same_step(env, vec, random_actions(rng))
+
+    def test_symbolic(self):
+        for fixed_players in (False, True):
+            for ghost_mode in (False, True):
+                with self.subTest(fixed_players=fixed_players, ghost_mode=ghost_mode):
+                    self.check_random_episodes('symbolic', fixed_players, ghost_mode)
+
+    def test_image(self):
+        for fixed_players in (False, True):
+            for ghost_mode in (False, True):
+                with self.subTest(fixed_players=fixed_players, ghost_mode=ghost_mode):
+                    self.check_random_episodes('image', fixed_players, ghost_mode)
+
+    def test_bonus_reuse(self):
+        for observation_style in ('symbolic', 'image'):
+            with self.subTest(observation_style=observation_style):
+                env, vec = make_envs(observation_style, fixed_players=True, ghost_mode=True)
+                env.reset()
+                copy_state(env, vec)
+                # With fixed players, the middle agent starts right below the center bonus.
+                agent = N_AGENTS // 2
+                center = (GRID_SIZE // 2, GRID_SIZE // 2)
+                self.assertEqual(tuple(env.agents[agent].pos), (center[0], center[1] + 1))
+
+                def act(action):
+                    actions = np.full(N_AGENTS, GridAgentInterface.actions.done)
+                    actions[agent] = action
+                    return self.assert_same_step(env, vec, actions)[0]
+
+                # Face up, then collect the bonus.
+                while env.agents[agent].dir != 3:
+                    act(GridAgentInterface.actions.left)
+                self.assertGreater(act(GridAgentInterface.actions.forward), 0)
+                self.assertFalse(env.grid.get(*center).active)
+                # Step off the tile and back onto it: used tiles give no reward.
+                for action in ('left', 'left', 'forward', 'left', 'left', 'forward'):
+                    self.assertEqual(act(GridAgentInterface.actions[action]), 0)
+                self.assertEqual(tuple(env.agents[agent].pos), center)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -163,6 +163,9 @@ class BulkObj(WorldObj, metaclass=RegisteredObjectType):
         return hash(self) == hash(other)
 
 class BonusTile(WorldObj):
+    # Added to the state (the bonus_id) in the encoding of collected tiles.
+    USED_STATE = 128
+
     def __init__(self, reward, penalty=-0.1, bonus_id=0, n_bonus=1, initial_reward=True, reset_on_mistake=False,  color='yellow', *args, **kwargs):
         super().__init__(*args, **{'color': color, **kwargs, 'state': bonus_id})
         self.reward = reward
@@ -179,6 +182,10 @@ class BonusTile(WorldObj):
     def str_render(self, dir=0):
         return "BB"
 
+    def encode(self, str_class=False):
+        enc_class, enc_color, state = super().encode(str_class=str_class)
+        return (enc_class, enc_color, state if self.active else state + self.USED_STATE)
+
     def get_reward(self, agent):
         # If the agent hasn't hit any bonus tiles, set its bonus state so that
         #  it'll get a reward from hitting this tile.
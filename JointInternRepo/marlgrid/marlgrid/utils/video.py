@@ -1,6 +1,15 @@
+import atexit
+import glob
 import gym
 import numpy as np
 import os
+import pickle
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import tqdm
 
 
@@ -52,7 +61,212 @@ def render_frames(X, path, ext="png"):
     for k, frame in tqdm.tqdm(enumerate(X), total=len(X)):
         Image.fromarray(frame, "RGB").save(os.path.join(path, f"frame_{k}.{ext}"))
 
+
+def supports_state_recording(env):
+    '''
+    Whether episodes of the (unwrapped) env can be recorded as compact per-step
+        states rather than as rendered frames.
+    '''
+    return hasattr(env, 'agents') and hasattr(getattr(env, 'grid', None), 'obj_reg')
+
+
+def snapshot_env(env):
+    '''Pickles a MultiGridEnv, the base that recorded states are applied to.'''
+    window, env.window = getattr(env, 'window', None), None
+    try:
+        return pickle.dumps(env)
+    finally:
+        env.window = window
+
+
+def capture_state(env):
+    '''
+    Returns the compact state of a MultiGridEnv: the grid keys, the (state, active)
+        of every registered object and the (x, y, dir, active, host key) of every
+        agent, the host being the object the agent is stacked on (-1 if the agent is
+        itself in the grid).
+    '''
+    grid = env.grid
+    reg = grid.obj_reg
+    objects = np.full((reg.next_key, 2), -1, dtype=np.int16)
+    for key, obj in reg.key_to_obj_map.items():
+        if obj is not None:
+            objects[key] = (obj.state, getattr(obj, 'active', True))
+    agents = np.full((len(env.agents), 5), -1, dtype=np.int16)
+    for k, agent in enumerate(env.agents):
+        agents[k, 3] = agent.active
+        if agent.pos is not None:
+            x, y = agent.pos
+            cell = grid.grid[x, y]
+            host = -1 if reg.key_to_obj_map[cell] is agent else cell
+            agents[k] = (x, y, agent.dir, agent.active, host)
+    return grid.grid.copy(), objects, agents
+
+
+def restore_state(env, keys, objects, agents):
+    '''Applies a state returned by capture_state to a snapshot of the env.'''
+    reg = env.grid.obj_reg
+    np.copyto(env.grid.grid, keys)
+    for agent in env.agents:
+        agent.agents = []
+    for key, (state, active) in enumerate(objects):
+        obj = reg.key_to_obj_map.get(key)
+        if obj is None or state < 0:
+            continue
+        obj.state = int(state)
+        obj.agents = []
+        if hasattr(obj, 'active'):
+            obj.active = bool(active)
+            # The encoding of bonus tiles depends on whether they are active.
+            reg.update_object(obj)
+    for agent, (x, y, dir, active, host) in zip(env.agents, agents):
+        agent.active = bool(active)
+        if x < 0:
+            agent.pos = None
+            continue
+        agent.pos = (int(x), int(y))
+        # Agents' directions are part of their state, which is already restored.
+        if agent.dir != dir:
+            agent.dir = int(dir)
+        if host >= 0:
+            reg.key_to_obj_map[host].agents.append(agent)
+
+
+def render_recording(path):
+    '''
+    Yields the frames of an episode recorded by GridRecorder, rendering them from
+        the recorded states if needed.
+    '''
+    with open(os.path.join(path, 'header.pkl'), 'rb') as f:
+        header = pickle.load(f)
+    env = pickle.loads(header['env']) if header['env'] is not None else None
+    for chunk_file in sorted(glob.glob(os.path.join(path, 'chunk_*.npz'))):
+        chunk = np.load(chunk_file)
+        if 'frames' in chunk:
+            yield from chunk['frames']
+            continue
+        new_objects = pickle.loads(chunk['new_objects'].tobytes())
+        for t in range(len(chunk['keys'])):
+            for key, agent_no, obj in new_objects.get(t, []):
+                obj = env.agents[agent_no] if agent_no >= 0 else obj
+                env.grid.obj_reg.key_to_obj_map[key] = obj
+            restore_state(env, chunk['keys'][t], chunk['objects'][t][:chunk['n_keys'][t]], chunk['agents'][t])
+            yield env.render(mode='rgb_array', **header['render_kwargs'])
+
+
+def _publish(src, dst):
+    '''
+    Moves a finished export (file or directory) to dst through a hidden temporary
+        name next to it, so that dst never holds a partial export.
+    '''
+    dst_dir = os.path.dirname(dst)
+    os.makedirs(dst_dir, exist_ok=True)
+    tmp = os.path.join(dst_dir, f'.{os.path.basename(dst)}.tmp')
+    shutil.move(src, tmp)
+    os.replace(tmp, dst)
+
+
+def export_recording(path, outputs, cleanup=True):
+    '''
+    Renders a recorded episode to the requested outputs, ('video', outfile,
+        video_kwargs) or ('frames', path), then deletes the recording. Outputs
+        are rendered in the recording directory and only then moved into place.
+    '''
+    frames = np.stack(list(render_recording(path)))
+    for k, output in enumerate(outputs):
+        if output[0] == 'video':
+            # moviepy picks the codec from the extension.
+            tmp = os.path.join(path, f'export_{k}{os.path.splitext(output[1])[1]}')
+            export_video(frames, tmp, **output[2])
+            _publish(tmp, output[1])
+        else:
+            tmp = os.path.join(path, f'export_{k}')
+            render_frames(frames, tmp)
+            # Like render_frames, frames go to a directory without extension.
+            dst = output[1]
+            if '.' in os.path.basename(dst):
+                dst = os.path.splitext(dst)[0]
+            _publish(tmp, dst)
+    if cleanup:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class _BackgroundWriter:
+    '''
+    Runs the disk writes of a GridRecorder in order, in a background thread, and
+        launches the rendering of finished recordings in separate processes.
+    '''
+    def __init__(self):
+        self.tasks = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                return
+            fn, args = task
+            fn(*args)
+
+    def submit(self, fn, *args):
+        self.tasks.put((fn, args))
+
+    def close(self):
+        self.tasks.put(None)
+        self.thread.join()
+
+
+def _write_header(path, header):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, 'header.pkl'), 'wb') as f:
+        pickle.dump(header, f)
+
+
+def _write_chunk(path, index, steps, new_objects):
+    if len(steps[0]) == 1:
+        arrays = {'frames': np.stack([frame for frame, in steps])}
+    else:
+        keys, objects, agents = zip(*steps)
+        n_keys = np.array([len(o) for o in objects])
+        # Objects registered mid-episode make the rows ragged.
+        padded = np.full((len(objects), n_keys.max(), 2), -1, dtype=np.int16)
+        for t, o in enumerate(objects):
+            padded[t, :len(o)] = o
+        arrays = {
+            'keys': np.stack(keys),
+            'objects': padded,
+            'n_keys': n_keys,
+            'agents': np.stack(agents),
+            'new_objects': np.frombuffer(pickle.dumps(new_objects), dtype=np.uint8),
+        }
+    np.savez_compressed(os.path.join(path, f'chunk_{index:05d}.npz'), **arrays)
+
+
+def _start_export(path, outputs):
+    # Rendering is CPU heavy and not needed by the environment, so it is left to
+    #  another process. It is a fresh interpreter, as forking the (threaded)
+    #  parent isn't safe and spawning re-runs the parent's main script.
+    with open(os.path.join(path, 'outputs.pkl'), 'wb') as f:
+        pickle.dump(outputs, f)
+    subprocess.Popen(
+        [sys.executable, '-m', 'marlgrid.utils.video', path],
+        env={**os.environ, 'PYTHONPATH': os.pathsep.join(sys.path)})
+
+
 class GridRecorder(gym.core.Wrapper):
+    '''
+    Records episodes and exports them as videos and/or frames.
+
+    Marlgrid episodes are streamed to a temporary directory (outside of save_root)
+        as compact per-step states (grid keys, object states and agent poses) in
+        compressed chunks of `chunk_size` steps, written by a background thread.
+        Frames are only rendered, from a snapshot of the environment, in a
+        separate process once the episode ends, so recording adds little to the
+        environment step and its memory use doesn't grow with the episode length.
+        Other environments are recorded as rendered frames, streamed the same
+        way. Exports only appear in save_root once complete.
+    '''
     default_max_len = 1000
     default_video_kwargs = {
         'fps': 20,
@@ -67,11 +281,11 @@ class GridRecorder(gym.core.Wrapper):
             auto_save_videos=True,
             auto_save_interval=None,
             render_kwargs={},
-            video_kwargs={}
+            video_kwargs={},
+            chunk_size=100,
             ):
         super().__init__(env)
 
-        self.frames = None
         self.ptr = 0
         self.reset_count = 0
         self.last_save = -10000
@@ -83,6 +297,10 @@ class GridRecorder(gym.core.Wrapper):
         self.render_kwargs = render_kwargs
         self.video_kwargs = {**self.default_video_kwargs, **video_kwargs}
         self.n_parallel = getattr(env, 'num_envs', 1)
+        self.chunk_size = chunk_size
+        # Recordings are kept out of save_root, which may be synced while
+        #  they are written.
+        self.recordings_root = tempfile.mkdtemp(prefix='marlgrid_recordings_')
 
         if max_steps is None:
             if hasattr(env, "max_steps") and env.max_steps != 0:
@@ -91,7 +309,19 @@ class GridRecorder(gym.core.Wrapper):
                 self.max_steps = self.default_max_steps + 1
         else:
             self.max_steps = max_steps + 1
-    
+
+        self.writer = _BackgroundWriter()
+        self.recording_count = 0
+        self.recording_path = None
+        self.pending_steps = []
+        self.pending_objects = {}
+        self.chunk_count = 0
+        self.known_keys = 0
+        self.outputs = []
+        # Exports requested mid-episode are otherwise lost if the env is never
+        #  reset or closed again.
+        atexit.register(self.finish_recordings)
+
     @staticmethod
     def fix_path(path):
         return os.path.abspath(os.path.expanduser(path))
@@ -104,19 +334,20 @@ class GridRecorder(gym.core.Wrapper):
             return False
         return (self.reset_count - self.last_save) >= self.auto_save_interval
 
+    # Exports are done once the episode ends, on reset or close.
     def export_frames(self,  episode_id=None, save_root=None):
         if save_root is None:
             save_root = self.save_root
         if episode_id is None:
             episode_id = f'frames_{self.reset_count}'
-        render_frames(self.frames[:self.ptr], os.path.join(self.fix_path(save_root), episode_id))
+        self.outputs.append(('frames', os.path.join(self.fix_path(save_root), episode_id)))
 
     def export_video(self, episode_id=None, save_root=None):
         if save_root is None:
             save_root = self.save_root
         if episode_id is None:
             episode_id = f'video_{self.reset_count}.mp4'
-        export_video(self.frames[:self.ptr],  os.path.join(self.fix_path(save_root), episode_id), **self.video_kwargs)
+        self.outputs.append(('video', os.path.join(self.fix_path(save_root), episode_id), self.video_kwargs))
 
     def export_both(self, episode_id, save_root=None):
         self.export_frames(f'{episode_id}_frames', save_root=save_root)
@@ -130,49 +361,87 @@ class GridRecorder(gym.core.Wrapper):
             if self.auto_save_videos:
                 self.export_video()
             self.last_save = self.reset_count
-        del self.frames
-        self.frames = None
-        self.ptr = 0
+        self.finish_recording()
         self.reset_count += self.n_parallel
         return self.env.reset(**kwargs)
 
+    def start_recording(self):
+        base = self.env.unwrapped
+        self.recording_path = os.path.join(self.recordings_root, str(self.recording_count))
+        self.recording_count += 1
+        if self.writer is None:
+            self.writer = _BackgroundWriter()
+        header = {'render_kwargs': self.render_kwargs, 'env': None}
+        if supports_state_recording(base):
+            header['env'] = snapshot_env(base)
+            self.known_keys = base.grid.obj_reg.next_key
+        self.writer.submit(_write_header, self.recording_path, header)
+
+    def flush_chunk(self):
+        if self.pending_steps:
+            self.writer.submit(_write_chunk, self.recording_path, self.chunk_count, self.pending_steps, self.pending_objects)
+            self.chunk_count += 1
+            self.pending_steps = []
+            self.pending_objects = {}
+
+    def finish_recording(self):
+        '''Ends the current recording, exporting it if any export was requested.'''
+        if self.recording_path is None:
+            self.outputs = []
+            return
+        self.flush_chunk()
+        if self.outputs:
+            self.writer.submit(_start_export, self.recording_path, self.outputs)
+        else:
+            self.writer.submit(shutil.rmtree, self.recording_path, True)
+        self.recording_path = None
+        self.chunk_count = 0
+        self.outputs = []
+        self.ptr = 0
+
     def append_current_frame(self):
         if self.should_record:
-            new_frame = self.env.render(mode="rgb_array", **self.render_kwargs)
-            if isinstance(new_frame, list) or len(new_frame.shape)>3:
-                new_frame = new_frame[0]
-            if self.frames is None:
-                self.frames = np.zeros(
-                    (self.max_steps, *new_frame.shape), dtype=new_frame.dtype
-                )
-            self.frames[self.ptr] = new_frame
+            if self.recording_path is None:
+                self.start_recording()
+            base = self.env.unwrapped
+            if supports_state_recording(base):
+                reg = base.grid.obj_reg
+                # Objects registered during the episode aren't in the snapshot.
+                new_objects = []
+                for key in range(self.known_keys, reg.next_key):
+                    obj = reg.key_to_obj_map.get(key)
+                    agent_no = next((k for k, agent in enumerate(base.agents) if agent is obj), -1)
+                    new_objects.append((key, agent_no, obj if agent_no < 0 else None))
+                if new_objects:
+                    self.pending_objects[len(self.pending_steps)] = new_objects
+                self.known_keys = reg.next_key
+                self.pending_steps.append(capture_state(base))
+            else:
+                new_frame = self.env.render(mode="rgb_array", **self.render_kwargs)
+                if isinstance(new_frame, list) or len(new_frame.shape)>3:
+                    new_frame = new_frame[0]
+                self.pending_steps.append((new_frame,))
             self.ptr += 1
+            if len(self.pending_steps) >= self.chunk_size:
+                self.flush_chunk()
 
     def step(self, action):
         self.append_current_frame()
         obs, rew, done, info = self.env.step(action)
         return obs, rew, done, info
 
-    # def export_video(
-    #     self,
-    #     output_path,
-    #     fps=20,
-    #     rescale_factor=1,
-    #     render_last=True,
-    #     render_frame_images=True,
-    #     **kwargs,
-    # ):
-    #     if self.should_record:
-    #         if render_last:
-    #             self.frames[self.ptr] = self.env.render(
-    #                 mode="rgb_array", **self.render_kwargs
-    #             )
-    #         if render_frame_images:
-    #             render_frames(self.frames[: self.ptr + 1], output_path)
-    #         return export_video(
-    #             self.frames[: self.ptr + 1],
-    #             output_path,
-    #             fps=fps,
-    #             rescale_factor=rescale_factor,
-    #             **kwargs,
-    #         )
+    def finish_recordings(self):
+        '''Ends the current recording and waits for all its writes.'''
+        if self.writer is not None:
+            self.finish_recording()
+            self.writer.close()
+            self.writer = None
+
+    def close(self):
+        self.finish_recordings()
+        return self.env.close()
+
+
+if __name__ == '__main__':
+    with open(os.path.join(sys.argv[1], 'outputs.pkl'), 'rb') as f:
+        export_recording(sys.argv[1], pickle.load(f))
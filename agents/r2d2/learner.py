@@ -66,6 +66,10 @@ flags.DEFINE_integer('replay_buffer_min_size', 10,
 flags.DEFINE_float('priority_exponent', 0.9,
                    'Priority exponent used when sampling in the replay buffer. '
                    '0.9 comes from R2D2 paper, table 2.')
+flags.DEFINE_bool('sum_tree_replay', False,
+                  'Whether the replay buffer samples with a sum tree, in '
+                  'O(log replay_buffer_size) per item, instead of computing '
+                  'the probabilities of all the items for every batch.')
 flags.DEFINE_integer('unroll_queue_max_size', 100,
                      'Max size of the unroll queue')
 flags.DEFINE_integer('burn_in', 40,
@@ -690,9 +694,14 @@ def learner_loop(create_env_fn, create_agent_fn, create_optimizer_fn):
       info_specs + (tf.TensorSpec([], tf.int32, 'env_ids'),)))
   info_queue = utils.StructuredFIFOQueue(-1, episode_info_specs)
 
-  replay_buffer = utils.PrioritizedReplay(FLAGS.replay_buffer_size,
-                                          unroll_specs,
-                                          FLAGS.importance_sampling_exponent)
+  if FLAGS.sum_tree_replay:
+    replay_buffer = utils.SumTreePrioritizedReplay(
+        FLAGS.replay_buffer_size, unroll_specs,
+        FLAGS.importance_sampling_exponent, FLAGS.priority_exponent)
+  else:
+    replay_buffer = utils.PrioritizedReplay(FLAGS.replay_buffer_size,
+                                            unroll_specs,
+                                            FLAGS.importance_sampling_exponent)
 
   def add_batch_size(ts):
     return tf.TensorSpec([FLAGS.inference_batch_size] + list(ts.shape),
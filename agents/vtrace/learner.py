@@ -27,6 +27,7 @@ from seed_rl import grpc
 from seed_rl.common import common_flags
 from seed_rl.common import utils
 from seed_rl.common import vtrace
+from seed_rl.common import wire_encoding
 from seed_rl.common.parametric_distribution import get_parametric_distribution_for_action_space
 
 import tensorflow as tf
@@ -42,7 +43,40 @@ flags.DEFINE_integer('total_environment_frames', int(1e9),
 flags.DEFINE_integer('batch_size', 32, 'Batch size for training.')
 flags.DEFINE_integer('inference_batch_size', -1,
                      'Batch size for inference, -1 for auto-tune.')
+flags.DEFINE_float('inference_batch_timeout_ms', 0.,
+                   'Maximal time in milliseconds an inference batch waits for '
+                   'more environments before running partially filled. 0 '
+                   'waits for full batches.')
 flags.DEFINE_integer('unroll_length', 100, 'Unroll length in agent steps.')
+flags.DEFINE_integer('unroll_queue_capacity', 1,
+                     'Number of completed unrolls buffered per host between '
+                     'inference and training. Inference calls completing '
+                     'unrolls block while the queue is full.')
+flags.DEFINE_integer('max_policy_lag', None,
+                     'If set, maximal number of training steps between the '
+                     'policy that started an unroll and the policy trained on '
+                     'it. Older unrolls are handled according to '
+                     '--stale_unroll_mode.')
+flags.DEFINE_enum('stale_unroll_mode', 'drop', ['drop', 'downweight'],
+                  'With drop, unrolls exceeding --max_policy_lag are '
+                  'discarded when completed and masked out of the loss, '
+                  'which is averaged over the remaining unrolls. With '
+                  'downweight, their losses are scaled by '
+                  'max_policy_lag / lag.')
+flags.DEFINE_integer('batch_prefetch', 1,
+                     'Number of training batches assembled ahead of the '
+                     'training step.')
+flags.DEFINE_enum('inference_state_placement', 'host',
+                  ['host', 'inference_device'],
+                  'Where the per-environment agent states, actions and '
+                  'unrolls are kept. With inference_device, they stay next to '
+                  'the agent on the (GPU) inference device, and inference '
+                  'calls only move observations in and actions and completed '
+                  'unrolls out. Falls back to host without GPU inference '
+                  'devices.')
+flags.DEFINE_bool('measure_inference_transfers', False,
+                  'Whether to log the bytes of the tensors moved between the '
+                  'host and the inference device per inference call.')
 flags.DEFINE_integer('num_training_tpus', 1, 'Number of TPUs for training.')
 flags.DEFINE_string('init_checkpoint', None,
                     'Path to the checkpoint used to initialize the agent.')
@@ -70,8 +104,39 @@ flags.DEFINE_integer('log_episode_frequency', 1, 'We average that many episodes'
 FLAGS = flags.FLAGS
 
 
+def policy_lag_weights(policy_lag):
+  """Returns the loss weights of unrolls with the given policy lags.
+
+  None (no weighting) if the policy lag isn't bounded.
+  """
+  if FLAGS.max_policy_lag is None:
+    return None
+  is_stale = policy_lag > FLAGS.max_policy_lag
+  if FLAGS.stale_unroll_mode == 'drop':
+    return 1. - tf.cast(is_stale, tf.float32)
+  return tf.where(is_stale,
+                  FLAGS.max_policy_lag / tf.cast(tf.maximum(policy_lag, 1),
+                                                 tf.float32),
+                  1.)
+
+
+def _weighted_mean(x, weights):
+  """Mean of a [T, B, ...] tensor, with [B] per-unroll weights (or None)."""
+  if weights is None:
+    return tf.reduce_mean(x)
+  # Unrolls are along the second axis, e.g. [T, B, agents] without
+  # centralization.
+  weights = tf.broadcast_to(
+      tf.reshape(weights, [1, -1] + [1] * (x.shape.rank - 2)), tf.shape(x))
+  if FLAGS.stale_unroll_mode == 'drop':
+    # Dropped unrolls don't count, rather than diluting the mean.
+    return tf.math.divide_no_nan(tf.reduce_sum(x * weights),
+                                 tf.reduce_sum(weights))
+  return tf.reduce_mean(x * weights)
+
+
 def compute_loss(logger, parametric_action_distribution, agent, agent_state,
-                 prev_actions, env_outputs, agent_outputs):
+                 prev_actions, env_outputs, agent_outputs, weights=None):
   # Networks expect postprocessed prev_actions but it's done during inference.
   # agent((prev_actions[t], env_outputs[t]), agent_state)
   #   -> agent_outputs[t], agent_state'
@@ -115,13 +180,16 @@ def compute_loss(logger, parametric_action_distribution, agent, agent_state,
       lambda_=FLAGS.lambda_,
       logger=(logger, session))
 
-  # Policy loss based on Policy Gradients
-  policy_loss = -tf.reduce_mean(target_action_log_probs *
-                                tf.stop_gradient(vtrace_returns.pg_advantages))
+  # Policy loss based on Policy Gradients, the losses on the behaviour data
+  # are weighted per unroll.
+  policy_loss = -_weighted_mean(
+      target_action_log_probs *
+      tf.stop_gradient(vtrace_returns.pg_advantages), weights)
 
   # Value function loss
   v_error = vtrace_returns.vs - learner_outputs.baseline
-  v_loss = FLAGS.baseline_cost * 0.5 * tf.reduce_mean(tf.square(v_error))
+  v_loss = FLAGS.baseline_cost * 0.5 * _weighted_mean(
+      tf.square(v_error), weights)
 
   # Entropy reward
   entropy = tf.reduce_mean(
@@ -130,7 +198,7 @@ def compute_loss(logger, parametric_action_distribution, agent, agent_state,
 
   # KL(old_policy|new_policy) loss
   kl = behaviour_action_log_probs - target_action_log_probs
-  kl_loss = FLAGS.kl_cost * tf.reduce_mean(kl)
+  kl_loss = FLAGS.kl_cost * _weighted_mean(kl, weights)
 
   # Entropy cost adjustment (Langrange multiplier style)
   if FLAGS.target_entropy:
@@ -160,7 +228,8 @@ def compute_loss(logger, parametric_action_distribution, agent, agent_state,
   logger.log(session, 'policy/max_action_abs(before_tanh)',
              tf.reduce_max(tf.abs(agent_outputs.action)))
   logger.log(session, 'policy/max_input_abs',
-             tf.reduce_max(tf.abs(frame)))
+             tf.reduce_max([tf.reduce_max(tf.abs(tf.cast(f, tf.float32)))
+                            for f in tf.nest.flatten(frame)]))
   logger.log(session, 'policy/entropy', entropy)
   logger.log(session, 'policy/entropy_cost', agent.entropy_cost())
   logger.log(session, 'policy/kl(old|new)', tf.reduce_mean(kl))
@@ -168,8 +237,11 @@ def compute_loss(logger, parametric_action_distribution, agent, agent_state,
   return total_loss, session
 
 
+# policy_version is the training iteration of the policy that started the
+# unroll.
 Unroll = collections.namedtuple(
-    'Unroll', 'agent_state prev_actions env_outputs agent_outputs')
+    'Unroll',
+    'agent_state prev_actions env_outputs agent_outputs policy_version')
 
 
 def validate_config():
@@ -206,8 +278,9 @@ def learner_loop(create_env_fn, create_agent_fn, create_optimizer_fn):
   env_output_specs = utils.EnvOutput(
       tf.TensorSpec([], tf.float32, 'reward'),
       tf.TensorSpec([], tf.bool, 'done'),
-      tf.TensorSpec(env.observation_space.shape, env.observation_space.dtype,
-                    'observation'),
+      tf.nest.map_structure(
+          lambda s: tf.TensorSpec(s.shape, s.dtype, 'observation'),
+          env.observation_space.__dict__.get('spaces', env.observation_space)),
       tf.TensorSpec([], tf.bool, 'abandoned'),
       tf.TensorSpec([], tf.int32, 'episode_step'),
   )
@@ -267,11 +340,17 @@ def learner_loop(create_env_fn, create_agent_fn, create_optimizer_fn):
   def minimize(iterator):
     data = next(iterator)
 
-    def compute_gradients(args):
+    def compute_gradients(args, iteration):
       args = tf.nest.pack_sequence_as(unroll_specs[0], decode(args, data))
+      policy_lag = iteration - args.policy_version
       with tf.GradientTape() as tape:
         loss, logs = compute_loss(logger, parametric_action_distribution, agent,
-                                  *args)
+                                  *args[:-1],
+                                  weights=policy_lag_weights(policy_lag))
+      policy_lag = tf.cast(policy_lag, tf.float32)
+      logger.log(logs, 'unroll_queue/policy_lag', tf.reduce_mean(policy_lag))
+      logger.log(logs, 'unroll_queue/max_policy_lag',
+                 tf.reduce_max(policy_lag))
       grads = tape.gradient(loss, agent.trainable_variables)
       norms = []
       for t, g in zip(temp_grads, grads):
@@ -281,7 +360,8 @@ def learner_loop(create_env_fn, create_agent_fn, create_optimizer_fn):
       logger.log(logs, 'gradient norm', tf.reduce_max(norms))
       return loss, logs
 
-    loss, logs = training_strategy.run(compute_gradients, (data,))
+    loss, logs = training_strategy.run(
+        compute_gradients, (data, tf.cast(iterations, tf.int32)))
     loss = training_strategy.experimental_local_results(loss)[0]
 
     def apply_gradients(_):
@@ -328,44 +408,77 @@ def learner_loop(create_env_fn, create_agent_fn, create_optimizer_fn):
 
   info_queue = utils.StructuredFIFOQueue(-1, info_specs)
 
+  # Bytes moved from host to inference device, back, and number of inference
+  # calls, since the last log.
+  transfer_stats = tf.Variable(tf.zeros([3], tf.int64), trainable=False,
+                               name='inference_transfer_stats')
+  # Unrolls dropped for exceeding the maximal policy lag since the last log.
+  dropped_unrolls = tf.Variable(0, dtype=tf.int64, trainable=False,
+                                name='dropped_unrolls')
+
+  policy_version_specs = tf.TensorSpec([], tf.int32, 'policy_version')
+
   def create_host(i, host, inference_devices):
+    state_device = host
+    if FLAGS.inference_state_placement == 'inference_device':
+      if tf.DeviceSpec.from_string(inference_devices[0]).device_type == 'GPU':
+        state_device = inference_devices[0]
+      else:
+        logging.info('No GPU inference device on %s, keeping the inference '
+                     'state on the host.', host)
+    state_on_device = state_device != host
     with tf.device(host):
       server = grpc.Server([FLAGS.server_address])
 
-      store = utils.UnrollStore(
-          FLAGS.num_envs, FLAGS.unroll_length,
-          (action_specs, env_output_specs, agent_output_specs))
       env_run_ids = utils.Aggregator(FLAGS.num_envs,
                                      tf.TensorSpec([], tf.int64, 'run_ids'))
       env_infos = utils.Aggregator(FLAGS.num_envs, info_specs,
                                    'env_infos')
 
-      # First agent state in an unroll.
-      first_agent_states = utils.Aggregator(
-          FLAGS.num_envs, agent_state_specs, 'first_agent_states')
+      with tf.device(state_device):
+        store = utils.UnrollStore(
+            FLAGS.num_envs, FLAGS.unroll_length,
+            (action_specs, env_output_specs, agent_output_specs))
 
-      # Current agent state and action.
-      agent_states = utils.Aggregator(
-          FLAGS.num_envs, agent_state_specs, 'agent_states')
-      actions = utils.Aggregator(FLAGS.num_envs, action_specs, 'actions')
+        # First agent state in an unroll.
+        first_agent_states = utils.Aggregator(
+            FLAGS.num_envs, agent_state_specs, 'first_agent_states')
+        first_policy_versions = utils.Aggregator(
+            FLAGS.num_envs, policy_version_specs, 'first_policy_versions')
 
-      unroll_specs[0] = Unroll(agent_state_specs, *store.unroll_specs)
-      unroll_queue = utils.StructuredFIFOQueue(1, unroll_specs[0])
+        # Current action and agent state, read and replaced together.
+        agent_memory = utils.Aggregator(
+            FLAGS.num_envs, (action_specs, agent_state_specs), 'agent_memory')
+
+      unroll_specs[0] = Unroll(agent_state_specs, *store.unroll_specs,
+                               policy_version_specs)
+      unroll_queue = utils.StructuredFIFOQueue(FLAGS.unroll_queue_capacity,
+                                               unroll_specs[0])
 
       def add_batch_size(ts):
         return tf.TensorSpec([FLAGS.inference_batch_size] + list(ts.shape),
                              ts.dtype, ts.name)
 
+      # Observations are decoded from their wire encoding at the beginning of
+      # inference.
+      observation_decoder = wire_encoding.ObservationDecoder(
+          FLAGS.num_envs, env_output_specs.observation,
+          FLAGS.observation_encoding, FLAGS.observation_delta_encoding)
       inference_specs = (
           tf.TensorSpec([], tf.int32, 'env_id'),
           tf.TensorSpec([], tf.int64, 'run_id'),
-          env_output_specs,
+          env_output_specs._replace(observation=wire_encoding.encoded_specs(
+              env_output_specs.observation, FLAGS.observation_encoding,
+              FLAGS.observation_delta_encoding)),
           tf.TensorSpec([], tf.float32, 'raw_reward'),
       )
       inference_specs = tf.nest.map_structure(add_batch_size, inference_specs)
       def create_inference_fn(inference_device):
         @tf.function(input_signature=inference_specs)
         def inference(env_ids, run_ids, env_outputs, raw_rewards):
+          env_outputs = env_outputs._replace(observation=observation_decoder(
+              env_ids, env_outputs.observation))
+          policy_version = tf.cast(iterations, tf.int32)
           # Reset the environments that had their first run or crashed.
           previous_run_ids = env_run_ids.read(env_ids)
           env_run_ids.replace(env_ids, run_ids)
@@ -376,11 +489,15 @@ def learner_loop(create_env_fn, create_agent_fn, create_optimizer_fn):
             tf.print('Environment ids needing reset:', envs_needing_reset)
           env_infos.reset(envs_needing_reset)
           store.reset(envs_needing_reset)
-          initial_agent_states = agent.initial_state(
-              tf.shape(envs_needing_reset)[0])
+          num_resets = tf.shape(envs_needing_reset)[0]
+          initial_agent_states = agent.initial_state(num_resets)
           first_agent_states.replace(envs_needing_reset, initial_agent_states)
-          agent_states.replace(envs_needing_reset, initial_agent_states)
-          actions.reset(envs_needing_reset)
+          first_policy_versions.replace(
+              envs_needing_reset, tf.fill([num_resets], policy_version))
+          agent_memory.replace(envs_needing_reset, (
+              tf.zeros([num_resets] + action_specs.shape.dims,
+                       action_specs.dtype),
+              initial_agent_states))
 
           tf.debugging.assert_non_positive(
               tf.cast(env_outputs.abandoned, tf.int32),
@@ -395,10 +512,10 @@ def learner_loop(create_env_fn, create_agent_fn, create_optimizer_fn):
           env_infos.add(env_ids, (FLAGS.num_action_repeats, 0., 0.))
 
           # Inference.
+          prev_actions, prev_agent_states = agent_memory.read(env_ids)
           prev_actions = parametric_action_distribution.postprocess(
-              actions.read(env_ids))
+              prev_actions)
           input_ = encode((prev_actions, env_outputs))
-          prev_agent_states = agent_states.read(env_ids)
           with tf.device(inference_device):
             @tf.function
             def agent_inference(*args):
@@ -412,22 +529,49 @@ def learner_loop(create_env_fn, create_agent_fn, create_optimizer_fn):
           # in queue.
           completed_ids, unrolls = store.append(
               env_ids, (prev_actions, env_outputs, agent_outputs))
-          unrolls = Unroll(first_agent_states.read(completed_ids), *unrolls)
+          unrolls = Unroll(first_agent_states.read(completed_ids), *unrolls,
+                           first_policy_versions.read(completed_ids))
+          if (FLAGS.max_policy_lag is not None and
+              FLAGS.stale_unroll_mode == 'drop'):
+            is_fresh = (policy_version - unrolls.policy_version <=
+                        FLAGS.max_policy_lag)
+            dropped_unrolls.assign_add(tf.reduce_sum(
+                tf.cast(~is_fresh, tf.int64)))
+            unrolls = tf.nest.map_structure(
+                lambda t: tf.boolean_mask(t, is_fresh), unrolls)
           unroll_queue.enqueue_many(unrolls)
-          first_agent_states.replace(completed_ids,
-                                     agent_states.read(completed_ids))
+          first_agent_states.replace(
+              completed_ids, agent_memory.read(completed_ids)[1])
+          first_policy_versions.replace(
+              completed_ids,
+              tf.fill([tf.shape(completed_ids)[0]], policy_version))
 
           # Update current state.
-          agent_states.replace(env_ids, curr_agent_states)
-          actions.replace(env_ids, agent_outputs.action)
+          agent_memory.replace(env_ids,
+                               (agent_outputs.action, curr_agent_states))
           # Return environment actions to environments.
-          return parametric_action_distribution.postprocess(
+          env_actions = parametric_action_distribution.postprocess(
               agent_outputs.action)
 
+          if FLAGS.measure_inference_transfers:
+            if state_on_device:
+              # Agent states and actions stay on the device, completed unrolls
+              # go to the unroll queue on the host.
+              to_device = (env_ids, env_outputs)
+              to_host = (env_actions, unrolls)
+            else:
+              to_device = (input_, prev_agent_states)
+              to_host = (agent_outputs, curr_agent_states)
+            transfer_stats.assign_add(tf.stack([
+                utils.nest_num_bytes(to_device), utils.nest_num_bytes(to_host),
+                tf.constant(1, tf.int64)]))
+          return env_actions
+
         return inference
 
       with strategy.scope():
-        server.bind([create_inference_fn(d) for d in inference_devices])
+        server.bind([create_inference_fn(d) for d in inference_devices],
+                    batch_timeout_ms=FLAGS.inference_batch_timeout_ms)
       server.start()
       unroll_queues.append(unroll_queue)
       servers.append(server)
@@ -436,15 +580,17 @@ def learner_loop(create_env_fn, create_agent_fn, create_optimizer_fn):
     create_host(i, host, inference_devices)
 
   def dequeue(ctx):
-    # Create batch (time major).
-    env_outputs = tf.nest.map_structure(lambda *args: tf.stack(args), *[
-        unroll_queues[ctx.input_pipeline_id].dequeue()
-        for i in range(ctx.get_per_replica_batch_size(FLAGS.batch_size))
-    ])
+    # Create batch (time major). The transposes run on the host, as part of
+    # the input pipeline.
+    env_outputs = unroll_queues[ctx.input_pipeline_id].dequeue_many(
+        ctx.get_per_replica_batch_size(FLAGS.batch_size))
     env_outputs = env_outputs._replace(
-        prev_actions=utils.make_time_major(env_outputs.prev_actions),
-        env_outputs=utils.make_time_major(env_outputs.env_outputs),
-        agent_outputs=utils.make_time_major(env_outputs.agent_outputs))
+        prev_actions=utils.make_time_major(env_outputs.prev_actions,
+                                           use_xla=False),
+        env_outputs=utils.make_time_major(env_outputs.env_outputs,
+                                          use_xla=False),
+        agent_outputs=utils.make_time_major(env_outputs.agent_outputs,
+                                            use_xla=False))
     env_outputs = env_outputs._replace(
         env_outputs=encode(env_outputs.env_outputs))
     # tf.data.Dataset treats list leafs as tensors, so we need to flatten and
@@ -457,8 +603,9 @@ def learner_loop(create_env_fn, create_agent_fn, create_optimizer_fn):
     def _dequeue(_):
       return dequeue(ctx)
 
-    return dataset.map(
+    dataset = dataset.map(
         _dequeue, num_parallel_calls=ctx.num_replicas_in_sync // len(hosts))
+    return dataset.prefetch(FLAGS.batch_prefetch)
 
   dataset = training_strategy.experimental_distribute_datasets_from_function(
       dataset_fn)
@@ -466,6 +613,29 @@ def learner_loop(create_env_fn, create_agent_fn, create_optimizer_fn):
 
   def additional_logs():
     tf.summary.scalar('learning_rate', learning_rate_fn(iterations))
+    if FLAGS.measure_inference_transfers:
+      stats = transfer_stats.read_value()
+      transfer_stats.assign_sub(stats)
+      to_device, to_host, num_calls = tf.unstack(
+          tf.cast(stats, tf.float32))
+      if num_calls > 0:
+        tf.summary.scalar('inference/host_to_device_bytes',
+                          to_device / num_calls)
+        tf.summary.scalar('inference/device_to_host_bytes',
+                          to_host / num_calls)
+    tf.summary.scalar('unroll_queue/depth', tf.add_n(
+        [unroll_queue.size() for unroll_queue in unroll_queues]))
+    if FLAGS.max_policy_lag is not None:
+      num_dropped = dropped_unrolls.read_value()
+      dropped_unrolls.assign_sub(num_dropped)
+      tf.summary.scalar('unroll_queue/dropped', num_dropped)
+    for server in servers:
+      batch_sizes, queueing_times = server.batch_stats('inference')
+      if tf.not_equal(tf.size(batch_sizes), 0):
+        tf.summary.histogram(
+            'inference/batch_fill',
+            tf.cast(batch_sizes, tf.float32) / FLAGS.inference_batch_size)
+        tf.summary.histogram('inference/queueing_time_s', queueing_times)
     n_episodes = info_queue.size()
     n_episodes -= n_episodes % FLAGS.log_episode_frequency
     if tf.not_equal(n_episodes, 0):
@@ -0,0 +1,176 @@
+# coding=utf-8
+# Copyright 2019 The SEED Authors
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for learner.py."""
+
+import collections
+
+from absl import flags
+from absl.testing import flagsaver
+from absl.testing import parameterized
+import numpy as np
+from seed_rl.agents.vtrace import learner
+from seed_rl.common import parametric_distribution
+from seed_rl.common import utils
+import tensorflow as tf
+
+
+FLAGS = flags.FLAGS
+
+AgentOutput = collections.namedtuple('AgentOutput',
+                                     'action policy_logits baseline')
+
+
+class _ConstantAgent(tf.Module):
+  """Agent with trainable logits and baseline, independent of its inputs."""
+
+  def __init__(self, logits_shape, action_shape, baseline_shape):
+    super(_ConstantAgent, self).__init__()
+    self._action_shape = action_shape
+    self._logits = tf.Variable(tf.zeros(logits_shape))
+    self._baseline = tf.Variable(tf.zeros(baseline_shape))
+
+  def entropy_cost(self):
+    return tf.constant(0.01)
+
+  def __call__(self, prev_actions, env_outputs, core_state, unroll,
+               is_training, postprocess_action):
+    batch_shape = tf.shape(env_outputs.reward)
+    logits = self._logits + tf.zeros(
+        tf.concat([batch_shape, tf.shape(self._logits)], axis=0))
+    baseline = self._baseline + tf.zeros(
+        tf.concat([batch_shape, tf.shape(self._baseline)], axis=0))
+    action = tf.zeros(tf.concat([batch_shape, self._action_shape], axis=0),
+                      tf.int32)
+    return AgentOutput(action, logits, baseline), core_state
+
+
+def _unroll_batch(agent, observation):
+  """Returns random env and agent outputs of a [T, B] unroll batch."""
+  time_batch_shape = tf.nest.flatten(observation)[0].shape[:2]
+  env_outputs = utils.EnvOutput(
+      reward=tf.random.uniform(time_batch_shape),
+      done=tf.zeros(time_batch_shape, tf.bool),
+      observation=observation,
+      abandoned=tf.zeros(time_batch_shape, tf.bool),
+      episode_step=tf.zeros(time_batch_shape, tf.int32))
+  agent_outputs, _ = agent(None, env_outputs, (), True, False, False)
+  agent_outputs = agent_outputs._replace(
+      policy_logits=agent_outputs.policy_logits +
+      tf.random.normal(agent_outputs.policy_logits.shape))
+  return env_outputs, agent_outputs
+
+
+def _loss(agent, distribution, env_outputs, agent_outputs, weights=None):
+  """Returns the loss and the logged values of an unroll batch."""
+  logger = utils.ProgressLogger()
+  loss, session = learner.compute_loss(
+      logger, distribution, agent, (), agent_outputs.action, env_outputs,
+      agent_outputs, weights=weights)
+  return loss, dict(zip(logger.log_keys, session))
+
+
+def _compute_loss(agent, distribution, observation, weights=None):
+  """Returns the loss and the logged values of a random [T, B] unroll batch."""
+  return _loss(agent, distribution, *_unroll_batch(agent, observation),
+               weights=weights)
+
+
+class ComputeLossTest(tf.test.TestCase, parameterized.TestCase):
+
+  def setUp(self):
+    super(ComputeLossTest, self).setUp()
+    FLAGS.mark_as_parsed()
+
+  def test_structured_observation(self):
+    observation = {
+        'observation': -3 * tf.ones([5, 2, 3, 4]),
+        'avail_actions': tf.ones([5, 2, 3, 6]),
+        'state': tf.ones([5, 2, 7]),
+    }
+    distribution = parametric_distribution.MultiCategoricalDistribution(
+        n_dimensions=3, n_actions_per_dim=6, dtype=tf.int32)
+    agent = _ConstantAgent(logits_shape=[18], action_shape=[3],
+                           baseline_shape=[])
+    loss, logs = _compute_loss(agent, distribution, observation)
+    self.assertTrue(np.isfinite(loss))
+    self.assertEqual(3, logs['policy/max_input_abs'])
+
+  def test_uint8_observation(self):
+    # Symbolic marlgrid observations: [T, B, agents, view, view, 3] uint8.
+    observation = tf.fill([5, 2, 3, 7, 7, 3], tf.constant(200, tf.uint8))
+    distribution = parametric_distribution.MultiCategoricalDistribution(
+        n_dimensions=3, n_actions_per_dim=4, dtype=tf.int32)
+    agent = _ConstantAgent(logits_shape=[12], action_shape=[3],
+                           baseline_shape=[])
+    loss, logs = _compute_loss(agent, distribution, observation)
+    self.assertTrue(np.isfinite(loss))
+    self.assertEqual(200, logs['policy/max_input_abs'])
+
+
+  @parameterized.parameters(2, 3)
+  @flagsaver.flagsaver(is_centralized=False, max_policy_lag=4)
+  def test_multi_agent_weights(self, batch_size):
+    # Without centralization, losses are [T, B, agents]: weights must apply to
+    # unrolls, including when the number of agents is the batch size.
+    distribution = parametric_distribution.MultiCategoricalDistribution(
+        n_dimensions=3, n_actions_per_dim=4, dtype=tf.int32, event_ndims=0)
+    agent = _ConstantAgent(logits_shape=[12], action_shape=[3],
+                           baseline_shape=[3])
+    env_outputs, agent_outputs = _unroll_batch(
+        agent, tf.ones([5, batch_size, 3, 4]))
+    first_unroll = lambda t: t[:, :1]
+    _, logs = _loss(
+        agent, distribution,
+        *tf.nest.map_structure(first_unroll, (env_outputs, agent_outputs)))
+    dropped = learner.policy_lag_weights(
+        tf.constant([0] + [5] * (batch_size - 1)))
+    loss, dropped_logs = _loss(agent, distribution, env_outputs, agent_outputs,
+                               weights=dropped)
+    self.assertTrue(np.isfinite(loss))
+    # Dropped unrolls don't dilute the losses on the behaviour data.
+    for name in ('losses/policy', 'losses/V', 'losses/kl'):
+      self.assertAllClose(logs[name], dropped_logs[name])
+
+    with flagsaver.flagsaver(stale_unroll_mode='downweight'):
+      _, unweighted_logs = _loss(agent, distribution, env_outputs,
+                                 agent_outputs)
+      _, weighted_logs = _loss(agent, distribution, env_outputs, agent_outputs,
+                               weights=tf.ones([batch_size]))
+    for name in ('losses/policy', 'losses/V', 'losses/kl'):
+      self.assertAllClose(unweighted_logs[name], weighted_logs[name])
+
+
+class PolicyLagWeightsTest(tf.test.TestCase):
+
+  def setUp(self):
+    super(PolicyLagWeightsTest, self).setUp()
+    FLAGS.mark_as_parsed()
+
+  def test_unbounded(self):
+    self.assertIsNone(learner.policy_lag_weights(tf.constant([0, 5, 100])))
+
+  @flagsaver.flagsaver(max_policy_lag=4, stale_unroll_mode='drop')
+  def test_drop(self):
+    self.assertAllEqual([1., 1., 0.],
+                        learner.policy_lag_weights(tf.constant([0, 4, 5])))
+
+  @flagsaver.flagsaver(max_policy_lag=4, stale_unroll_mode='downweight')
+  def test_downweight(self):
+    self.assertAllClose([1., 1., 0.5],
+                        learner.policy_lag_weights(tf.constant([0, 4, 8])))
+
+
+if __name__ == '__main__':
+  tf.test.main()
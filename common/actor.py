@@ -14,6 +14,8 @@
 
 r"""SEED actor."""
 
+import atexit
+import concurrent.futures
 import os
 import timeit
 
@@ -25,11 +27,9 @@ from seed_rl.common import common_flags
 from seed_rl.common import env_wrappers
 from seed_rl.common import profiling
 from seed_rl.common import utils
+from seed_rl.common import wire_encoding
 import tensorflow as tf
 
-import neptune
-import time
-
 
 FLAGS = flags.FLAGS
 
@@ -39,47 +39,123 @@ flags.DEFINE_integer('num_actors_with_summaries', 4,
                      'summaries.')
 flags.DEFINE_bool('render', False,
                   'Whether the first actor should render the environment.')
+flags.DEFINE_integer('num_env_processes', 0,
+                     'Number of worker processes stepping the environment '
+                     'batch. 0 steps all environments sequentially in the '
+                     'actor process.')
+flags.DEFINE_string('metrics_file', None,
+                    'If set, the first actor appends its reported metrics to '
+                    'this local file instead of the Neptune experiment.')
+flags.DEFINE_integer('num_inference_groups', 1,
+                     'Number of groups the environment batch is split into. '
+                     'With more than one group, inference for one group runs '
+                     'while the other groups step, hiding inference latency.')
+flags.DEFINE_string('episode_log_dir', None,
+                    'If set, the first actor streams the actions, rewards and '
+                    'dones of its first environment to this directory, in '
+                    'compressed chunks written in the background, with the '
+                    'run id and seed of every episode and the flags of the '
+                    'run.')
+
+
+def _env_seed(batched_env):
+  """Returns the seed of the first environment of the batch, if known.
+
+  Natively batched engines have a single seed for all their environments.
+  """
+  envs = getattr(batched_env, 'envs', None)
+  if not envs:
+    return getattr(batched_env, 'env_seed', None)
+  return getattr(envs[0], 'env_seed', None)
 
 
 def are_summaries_enabled():
   return FLAGS.task < FLAGS.num_actors_with_summaries
 
 
-class DummyExperiment:
-    def log_metric(self, log_name, x, y):
-        pass
-
-
-def actor_loop(create_env_fn):
+def _create_metric_reporter():
+  """Returns a started MetricReporter for the first actor, None otherwise."""
+  if FLAGS.task != 0:
+    return None
+  if FLAGS.metrics_file:
+    sink = utils.FileMetricSink(FLAGS.metrics_file)
+  elif not FLAGS.is_local:
+    sink = utils.NeptuneMetricSink('pmtest/marl-vtrace', tag=FLAGS.nonce)
+  else:
+    return None
+  reporter = utils.MetricReporter(sink)
+  reporter.start()
+  return reporter
+
+
+class _EnvGroup(object):
+  """A batch of environments with its own inference calls and episode state."""
+
+  def __init__(self, batched_env):
+    self.batched_env = batched_env
+    batch_size = len(batched_env.env_ids)
+    self.env_id = batched_env.env_ids
+    self.run_id = np.random.randint(
+        low=0,
+        high=np.iinfo(np.int64).max,
+        size=batch_size,
+        dtype=np.int64)
+    self.observation = batched_env.reset()
+    self.reward = np.zeros(batch_size, np.float32)
+    self.done = np.zeros(batch_size, np.bool)
+    self.stats = utils.EpisodeStats(batch_size)
+    self.encoder = None
+    if (FLAGS.observation_encoding != wire_encoding.NONE or
+        FLAGS.observation_delta_encoding):
+      self.encoder = wire_encoding.ObservationEncoder(
+          FLAGS.observation_encoding, FLAGS.observation_delta_encoding)
+
+  def encode_observation(self, observation, keyframe):
+    """Returns the observation as sent on the wire."""
+    if self.encoder is None:
+      return observation
+    return self.encoder.encode(observation, keyframe)
+
+  def inference(self, client):
+    """Sends the latest transition of the group and returns actions."""
+    env_output = utils.EnvOutput(
+        self.reward, self.done,
+        self.encode_observation(self.observation, keyframe=self.done),
+        self.stats.abandoned, self.stats.episode_step)
+    return client.inference(self.env_id, self.run_id, env_output,
+                            self.stats.raw_reward)
+
+
+def actor_loop(create_env_fn, create_batched_env_fn=None):
   """Main actor loop.
 
   Args:
     create_env_fn: Callable (taking the task ID as argument) that must return a
       newly created environment.
+    create_batched_env_fn: Optional callable taking a batch size and an
+      environment ID offset, returning an object with the interface of
+      env_wrappers.BatchedEnvironment. Used instead of batching environments
+      created with `create_env_fn`, for environments that step a whole batch
+      natively.
   """
 
-  project = neptune.init('pmtest/marl-vtrace')
-  experiment = DummyExperiment()
-
-  if FLAGS.task == 0 and not FLAGS.is_local:
-    # First actor logs winning rate.
-    while True:
-      time.sleep(5)
-      experiments = project.get_experiments(tag=FLAGS.nonce)
-      if len(experiments) == 0:
-        logging.info('Experiment not found, retry...')
-      else:
-        experiment = experiments[-1]
-        break
+  # First actor reports winning rate. The experiment is looked up in the
+  # background, so acting starts immediately.
+  metric_reporter = _create_metric_reporter()
 
   log_period = 5
   log_period_growth = 1.05
   log_period_max = 600
 
-  last_replay_time = timeit.default_timer()
-  replay_period = 600
-  replay_period_growth = 1.2
-  replay_period_max = 3600
+  episode_log = None
+  if FLAGS.task == 0 and FLAGS.episode_log_dir:
+    episode_log = utils.EpisodeLogWriter(
+        FLAGS.episode_log_dir,
+        metadata={'flags': FLAGS.flags_into_string()})
+    episode_log.start()
+    # The actor loop only ends with the process, which must not lose the last
+    # (partial) chunk.
+    atexit.register(episode_log.shutdown)
 
   env_batch_size = FLAGS.env_batch_size
   logging.info('Starting actor loop. Task: %r. Environment batch size: %r',
@@ -94,141 +170,144 @@ def actor_loop(create_env_fn):
     summary_writer = tf.summary.create_noop_writer()
     timer_cls = utils.nullcontext
 
+  num_groups = FLAGS.num_inference_groups
+  assert env_batch_size % num_groups == 0, (
+      'env_batch_size (=%d) must be a multiple of num_inference_groups (=%d)' %
+      (env_batch_size, num_groups))
+  group_size = env_batch_size // num_groups
+  # Inference of one group runs in the background while the other groups step.
+  executor = (concurrent.futures.ThreadPoolExecutor(max_workers=num_groups)
+              if num_groups > 1 else None)
+
   actor_step = 0
   with summary_writer.as_default():
     while True:
+      groups = []
       try:
         # Client to communicate with the learner.
         client = grpc.Client(FLAGS.server_address)
 
-        batched_env = env_wrappers.BatchedEnvironment(
-            create_env_fn, env_batch_size, FLAGS.task * env_batch_size)
-
-        env_id = batched_env.env_ids
-        run_id = np.random.randint(
-            low=0,
-            high=np.iinfo(np.int64).max,
-            size=env_batch_size,
-            dtype=np.int64)
-        observation = batched_env.reset()
-        reward = np.zeros(env_batch_size, np.float32)
-        raw_reward = np.zeros(env_batch_size, np.float32)
-        done = np.zeros(env_batch_size, np.bool)
-        abandoned = np.zeros(env_batch_size, np.bool)
-
-        global_step = 0
-        episode_step = np.zeros(env_batch_size, np.int32)
-        episode_return = np.zeros(env_batch_size, np.float32)
-        episode_raw_return = np.zeros(env_batch_size, np.float32)
-        episode_step_sum = 0
-        episode_return_sum = 0
-        episode_raw_return_sum = 0
-        episode_won = 0
-        episodes_in_report = 0
+        for g in range(num_groups):
+          id_offset = FLAGS.task * env_batch_size + g * group_size
+          if create_batched_env_fn is not None:
+            batched_env = create_batched_env_fn(group_size, id_offset)
+          elif FLAGS.num_env_processes > 0:
+            batched_env = env_wrappers.ParallelBatchedEnvironment(
+                create_env_fn, group_size, id_offset,
+                max(1, FLAGS.num_env_processes // num_groups))
+          else:
+            batched_env = env_wrappers.BatchedEnvironment(
+                create_env_fn, group_size, id_offset)
+          groups.append(_EnvGroup(batched_env))
+        if episode_log:
+          episode_log.start_episode(groups[0].run_id[0],
+                                    _env_seed(groups[0].batched_env))
+
+        all_stats = [group.stats for group in groups]
 
         elapsed_inference_s_timer = timer_cls('actor/elapsed_inference_s', 1000)
         last_log_time = timeit.default_timer()
         last_global_step = 0
+        if executor:
+          pending_actions = [executor.submit(group.inference, client)
+                             for group in groups]
         while True:
-          tf.summary.experimental.set_step(actor_step)
-          env_output = utils.EnvOutput(reward, done, observation,
-                                       abandoned, episode_step)
-          with elapsed_inference_s_timer:
-            action = client.inference(env_id, run_id, env_output, raw_reward)
-          with timer_cls('actor/elapsed_env_step_s', 1000):
-            observation, reward, done, info = batched_env.step(action.numpy())
-          if is_rendering_enabled:
-            batched_env.render()
-          for i in range(env_batch_size):
-            episode_step[i] += 1
-            episode_return[i] += reward[i]
-            raw_reward[i] = float((info[i] or {}).get('score_reward',
-                                                      reward[i]))
-            episode_raw_return[i] += raw_reward[i]
-            # If the info dict contains an entry abandoned=True and the
-            # episode was ended (done=True), then we need to specially handle
-            # the final transition as per the explanations below.
-            abandoned[i] = (info[i] or {}).get('abandoned', False)
-            assert done[i] if abandoned[i] else True
-            if done[i]:
+          for g, group in enumerate(groups):
+            tf.summary.experimental.set_step(actor_step)
+            batched_env = group.batched_env
+            stats = group.stats
+            with elapsed_inference_s_timer:
+              if executor:
+                action = pending_actions[g].result()
+              else:
+                action = group.inference(client)
+            with timer_cls('actor/elapsed_env_step_s', 1000):
+              observation, reward, done, info = batched_env.step(
+                  action.numpy())
+            if is_rendering_enabled and g == 0:
+              batched_env.render()
+            if episode_log and g == 0:
+              episode_log.append(action[0].numpy(), reward[0], done[0])
+              if done[0]:
+                episode_log.start_episode(group.run_id[0],
+                                          _env_seed(batched_env))
+            finished = stats.step(
+                reward, done, info,
+                getattr(batched_env, 'raw_rewards', None))
+            if len(finished):
               # If the episode was abandoned, we need to report the final
-              # transition including the final observation as if the episode has
-              # not terminated yet. This way, learning algorithms can use the
-              # transition for learning.
-              if abandoned[i]:
-                # We do not signal yet that the episode was abandoned. This will
-                # happen for the transition from the terminal state to the
-                # resetted state.
-                assert env_batch_size == 1 and i == 0, (
-                    'Mixing of batched and non-batched inference calls is not '
-                    'yet supported')
-                env_output = utils.EnvOutput(reward,
-                                             np.array([False]), observation,
-                                             np.array([False]), episode_step)
+              # transition including the final observation as if the episode
+              # has not terminated yet. This way, learning algorithms can use
+              # the transition for learning.
+              if stats.abandoned.any():
+                # We do not signal yet that the episode was abandoned. This
+                # will happen for the transition from the terminal state to
+                # the resetted state.
+                assert group_size == 1, (
+                    'Mixing of batched and non-batched inference calls is '
+                    'not yet supported')
+                env_output = utils.EnvOutput(
+                    reward, np.array([False]),
+                    group.encode_observation(observation,
+                                             keyframe=np.array([False])),
+                    np.array([False]), stats.episode_step)
                 with elapsed_inference_s_timer:
                   # action is ignored
-                  client.inference(env_id, run_id, env_output, raw_reward)
-                reward[i] = 0.0
-                raw_reward[i] = 0.0
+                  client.inference(group.env_id, group.run_id, env_output,
+                                   stats.raw_reward)
+                reward[0] = 0.0
+                stats.raw_reward[0] = 0.0
 
               # Periodically log statistics.
               current_time = timeit.default_timer()
-              episode_step_sum += episode_step[i]
-              episode_return_sum += episode_return[i]
-              episode_raw_return_sum += episode_raw_return[i]
-              global_step += episode_step[i]
-              episode_won += (info[i] or {}).get('battle_won', False)
-              episodes_in_report += 1
-
-              if FLAGS.task == 0 and \
-                      current_time - last_replay_time > replay_period:
-                  replay_period = min(replay_period_max,
-                                      replay_period * replay_period_growth)
-                  last_replay_time = current_time
-                  batched_env.envs[0].save_replay()
+              stats.end_episodes(finished)
 
               if current_time - last_log_time > log_period:
                 log_period = min(log_period_max, log_period * log_period_growth)
+                global_step = sum(s.total_steps for s in all_stats)
+                episodes_in_report = sum(s.num_episodes for s in all_stats)
+                win_rate = (sum(s.won_sum for s in all_stats) /
+                            episodes_in_report)
                 logging.info(
                     'Actor steps: %i, Return: %f Raw return: %f '
                     'Episode steps: %f, Speed: %f steps/s, Won: %.2f',
                     global_step,
-                    episode_return_sum / episodes_in_report,
-                    episode_raw_return_sum / episodes_in_report,
-                    episode_step_sum / episodes_in_report,
+                    sum(s.return_sum for s in all_stats) / episodes_in_report,
+                    sum(s.raw_return_sum for s in all_stats) /
+                    episodes_in_report,
+                    sum(s.step_sum for s in all_stats) / episodes_in_report,
                     (global_step - last_global_step) /
                     (current_time - last_log_time),
-                    episode_won / episodes_in_report)
-                tf.summary.scalar('episodes win rate',
-                                  episode_won / episodes_in_report,
+                    win_rate)
+                tf.summary.scalar('episodes win rate', win_rate,
                                   step=global_step)
-                if FLAGS.task == 0:
-                  experiment.log_metric(log_name='episode win rate',
-                                        x=global_step,
-                                        y=episode_won / episodes_in_report)
+                if metric_reporter:
+                  metric_reporter.log_metric('episode win rate',
+                                             x=global_step, y=win_rate)
 
                 last_global_step = global_step
-                episode_return_sum = 0
-                episode_raw_return_sum = 0
-                episode_step_sum = 0
-                episode_won = 0
-                episodes_in_report = 0
+                for s in all_stats:
+                  s.reset_report()
                 last_log_time = current_time
 
-              episode_step[i] = 0
-              episode_return[i] = 0
-              episode_raw_return[i] = 0
-
-          # Finally, we reset the episode which will report the transition
-          # from the terminal state to the resetted state in the next loop
-          # iteration (with zero rewards).
-          with timer_cls('actor/elapsed_env_reset_s', 10):
-            observation = batched_env.reset_if_done(done)
+            # Finally, we reset the episode which will report the transition
+            # from the terminal state to the resetted state in the next loop
+            # iteration (with zero rewards).
+            with timer_cls('actor/elapsed_env_reset_s', 10):
+              observation = batched_env.reset_if_done(done)
+            group.observation, group.reward, group.done = (observation, reward,
+                                                           done)
 
-          if is_rendering_enabled and done[0]:
-            batched_env.render()
+            if is_rendering_enabled and g == 0 and done[0]:
+              batched_env.render()
 
-          actor_step += 1
+            if executor:
+              pending_actions[g] = executor.submit(group.inference, client)
+            actor_step += 1
       except (tf.errors.UnavailableError, tf.errors.CancelledError) as e:
         logging.exception(e)
-        batched_env.close()
+        for group in groups:
+          group.batched_env.close()
+        if episode_log:
+          # Environments are recreated with new run ids.
+          episode_log.flush()
@@ -47,6 +47,14 @@ flags.DEFINE_integer('num_envs', 4,
 flags.DEFINE_integer('num_action_repeats', 1, 'Number of action repeats.')
 flags.DEFINE_integer('frames_stacked', 3, 'Number of stacked frames.')
 
+flags.DEFINE_enum('observation_encoding', 'none', ['none', 'fp16', 'uint8'],
+                  'Encoding of floating point observations sent by actors '
+                  'for inference. uint8 quantizes each observation with its '
+                  'own offset and scale.')
+flags.DEFINE_bool('observation_delta_encoding', False,
+                  'Whether actors send observations as deltas to the '
+                  'previous observation of the environment.')
+
 flags.DEFINE_bool('is_local', False,
                   'Whether the program is running locally.')
 flags.DEFINE_bool('is_centralized', True,
@@ -57,3 +65,8 @@ flags.DEFINE_bool('centralized_IS', False,
                   'Use centralized importance sampling')
 flags.DEFINE_bool('mean_value_function', False,
                   'Use mean value function in the decentralized training')
+flags.DEFINE_enum('vtrace_implementation', 'loop',
+                  ['loop', 'scan', 'associative_scan'],
+                  'How V-trace computes its backward recursion: a Python loop '
+                  'unrolled in the graph (T ops), tf.scan (one while loop) or '
+                  'a parallel prefix scan (log2(T) vectorized steps).')
@@ -14,7 +14,11 @@
 
 
 """Environment wrappers."""
+import multiprocessing
+import os
 import sys
+import tempfile
+import uuid
 
 from absl import flags
 import gym
@@ -126,8 +130,40 @@ class DiscretizeEnvWrapper(gym.Env):
     return self.env.render(*args, **kwargs)
 
 
+def _write_obs(slot, obs):
+  """Copies `obs` into the flattened batch buffer slot `slot`.
+
+  Leaves that already are the slot views (written in place by an environment
+  exposing `observation_buffer`) are skipped.
+  """
+  for view, leaf in zip(slot, tf.nest.flatten(obs)):
+    if leaf is not view:
+      view[...] = leaf
+
+
+def _attach_obs_buffer(env, structure, slot):
+  """Lets an environment write its observations directly into its slot."""
+  if hasattr(env, 'observation_buffer'):
+    env.observation_buffer = tf.nest.pack_sequence_as(structure, slot)
+
+
+def _raw_reward(reward, info):
+  """Returns the raw reward reported as 'score_reward' in `info`, if any."""
+  return info.get('score_reward', reward) if info else reward
+
+
 class BatchedEnvironment:
-  """A wrapper that batches several environment instances."""
+  """A wrapper that batches several environment instances.
+
+  The raw rewards reported by the environments as 'score_reward' info entries
+  are collected in the `raw_rewards` array while stepping.
+
+  Observations are written into preallocated batch buffers (one per
+  observation leaf) and returned as views of these buffers, so they are only
+  valid until the next call to step(), reset() or reset_if_done().
+  Environments with an `observation_buffer` attribute get the views of their
+  own slot assigned to it and may build their observations there in place.
+  """
 
   def __init__(self, create_env_fn, batch_size, id_offset):
     """Initialize the wrapper.
@@ -144,7 +180,10 @@ class BatchedEnvironment:
     env_ids = [id_offset + i for i in range(batch_size)]
     self._envs = [create_env_fn(id) for id in env_ids]
     self._env_ids = np.array(env_ids, np.int32)
-    self._obs = None
+    self._structure = None
+    self._buffers = None
+    self._slots = None
+    self._raw_rewards = np.zeros(batch_size, np.float32)
 
   @property
   def env_ids(self):
@@ -154,6 +193,26 @@ class BatchedEnvironment:
   def envs(self):
     return self._envs
 
+  @property
+  def raw_rewards(self):
+    """Raw rewards of the last step, defaulting to the rewards."""
+    return self._raw_rewards
+
+  def _allocate_buffers(self, observations):
+    """Creates the batch buffers from the first observations of all envs.
+
+    Shapes and dtypes are taken from the observations rather than from the
+    observation spaces, which do not always match what environments return.
+    """
+    self._structure = observations[0]
+    self._buffers = [
+        np.empty((self._batch_size,) + np.shape(leaf), np.asarray(leaf).dtype)
+        for leaf in tf.nest.flatten(self._structure)]
+    self._slots = [[buffer[i, ...] for buffer in self._buffers]
+                   for i in range(self._batch_size)]
+    for env, slot in zip(self._envs, self._slots):
+      _attach_obs_buffer(env, self._structure, slot)
+
   @property
   def _mapped_obs(self):
     """Maps observations to preserve the original structure.
@@ -162,25 +221,31 @@ class BatchedEnvironment:
     `achieved_goal` elements in its observations. In this case the batched
     observations would contain the same three elements batched by element.
     Returns:
-      Mapped observations.
+      Mapped observations, views of the batch buffers.
     """
-    return tf.nest.map_structure(lambda *args: np.array(args), *self._obs)
+    return tf.nest.pack_sequence_as(self._structure, self._buffers)
 
   def step(self, action_batch):
     """Does one step for all batched environments sequentially."""
+    assert self._buffers is not None, 'step() called before reset()'
     num_envs = self._batch_size
     rewards = np.zeros(num_envs, np.float32)
     dones = np.zeros(num_envs, np.bool)
     infos = [None] * num_envs
     for i in range(num_envs):
-      self._obs[i], rewards[i], dones[i], infos[i] = self._envs[i].step(
+      obs, rewards[i], dones[i], infos[i] = self._envs[i].step(
           action_batch[i])
+      self._raw_rewards[i] = _raw_reward(rewards[i], infos[i])
+      _write_obs(self._slots[i], obs)
     return self._mapped_obs, rewards, dones, infos
 
   def reset(self):
     """Reset all environments."""
     observations = [env.reset() for env in self._envs]
-    self._obs = observations
+    if self._buffers is None:
+      self._allocate_buffers(observations)
+    for slot, obs in zip(self._slots, observations):
+      _write_obs(slot, obs)
     return self._mapped_obs
 
   def reset_if_done(self, done):
@@ -191,10 +256,9 @@ class BatchedEnvironment:
     Returns:
       Observations for all environments.
     """
-    assert self._obs is not None, 'reset_if_done() called before reset()'
-    for i in range(len(self._envs)):
-      if done[i]:
-        self._obs[i] = self.envs[i].reset()
+    assert self._buffers is not None, 'reset_if_done() called before reset()'
+    for i in np.flatnonzero(done):
+      _write_obs(self._slots[i], self._envs[i].reset())
 
     return self._mapped_obs
 
@@ -207,6 +271,241 @@ class BatchedEnvironment:
       env.close()
 
 
+def _shared_memory_dir():
+  return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def _env_worker(conn, create_env_fn, env_ids, offset, argv):
+  """Creates and steps a shard of environments in a worker process.
+
+  Args:
+    conn: Worker end of the multiprocessing.Pipe used for commands.
+    create_env_fn: A function to create environment instances.
+    env_ids: Ids of the environments in this shard.
+    offset: Index of the first environment of this shard in the whole batch.
+    argv: Command line of the parent process, used to parse flags (workers are
+      spawned, so flag values are not inherited).
+  """
+  if not FLAGS.is_parsed():
+    FLAGS(argv, known_only=True)
+  envs = [create_env_fn(env_id) for env_id in env_ids]
+  slots = None
+
+  def write_obs(i, obs):
+    _write_obs(slots[i], obs)
+
+  while True:
+    command, args = conn.recv()
+    if command == 'step':
+      rewards = np.zeros(len(envs), np.float32)
+      raw_rewards = np.zeros(len(envs), np.float32)
+      dones = np.zeros(len(envs), np.bool)
+      infos = [None] * len(envs)
+      for i, env in enumerate(envs):
+        obs, rewards[i], dones[i], infos[i] = env.step(args[i])
+        raw_rewards[i] = _raw_reward(rewards[i], infos[i])
+        write_obs(i, obs)
+      conn.send((rewards, raw_rewards, dones, infos))
+    elif command == 'reset':
+      observations = [env.reset() for env in envs]
+      if slots is None:
+        # Buffers do not exist before the first reset, the parent process
+        # allocates them based on these observations.
+        conn.send(observations)
+      else:
+        for i, obs in enumerate(observations):
+          write_obs(i, obs)
+        conn.send(None)
+    elif command == 'reset_if_done':
+      for i, env in enumerate(envs):
+        if args[i]:
+          write_obs(i, env.reset())
+      conn.send(None)
+    elif command == 'attach':
+      structure, buffer_specs = args
+      buffers = [np.memmap(path, dtype=dtype, mode='r+', shape=shape)
+                 for path, dtype, shape in buffer_specs]
+      slots = [[buffer[offset + i, ...] for buffer in buffers]
+               for i in range(len(envs))]
+      for env, slot in zip(envs, slots):
+        _attach_obs_buffer(env, structure, slot)
+      conn.send(None)
+    elif command == 'call':
+      index, name, call_args, call_kwargs = args
+      conn.send(getattr(envs[index], name)(*call_args, **call_kwargs))
+    elif command == 'close':
+      for env in envs:
+        env.close()
+      conn.send(None)
+      conn.close()
+      return
+    else:
+      raise ValueError('Unknown command: {}'.format(command))
+
+
+class _RemoteEnv(object):
+  """Proxy forwarding method calls to an environment in a worker process."""
+
+  def __init__(self, conn, index):
+    self._conn = conn
+    self._index = index
+
+  def __getattr__(self, name):
+    def call(*args, **kwargs):
+      self._conn.send(('call', (self._index, name, args, kwargs)))
+      return self._conn.recv()
+    return call
+
+
+class ParallelBatchedEnvironment:
+  """A drop-in BatchedEnvironment that steps environments in worker processes.
+
+  The batch is split into `num_processes` contiguous shards, each one created
+  and stepped by its own process, so a single actor can use several cores.
+  Workers write observations directly into shared memory buffers (one per
+  observation leaf), only actions, rewards, dones and infos go through pipes.
+
+  Note: the returned observations are views of the shared buffers, they are
+  only valid until the next call to step(), reset() or reset_if_done().
+  """
+
+  def __init__(self, create_env_fn, batch_size, id_offset, num_processes):
+    """Initialize the wrapper.
+    Args:
+      create_env_fn: A function to create environment instances. It must be
+        picklable, as workers are started with the 'spawn' method.
+      batch_size: The number of environment instances to create.
+      id_offset: The offset for environment ids. Environments receive sequential
+        ids starting from this offset.
+      num_processes: The number of worker processes. Capped at batch_size.
+    """
+    self._batch_size = batch_size
+    env_ids = [id_offset + i for i in range(batch_size)]
+    self._env_ids = np.array(env_ids, np.int32)
+    self._buffers = None
+    self._structure = None
+    self._raw_rewards = np.zeros(batch_size, np.float32)
+
+    # Workers are spawned rather than forked, as forking a process with an
+    # initialized TensorFlow runtime is unsafe.
+    ctx = multiprocessing.get_context('spawn')
+    num_processes = max(1, min(num_processes, batch_size))
+    self._shards = []
+    self._conns = []
+    self._processes = []
+    self._envs = []
+    offset = 0
+    for shard in np.array_split(np.arange(batch_size), num_processes):
+      conn, worker_conn = ctx.Pipe()
+      process = ctx.Process(
+          target=_env_worker,
+          args=(worker_conn, create_env_fn, [env_ids[i] for i in shard],
+                offset, sys.argv),
+          daemon=True)
+      process.start()
+      worker_conn.close()
+      self._shards.append(slice(offset, offset + len(shard)))
+      self._conns.append(conn)
+      self._processes.append(process)
+      self._envs.extend(_RemoteEnv(conn, i) for i in range(len(shard)))
+      offset += len(shard)
+
+  @property
+  def env_ids(self):
+    return self._env_ids
+
+  @property
+  def envs(self):
+    """Proxies of the environments, forwarding method calls to the workers."""
+    return self._envs
+
+  @property
+  def raw_rewards(self):
+    """Raw rewards of the last step, defaulting to the rewards."""
+    return self._raw_rewards
+
+  def _broadcast(self, command, args=None):
+    for i, conn in enumerate(self._conns):
+      conn.send((command, None if args is None else args[self._shards[i]]))
+    return [conn.recv() for conn in self._conns]
+
+  def _allocate_buffers(self, observations):
+    """Creates the shared buffers from the first observations of all envs."""
+    self._structure = observations[0]
+    flat_observations = [tf.nest.flatten(obs) for obs in observations]
+    attach_args = []
+    memmaps = []
+    for leaf in flat_observations[0]:
+      leaf = np.asarray(leaf)
+      path = os.path.join(_shared_memory_dir(),
+                          'seed_rl_env_{}'.format(uuid.uuid4().hex))
+      shape = (self._batch_size,) + leaf.shape
+      memmaps.append(np.memmap(path, dtype=leaf.dtype, mode='w+', shape=shape))
+      attach_args.append((path, leaf.dtype, shape))
+    for conn in self._conns:
+      conn.send(('attach', (self._structure, attach_args)))
+    for conn in self._conns:
+      conn.recv()
+    # Workers have the files mapped, they can be unlinked from the filesystem.
+    for path, _, _ in attach_args:
+      os.unlink(path)
+    self._buffers = [np.asarray(m) for m in memmaps]
+    for i, flat_obs in enumerate(flat_observations):
+      for buffer, leaf in zip(self._buffers, flat_obs):
+        buffer[i] = leaf
+
+  @property
+  def _mapped_obs(self):
+    return tf.nest.pack_sequence_as(self._structure, self._buffers)
+
+  def step(self, action_batch):
+    """Does one step for all batched environments in parallel."""
+    assert self._buffers is not None, 'step() called before reset()'
+    results = self._broadcast('step', action_batch)
+    rewards = np.concatenate([r for r, _, _, _ in results])
+    self._raw_rewards = np.concatenate([r for _, r, _, _ in results])
+    dones = np.concatenate([d for _, _, d, _ in results])
+    infos = [info for _, _, _, shard_infos in results for info in shard_infos]
+    return self._mapped_obs, rewards, dones, infos
+
+  def reset(self):
+    """Reset all environments."""
+    results = self._broadcast('reset')
+    if self._buffers is None:
+      self._allocate_buffers([obs for shard in results for obs in shard])
+    return self._mapped_obs
+
+  def reset_if_done(self, done):
+    """Reset the environments for which 'done' is True.
+    Args:
+      done: An array that specifies which environments are 'done', meaning their
+        episode is terminated.
+    Returns:
+      Observations for all environments.
+    """
+    assert self._buffers is not None, 'reset_if_done() called before reset()'
+    self._broadcast('reset_if_done', np.asarray(done))
+    return self._mapped_obs
+
+  def render(self, mode='human', **kwargs):
+    # Render only the first one
+    self._envs[0].render(mode, **kwargs)
+
+  def close(self):
+    for conn in self._conns:
+      try:
+        conn.send(('close', None))
+      except (BrokenPipeError, EOFError):
+        pass
+    for conn, process in zip(self._conns, self._processes):
+      try:
+        conn.recv()
+      except (BrokenPipeError, EOFError):
+        process.terminate()
+      conn.close()
+      process.join()
+
+
 class FloatWrapper(gym.Env):
   def __init__(self, env):
     self.env = env
@@ -226,7 +525,7 @@ class FloatWrapper(gym.Env):
 
 
 class MultiWrapper(gym.Env):
-  def __init__(self, env, normalization=None):
+  def __init__(self, env, normalization=None, dtype=np.float32):
     self.env = env
     self.num_agents = len(env.action_space)
     if normalization is None:
@@ -238,7 +537,9 @@ class MultiWrapper(gym.Env):
 
     self.observation_space = env.observation_space[0]
     self.observation_space.shape = (len(env.observation_space),) + env.observation_space[0].shape
-    self.observation_space.dtype = np.float32
+    self.observation_space.dtype = dtype
+    # Set by BatchedEnvironment to the slot observations are written to.
+    self.observation_buffer = None
 
     print(env.action_space, env.observation_space)
     print(self.action_space, self.observation_space)
@@ -256,7 +557,12 @@ class MultiWrapper(gym.Env):
     return self.env.render(mode)
 
   def _convert_observation(self, obs):
-    return np.stack([self.normalization(obs[i]) for i in range(self.num_agents)], axis=0).astype(np.float32)
+    out = self.observation_buffer
+    if out is None:
+      out = np.empty(self.observation_space.shape, self.observation_space.dtype)
+    for i in range(self.num_agents):
+      out[i] = self.normalization(obs[i])
+    return out
 
   def _convert_action(self, action):
     return action
@@ -266,7 +572,7 @@ class MultiWrapper(gym.Env):
 
 
 class ParticleWrapper(gym.Env):
-  def __init__(self, env, normalization=None):
+  def __init__(self, env, normalization=None, dtype=np.float32):
     self.env = env
     self.num_agents = len(env.action_space)
     if normalization is None:
@@ -284,7 +590,9 @@ class ParticleWrapper(gym.Env):
 
     self.observation_space = env.observation_space[0]
     self.observation_space.shape = (len(env.observation_space),) + env.observation_space[0].shape
-    self.observation_space.dtype = np.float32
+    self.observation_space.dtype = dtype
+    # Set by BatchedEnvironment to the slot observations are written to.
+    self.observation_buffer = None
 
     print(env.action_space, env.observation_space)
     print(self.action_space, self.observation_space)
@@ -305,7 +613,12 @@ class ParticleWrapper(gym.Env):
     return self.env.render(mode=mode)
 
   def _convert_observation(self, obs):
-    return np.stack([self.normalization(obs[i]) for i in range(self.num_agents)], axis=0).astype(np.float32)
+    out = self.observation_buffer
+    if out is None:
+      out = np.empty(self.observation_space.shape, self.observation_space.dtype)
+    for i in range(self.num_agents):
+      out[i] = self.normalization(obs[i])
+    return out
 
   def _convert_action(self, action):
     # print(action)
@@ -320,9 +633,18 @@ class ParticleWrapper(gym.Env):
 
 
 class SCWrapper(gym.Env):
-  def __init__(self, env, normalization=None):
+  """Multi-agent StarCraft environment.
+
+  By default, the observation of every agent is a row made of its stacked
+  observations, its available actions mask and the global state. With
+  `structured=True`, observations are a dict of the stacked per-agent
+  observations, the available actions masks and a single copy of the global
+  state.
+  """
+
+  def __init__(self, env, normalization=None, structured=False):
     self.env = env
-    self.stacked_obs = []
+    self.structured = structured
 
     if normalization is None:
       self.normalization = (lambda x: x)
@@ -335,20 +657,50 @@ class SCWrapper(gym.Env):
     self.action_space = gym.spaces.MultiDiscrete(
                             [info['n_actions'] for _ in range(self.num_agents)])
 
-    self.observation_space = gym.spaces.Box(
-      low=-np.inf,
-      high=np.inf,
-      shape=(info['n_agents'], info['obs_shape']*FLAGS.frames_stacked + info['n_actions'] + info['state_shape']))
-    self.observation_space.dtype = np.float32
+    if structured:
+      self.observation_space = gym.spaces.Dict({
+        'observation': gym.spaces.Box(
+          low=-np.inf, high=np.inf, dtype=np.float32,
+          shape=(info['n_agents'], info['obs_shape'] * FLAGS.frames_stacked)),
+        'avail_actions': gym.spaces.Box(
+          low=0, high=1, dtype=np.float32,
+          shape=(info['n_agents'], info['n_actions'])),
+        'state': gym.spaces.Box(
+          low=-np.inf, high=np.inf, dtype=np.float32,
+          shape=(info['state_shape'],)),
+      })
+    else:
+      self.observation_space = gym.spaces.Box(
+        low=-np.inf,
+        high=np.inf,
+        shape=(info['n_agents'], info['obs_shape']*FLAGS.frames_stacked + info['n_actions'] + info['state_shape']))
+      self.observation_space.dtype = np.float32
 
     self.state_dim = info['state_shape']
+    # Set by BatchedEnvironment to the slot observations are written to.
+    self.observation_buffer = None
+
+    # Ring buffer of the last normalized frames of every agent, the oldest
+    # frame is at index `_oldest_frame`.
+    self._obs_dim = info['obs_shape']
+    self._frames = np.zeros(
+        (self.num_agents, FLAGS.frames_stacked, self._obs_dim), np.float32)
+    self._oldest_frame = 0
 
     print(self.action_space, self.observation_space, 'state size:', self.state_dim)
 
+  @property
+  def env_seed(self):
+    """Seed of the StarCraft game, needed to replay its episodes."""
+    return self.env.seed()
+
   def reset(self):
-    self.stacked_obs = []
     self.env.reset()
     obs = self.env.get_obs()
+    # Frames before the beginning of the episode are zeros.
+    self._frames[:] = self.normalization(
+        np.zeros((self.num_agents, 1, self._obs_dim), np.float32))
+    self._oldest_frame = 0
     return self._convert_observation(obs)
 
   def step(self, action):
@@ -361,24 +713,46 @@ class SCWrapper(gym.Env):
     return self.env.render(mode)
 
   def _add_new_obs(self, obs):
-    if self.stacked_obs == []:
-      self.stacked_obs = [np.zeros_like(obs)] * (FLAGS.frames_stacked - 1) + [obs]
-    else:
-      self.stacked_obs = self.stacked_obs[1:] + [obs]
+    # Only the new frame is normalized, it replaces the oldest one.
+    self._frames[:, self._oldest_frame] = self.normalization(np.asarray(obs))
+    self._oldest_frame = (self._oldest_frame + 1) % FLAGS.frames_stacked
+
+  def _write_stacked_frames(self, out):
+    """Writes the frames from oldest to newest into `out` in a single copy."""
+    stacked = out.reshape(self.num_agents, FLAGS.frames_stacked, self._obs_dim)
+    order = (np.arange(FLAGS.frames_stacked) + self._oldest_frame) % (
+        FLAGS.frames_stacked)
+    np.take(self._frames, order, axis=1, out=stacked, mode='clip')
 
   def _convert_observation(self, obs):
     # Prepare raw observation for agent network.
     # Add information about available actions.
     self._add_new_obs(obs)
 
-    return np.stack([
-      np.concatenate([
-        self.normalization(self.stacked_obs[stack_i][agent_i])
-                       for stack_i in range(FLAGS.frames_stacked)] + [
-        self.env.get_avail_agent_actions(agent_i),
-        self.env.get_state(),
-      ]) for agent_i in range(self.num_agents)
-    ], axis=0).astype(np.float32)
+    if self.structured:
+      return self._convert_structured_observation()
+
+    out = self.observation_buffer
+    if out is None:
+      out = np.empty(self.observation_space.shape, np.float32)
+    frames_size = FLAGS.frames_stacked * self._obs_dim
+    self._write_stacked_frames(out[:, :frames_size])
+    for agent_i in range(self.num_agents):
+      out[agent_i, frames_size:-self.state_dim] = (
+          self.env.get_avail_agent_actions(agent_i))
+    out[:, -self.state_dim:] = self.env.get_state()
+    return out
+
+  def _convert_structured_observation(self):
+    out = self.observation_buffer
+    if out is None:
+      out = {key: np.empty(space.shape, space.dtype)
+             for key, space in self.observation_space.spaces.items()}
+    self._write_stacked_frames(out['observation'])
+    for agent_i in range(self.num_agents):
+      out['avail_actions'][agent_i] = self.env.get_avail_agent_actions(agent_i)
+    out['state'][:] = self.env.get_state()
+    return out
 
   def _convert_action(self, action):
     # Ensure the executed action is available.
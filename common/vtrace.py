@@ -33,12 +33,57 @@ FLAGS = flags.FLAGS
 
 VTraceReturns = collections.namedtuple('VTraceReturns', 'vs pg_advantages')
 
+IMPLEMENTATIONS = ('loop', 'scan', 'associative_scan')
+
+
+def _reverse_linear_scan(coefficients, deltas, implementation):
+  """Returns acc with acc[t] = deltas[t] + coefficients[t] * acc[t + 1].
+
+  The recursion starts from acc[T] = 0 and runs along the first (time)
+  dimension.
+
+  Args:
+    coefficients: A float32 tensor of shape [T, ...].
+    deltas: A float32 tensor of the same shape.
+    implementation: One of IMPLEMENTATIONS. 'loop' unrolls the T steps in the
+      graph, 'scan' uses tf.scan. 'associative_scan' composes the affine maps
+      acc -> delta + coefficient * acc with a Hillis-Steele parallel prefix
+      scan, in log2(T) steps over the whole sequence.
+  """
+  assert implementation in IMPLEMENTATIONS, implementation
+  if implementation == 'loop':
+    acc = tf.zeros_like(deltas[0])
+    result = []
+    for i in range(int(deltas.shape[0]) - 1, -1, -1):
+      acc = deltas[i] + coefficients[i] * acc
+      result.append(acc)
+    return tf.stack(result[::-1])
+  if implementation == 'scan':
+    return tf.scan(lambda acc, x: x[1] + x[0] * acc, (coefficients, deltas),
+                   initializer=tf.zeros_like(deltas[0]), reverse=True)
+  # In reversed time, after the step with `shift`, b[j] is the result of
+  # applying the maps j - 2 * shift + 1, ..., j to 0 and a[j] is the product of
+  # their coefficients.
+  a = tf.reverse(coefficients, axis=[0])
+  b = tf.reverse(deltas, axis=[0])
+  length = int(deltas.shape[0])
+  shift = 1
+  while shift < length:
+    # Maps before the start of the sequence are the identity.
+    a_earlier = tf.concat([tf.ones_like(a[:shift]), a[:-shift]], axis=0)
+    b_earlier = tf.concat([tf.zeros_like(b[:shift]), b[:-shift]], axis=0)
+    b = b + a * b_earlier
+    a = a * a_earlier
+    shift *= 2
+  return tf.reverse(b, axis=[0])
+
 
 def from_importance_weights(
     target_action_log_probs, behaviour_action_log_probs,
     discounts, rewards, values, bootstrap_value,
     clip_rho_threshold=1.0, clip_pg_rho_threshold=1.0, lambda_=1.0,
-    is_weights_scale=1.0, name='vtrace_from_importance_weights', logger=None):
+    is_weights_scale=1.0, name='vtrace_from_importance_weights', logger=None,
+    implementation=None):
   r"""V-trace from log importance weights.
 
   Calculates V-trace actor critic targets as described in
@@ -75,6 +120,8 @@ def from_importance_weights(
     lambda_: Mix between 1-step (lambda_=0) and n-step (lambda_=1). See Remark 2
       in paper. Defaults to lambda_=1.
     name: The name scope that all V-trace operations will be created in.
+    implementation: One of IMPLEMENTATIONS, the way the backward recursion is
+      computed. Defaults to the --vtrace_implementation flag.
 
   Returns:
     A VTraceReturns namedtuple (vs, pg_advantages) where:
@@ -138,13 +185,11 @@ def from_importance_weights(
         [values[1:], tf.expand_dims(bootstrap_value, 0)], axis=0)
     deltas = clipped_rhos * (rewards + discounts * values_t_plus_1 - values)
 
-    acc = tf.zeros_like(bootstrap_value)
-    vs_minus_v_xs = []
-    for i in range(int(discounts.shape[0]) - 1, -1, -1):
-      discount, c, delta = discounts[i], cs[i], deltas[i]
-      acc = delta + discount * c * acc
-      vs_minus_v_xs.append(acc)
-    vs_minus_v_xs = vs_minus_v_xs[::-1]
+    if implementation is None:
+      implementation = FLAGS.vtrace_implementation
+    vs_minus_v_xs = _reverse_linear_scan(
+        tf.broadcast_to(discounts * cs, tf.shape(deltas)), deltas,
+        implementation)
 
     # Add V(x_s) to get v_s.
     vs = tf.add(vs_minus_v_xs, values, name='vs')
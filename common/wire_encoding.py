@@ -0,0 +1,250 @@
+# coding=utf-8
+# Copyright 2019 The SEED Authors
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Wire encodings of the observations sent by actors for inference.
+
+Actors encode observations with ObservationEncoder before calling the
+inference server, the server-side inference tf.function decodes them with
+ObservationDecoder. The server batches calls of several actors together, so
+every row of an encoded batch is self-contained: quantization scales are per
+environment and delta encoding is relative to the previous observation of the
+same environment, kept by the decoder.
+
+Only floating point observation leaves are encoded, other leaves are sent
+as is.
+"""
+
+import collections
+
+import numpy as np
+from seed_rl.common import utils
+import tensorflow as tf
+
+NONE = 'none'
+FP16 = 'fp16'
+UINT8 = 'uint8'
+ENCODINGS = (NONE, FP16, UINT8)
+
+# A leaf quantized to uint8, values are `offset + quantized * scale`.
+QuantizedLeaf = collections.namedtuple('QuantizedLeaf',
+                                       'quantized offset scale')
+
+# Observation encoded as a delta to the previous observation of the
+# environment, except for rows where `keyframe` is True.
+DeltaObservation = collections.namedtuple('DeltaObservation',
+                                          'observation keyframe')
+
+
+def _is_encoded(dtype):
+  return tf.as_dtype(dtype).is_floating
+
+
+def encoded_specs(observation_specs, encoding, delta):
+  """Returns the specs of observations encoded on the wire.
+
+  Args:
+    observation_specs: Structure of tf.TensorSpecs of a single observation.
+    encoding: One of ENCODINGS.
+    delta: Whether observations are delta encoded.
+
+  Returns:
+    A structure of tf.TensorSpecs of a single encoded observation.
+  """
+
+  def encode_spec(spec):
+    if not _is_encoded(spec.dtype):
+      return spec
+    if encoding == NONE:
+      # Deltas are computed in float32.
+      return tf.TensorSpec(spec.shape, tf.float32, spec.name) if delta else spec
+    if encoding == FP16:
+      return tf.TensorSpec(spec.shape, tf.float16, spec.name)
+    return QuantizedLeaf(
+        tf.TensorSpec(spec.shape, tf.uint8, spec.name),
+        tf.TensorSpec([], tf.float32, 'offset'),
+        tf.TensorSpec([], tf.float32, 'scale'))
+
+  specs = tf.nest.map_structure(encode_spec, observation_specs)
+  if delta:
+    specs = DeltaObservation(specs, tf.TensorSpec([], tf.bool, 'keyframe'))
+  return specs
+
+
+def _expand_as(x, leaf):
+  """Reshapes a [batch_size] vector to broadcast against `leaf`."""
+  return np.reshape(x, x.shape + (1,) * (leaf.ndim - 1))
+
+
+class ObservationEncoder(object):
+  """Encodes batches of observations of an actor (numpy)."""
+
+  def __init__(self, encoding, delta=False, keyframe_period=100):
+    """Creates an ObservationEncoder.
+
+    Args:
+      encoding: One of ENCODINGS.
+      delta: Whether to send observations as deltas to the previous
+        observation of the environment.
+      keyframe_period: With delta encoding, every environment sends its full
+        observation at least every `keyframe_period` steps. This bounds the
+        accumulation of quantization errors.
+    """
+    assert encoding in ENCODINGS, encoding
+    self.encoding = encoding
+    self.delta = delta
+    self.keyframe_period = keyframe_period
+    # Observations as reconstructed by the decoder, used as delta references.
+    self._reference = None
+    self._steps_since_keyframe = None
+
+  def _encode_leaf(self, leaf):
+    """Returns the encoded leaf and its float32 reconstruction."""
+    if self.encoding == FP16:
+      encoded = leaf.astype(np.float16)
+      return encoded, encoded.astype(np.float32)
+    if self.encoding == UINT8:
+      axes = tuple(range(1, leaf.ndim))
+      offset = np.min(leaf, axis=axes).astype(np.float32)
+      scale = ((np.max(leaf, axis=axes) - offset) / 255).astype(np.float32)
+      scale[scale == 0] = 1
+      quantized = np.clip(np.rint((leaf - _expand_as(offset, leaf)) /
+                                  _expand_as(scale, leaf)), 0, 255)
+      quantized = quantized.astype(np.uint8)
+      reconstructed = (quantized.astype(np.float32) * _expand_as(scale, leaf) +
+                       _expand_as(offset, leaf))
+      return QuantizedLeaf(quantized, offset, scale), reconstructed
+    # The leaf may be a view of the environment buffers, the reference must
+    # not change with them.
+    return leaf, leaf.copy()
+
+  def encode(self, observation, keyframe):
+    """Encodes a batch of observations.
+
+    Args:
+      observation: Structure of numpy arrays, batched along the first
+        dimension.
+      keyframe: Boolean [batch_size] array, True for environments whose
+        observation must not be delta encoded (typically the first observation
+        of an episode).
+
+    Returns:
+      The encoded observation, with a structure following `encoded_specs`.
+    """
+    flat = tf.nest.flatten(observation)
+    if self.delta:
+      keyframe = np.array(keyframe, np.bool)
+      if self._reference is None:
+        self._reference = [None] * len(flat)
+        self._steps_since_keyframe = np.zeros(len(keyframe), np.int32)
+        keyframe[:] = True
+      self._steps_since_keyframe += 1
+      keyframe |= self._steps_since_keyframe >= self.keyframe_period
+      self._steps_since_keyframe[keyframe] = 0
+
+    encoded = []
+    for i, leaf in enumerate(flat):
+      leaf = np.asarray(leaf)
+      if not _is_encoded(leaf.dtype) or (self.encoding == NONE and
+                                         not self.delta):
+        encoded.append(leaf)
+        continue
+      if self.delta and self._reference[i] is not None:
+        delta = leaf - self._reference[i]
+        leaf = np.where(_expand_as(keyframe, leaf), leaf, delta)
+      encoded_leaf, reconstructed = self._encode_leaf(
+          leaf.astype(np.float32, copy=False))
+      if self.delta:
+        if self._reference[i] is not None:
+          reconstructed = np.where(_expand_as(keyframe, leaf), reconstructed,
+                                   self._reference[i] + reconstructed)
+        self._reference[i] = reconstructed
+      encoded.append(encoded_leaf)
+    encoded = tf.nest.pack_sequence_as(observation, encoded)
+    if self.delta:
+      encoded = DeltaObservation(encoded, keyframe)
+    return encoded
+
+
+class ObservationDecoder(tf.Module):
+  """Decodes batches of encoded observations inside a tf.function."""
+
+  def __init__(self, num_envs, observation_specs, encoding, delta,
+               name='ObservationDecoder'):
+    """Creates an ObservationDecoder.
+
+    Args:
+      num_envs: int, number of environments.
+      observation_specs: Structure of tf.TensorSpecs of a single decoded
+        observation.
+      encoding: One of ENCODINGS.
+      delta: Whether observations are delta encoded.
+      name: Name of the scope for the operations.
+    """
+    super(ObservationDecoder, self).__init__(name=name)
+    assert encoding in ENCODINGS, encoding
+    self._observation_specs = observation_specs
+    self._encoding = encoding
+    self._delta = delta
+    if delta:
+      self._reference = utils.Aggregator(num_envs, [
+          tf.TensorSpec(spec.shape, tf.float32, spec.name)
+          for spec in tf.nest.flatten(observation_specs)
+          if _is_encoded(spec.dtype)], 'observation_references')
+
+  @tf.Module.with_name_scope
+  def __call__(self, env_ids, encoded):
+    """Returns the decoded observations.
+
+    Args:
+      env_ids: 1D tensor with the environment IDs of the observations.
+      encoded: Batch of encoded observations, as produced by
+        ObservationEncoder.encode.
+    """
+    if self._delta:
+      keyframe = encoded.keyframe
+      encoded = encoded.observation
+    flat_specs = tf.nest.flatten(self._observation_specs)
+    flat_encoded = iter(tf.nest.flatten(encoded))
+    decoded = []
+    for spec in flat_specs:
+      if not _is_encoded(spec.dtype):
+        decoded.append(next(flat_encoded))
+      elif self._encoding == UINT8:
+        leaf = QuantizedLeaf(next(flat_encoded), next(flat_encoded),
+                             next(flat_encoded))
+        shape = tf.concat([tf.shape(leaf.scale),
+                           tf.ones([spec.shape.rank], tf.int32)], axis=0)
+        decoded.append(
+            tf.cast(leaf.quantized, tf.float32) *
+            tf.reshape(leaf.scale, shape) + tf.reshape(leaf.offset, shape))
+      else:
+        decoded.append(tf.cast(next(flat_encoded), tf.float32))
+
+    if self._delta:
+      references = self._reference.read(env_ids)
+      i = 0
+      for j, spec in enumerate(flat_specs):
+        if not _is_encoded(spec.dtype):
+          continue
+        shape = tf.concat([tf.shape(keyframe),
+                           tf.ones([spec.shape.rank], tf.int32)], axis=0)
+        decoded[j] = tf.where(tf.reshape(keyframe, shape), decoded[j],
+                              references[i] + decoded[j])
+        i += 1
+      self._reference.replace(
+          env_ids, [d for d, spec in zip(decoded, flat_specs)
+                    if _is_encoded(spec.dtype)])
+
+    decoded = [tf.cast(d, spec.dtype) for d, spec in zip(decoded, flat_specs)]
+    return tf.nest.pack_sequence_as(self._observation_specs, decoded)
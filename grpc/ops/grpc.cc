@@ -11,6 +11,8 @@
 // See the License for the specific language governing permissions and
 // limitations under the License.
 
+#include <algorithm>
+#include <deque>
 #include <functional>
 #include <memory>
 #include <utility>
@@ -43,6 +45,7 @@
 #include "tensorflow/core/lib/core/status.h"
 #include "tensorflow/core/lib/core/threadpool.h"
 #include "tensorflow/core/lib/gtl/array_slice.h"
+#include "tensorflow/core/platform/env.h"
 #include "tensorflow/core/platform/protobuf.h"
 #include "tensorflow/core/protobuf/struct.pb.h"
 #include "tensorflow/core/util/batch_util.h"
@@ -80,9 +83,32 @@ REGISTER_OP("GrpcServerBind")
     .Attr("output_shapes: list(shape)")
     .Attr("output_specs: string")
     .Attr("first_bind: bool")
+    .Attr("batch_timeout_micros: int = 0")
     .SetShapeFn(shape_inference::NoOutputs)
     .Doc(R"doc(
 Binds a tf.function to a call.
+
+batch_timeout_micros: If positive, a batch that is not full this many
+  microseconds after its first element arrived is run with the elements
+  received so far. `fn` must then accept a dynamic batch dimension.
+)doc");
+
+REGISTER_OP("GrpcServerBatchStats")
+    .Input("handle: resource")
+    .Attr("fn_name: string")
+    .Output("batch_sizes: int32")
+    .Output("queueing_times: float")
+    .SetShapeFn([](shape_inference::InferenceContext* c) {
+      c->set_output(0, c->Vector(c->UnknownDim()));
+      c->set_output(1, c->Vector(c->UnknownDim()));
+      return Status::OK();
+    })
+    .Doc(R"doc(
+Returns and clears the statistics of the batches run for a bound function.
+
+batch_sizes: Number of elements in each batch.
+queueing_times: Time in seconds between the arrival of the first element of
+  each batch and the start of the computation.
 )doc");
 
 REGISTER_OP("GrpcServerStart")
@@ -134,6 +160,10 @@ class FnType {
 
   virtual void Shutdown() = 0;
 
+  // Moves the statistics of the batches run so far to the output vectors.
+  virtual void DrainBatchStats(std::vector<int32>* batch_sizes,
+                               std::vector<float>* queueing_times) {}
+
   virtual ~FnType() {}
 };
 
@@ -218,6 +248,19 @@ class TensorHandler final {
     }
   }
 
+  Status DrainBatchStats(const string& fn_name,
+                         std::vector<int32>* batch_sizes,
+                         std::vector<float>* queueing_times) {
+    auto it = fns_.find(fn_name);
+    if (it == fns_.end()) {
+      return errors::NotFound("Function ", fn_name, " not found");
+    }
+    for (auto& f : it->second.fn) {
+      f->DrainBatchStats(batch_sizes, queueing_times);
+    }
+    return Status::OK();
+  }
+
   bool is_bound() const { return !output_specs_list_.empty(); }
 
  private:
@@ -594,7 +637,7 @@ class DynamicFn : public FnType {
             DataTypeVector&& input_types,
             std::vector<TensorShape>&& input_shapes,
             std::vector<Tensor>&& captures, GrpcServerResource* resource,
-            thread::ThreadPool* tp, bool batched)
+            thread::ThreadPool* tp, bool batched, int64 batch_timeout_micros)
       : lib_(lib),
         f_handle_(f_handle),
         input_types_(std::move(input_types)),
@@ -602,8 +645,11 @@ class DynamicFn : public FnType {
         captures_(std::move(captures)),
         resource_(resource),
         batch_size_(batched ? input_shapes_[0].dim_size(0) : -1),
+        batch_timeout_micros_(batch_timeout_micros),
         tp_(tp),
-        mu_(new mutex()) {
+        mu_(new mutex()),
+        timeout_mu_(new mutex()),
+        destroyed_(new bool(false)) {
     if (batch_size_ != -1) {
       for (auto shape : input_shapes_) {
         shape.RemoveDim(0);
@@ -614,7 +660,14 @@ class DynamicFn : public FnType {
   }
 
   ~DynamicFn() {
+    {
+      // Waits for a batch timeout that is running, pending ones must not
+      // touch this object anymore.
+      mutex_lock lock(*timeout_mu_);
+      *destroyed_ = true;
+    }
     Shutdown();
+    mutex_lock lock(*mu_);
     delete current_computation_;
   }
 
@@ -640,6 +693,8 @@ class DynamicFn : public FnType {
 
     int64 index;
     Computation* computation = nullptr;
+    bool schedule_timeout = false;
+    int64 batch_id = 0;
     {
       mutex_lock lock(*mu_);
       CHECK(current_computation_);
@@ -651,17 +706,45 @@ class DynamicFn : public FnType {
       // in this case next_index_ can exceed batch_size_.
 
       CHECK_LE(next_index_, batch_size_) << "Learner-side batch size exceeded";
+      if (index == 0) {
+        computation->start_micros = Env::Default()->NowMicros();
+        schedule_timeout =
+            batch_timeout_micros_ > 0 && next_index_ < batch_size_;
+        batch_id = batch_id_;
+      }
       if (next_index_ == batch_size_) {
-        next_index_ = 0;
-        if (!empty_computations_.empty()) {
-          current_computation_ = empty_computations_.back();
-          empty_computations_.pop_back();
-        } else {
-          current_computation_ = BuildEmptyComputation();
-        }
+        NextComputationLocked();
       }
     }
 
+    if (schedule_timeout) {
+      // Runs the batch with the elements received so far if it is still
+      // being filled when the timeout expires.
+      // The closure only holds the shared timeout_mu_ and destroyed_, and
+      // keeps timeout_mu_ locked until the batch is launched so this object
+      // can't be deleted in between.
+      auto timeout_mu = timeout_mu_;
+      auto destroyed = destroyed_;
+      Env::Default()->SchedClosureAfter(
+          batch_timeout_micros_, [this, timeout_mu, destroyed, batch_id]() {
+            mutex_lock timeout_lock(*timeout_mu);
+            if (*destroyed) {
+              return;
+            }
+            Computation* partial = nullptr;
+            {
+              mutex_lock lock(*mu_);
+              if (batch_id != batch_id_ || next_index_ == 0) {
+                return;
+              }
+              partial = current_computation_;
+              partial->size = next_index_;
+              NextComputationLocked();
+            }
+            MaybeRun(partial);
+          });
+    }
+
     // Copy input tensors to the batched input tensors.
     if (!args_batched) {
       for (unsigned int i = 0; i < args.size(); ++i) {
@@ -669,6 +752,7 @@ class DynamicFn : public FnType {
             args[i], &computation->request[i], index));
       }
     } else {
+      computation->args_batched = true;
       for (unsigned int i = 0; i < args.size(); ++i) {
         TF_CHECK_OK(batch_util::CopyContiguousSlices(
             args[i], 0, index, arg_batch_size, &computation->request[i]));
@@ -678,94 +762,8 @@ class DynamicFn : public FnType {
     // Populate the callback for the last slice in the batch.
     computation->callbacks[index + slice_count - 1] = callback;
 
-    int num_ready = computation->num_ready += slice_count;
-    if (num_ready == batch_size_) {
-      // A full batch have been filled up, so the function should be executed.
-      FunctionLibraryRuntime::Options f_opts;
-      f_opts.create_rendezvous = true;
-      std::shared_ptr<CancellationManager> c_mgr = nullptr;
-      std::shared_ptr<std::function<void()>> deregister_fn = nullptr;
-      auto status =
-          resource_->create_child_cancellation_manager(&c_mgr, &deregister_fn);
-      CHECK(status.ok());
-      f_opts.cancellation_manager = c_mgr.get();
-      auto f_callback = [this, deregister_fn, computation, c_mgr,
-                         args_batched](Status f_status) {
-        (*deregister_fn)();
-        if (f_status.ok()) {
-          for (unsigned int i = 0; i < computation->outputs.size(); ++i) {
-            const auto& shape = computation->outputs[i].shape();
-            if (shape.dims() <= 0) {
-              f_status = errors::InvalidArgument(
-                  "Output must be at least rank 1 when batching is enabled");
-              break;
-            }
-
-            if (input_shapes_[0].dim_size(0) != shape.dim_size(0)) {
-              f_status = errors::InvalidArgument(
-                  "All outputs must have the same batch size "
-                  "as the inputs when batching is enabled, expected: ",
-                  input_shapes_[0].dim_size(0), " was: ", shape.dim_size(0));
-              break;
-            }
-          }
-        }
-
-        // Parallel call all callbacks with their slice of outputs in.
-        // Make sure computation is freed once callbacks are done.
-        std::shared_ptr<Computation> done_computation;
-        done_computation.reset(computation);
-        int prev_batch_limit = -1;
-        std::vector<std::pair<int, int>> batch_bounds;
-        for (int j = 0; j < batch_size_; j++) {
-          if (!computation->callbacks[j]) continue;
-          batch_bounds.push_back(std::make_pair(prev_batch_limit + 1, j + 1));
-          prev_batch_limit = j;
-        }
-
-        const int work_unit_size =
-            (batch_bounds.size() + workers_thread_pools - 1) /
-            workers_thread_pools;
-        for (int j = 0; j < batch_bounds.size(); j += work_unit_size) {
-          const int limit =
-              std::min<int>(j + work_unit_size, batch_bounds.size());
-          tp_->Schedule([j, done_computation, f_status, limit, batch_bounds,
-                         args_batched]() {
-            for (int x = j; x < limit; x++) {
-              const int batch_start = batch_bounds[x].first;
-              const int batch_limit = batch_bounds[x].second;
-              std::vector<Tensor> rets;
-              if (f_status.ok()) {
-                rets.reserve(done_computation->outputs.size());
-                // Pass the slice of the batched outputs to the return vector.
-                for (unsigned int i = 0; i < done_computation->outputs.size();
-                     ++i) {
-                  if (args_batched) {
-                    rets.push_back(done_computation->outputs[i].Slice(
-                        batch_start, batch_limit));
-                  } else {
-                    rets.push_back(
-                        done_computation->outputs[i].SubSlice(batch_start));
-                  }
-                }
-              }
-              // Callbacks are populated for the last slice in the batch.
-              done_computation->callbacks[batch_limit - 1](f_status, rets);
-            }
-          });
-        }
-      };
-      lib_->Run(f_opts, f_handle_, computation->request, &computation->outputs,
-                f_callback);
-      // Refill empty_computations_.
-      Computation* refill_comp = BuildEmptyComputation();
-      {
-        mutex_lock lock(*mu_);
-        empty_computations_.push_back(refill_comp);
-      }
-      return true;
-    }
-    return false;
+    computation->num_ready += slice_count;
+    return MaybeRun(computation);
   }
 
   void Shutdown() override {
@@ -779,6 +777,9 @@ class DynamicFn : public FnType {
       }
       delete current_computation_;
       current_computation_ = BuildEmptyComputation();
+      next_index_ = 0;
+      // Invalidates the pending timeout of the cancelled batch.
+      ++batch_id_;
     }
     for (auto c : empty_computations_) {
       delete c;
@@ -786,15 +787,158 @@ class DynamicFn : public FnType {
     empty_computations_.clear();
   }
 
+  void DrainBatchStats(std::vector<int32>* batch_sizes,
+                       std::vector<float>* queueing_times) override {
+    mutex_lock lock(*mu_);
+    for (const auto& stats : batch_stats_) {
+      batch_sizes->push_back(stats.first);
+      queueing_times->push_back(stats.second);
+    }
+    batch_stats_.clear();
+  }
+
  private:
+  // Maximal number of batch statistics kept between two DrainBatchStats calls.
+  static constexpr int kMaxBatchStats = 10000;
+
   // Represents one batched computation.
   struct Computation {
     std::vector<Tensor> request;
     std::vector<Tensor> outputs;
     std::vector<std::function<void(Status, std::vector<Tensor>)>> callbacks;
     std::atomic_int num_ready{0};
+    // Number of elements the computation runs on. Lowered from the batch size
+    // when the batch timeout expires.
+    std::atomic_int size{0};
+    std::atomic<bool> launched{false};
+    std::atomic<bool> args_batched{false};
+    uint64 start_micros = 0;
   };
 
+  // Makes a new computation current. Must be called with mu_ held.
+  void NextComputationLocked() {
+    next_index_ = 0;
+    ++batch_id_;
+    if (!empty_computations_.empty()) {
+      current_computation_ = empty_computations_.back();
+      empty_computations_.pop_back();
+    } else {
+      current_computation_ = BuildEmptyComputation();
+    }
+  }
+
+  // Runs the computation if all its elements have been copied. Both the last
+  // copying call and the batch timeout can get here, only one of them runs it.
+  bool MaybeRun(Computation* computation) {
+    if (computation->num_ready != computation->size ||
+        computation->launched.exchange(true)) {
+      return false;
+    }
+    Run(computation);
+    return true;
+  }
+
+  void Run(Computation* computation) {
+    const int size = computation->size;
+    const bool args_batched = computation->args_batched;
+    if (size < batch_size_) {
+      // Partial batch: the function is run on the filled prefix of the
+      // requests. Slices starting at 0 share the buffers and stay aligned.
+      for (unsigned int i = 0; i < input_types_.size(); ++i) {
+        computation->request[i] = computation->request[i].Slice(0, size);
+      }
+    }
+    const float queueing_time =
+        (Env::Default()->NowMicros() - computation->start_micros) / 1e6;
+
+    FunctionLibraryRuntime::Options f_opts;
+    f_opts.create_rendezvous = true;
+    std::shared_ptr<CancellationManager> c_mgr = nullptr;
+    std::shared_ptr<std::function<void()>> deregister_fn = nullptr;
+    auto status =
+        resource_->create_child_cancellation_manager(&c_mgr, &deregister_fn);
+    CHECK(status.ok());
+    f_opts.cancellation_manager = c_mgr.get();
+    auto f_callback = [this, deregister_fn, computation, c_mgr, size,
+                       args_batched](Status f_status) {
+      (*deregister_fn)();
+      if (f_status.ok()) {
+        for (unsigned int i = 0; i < computation->outputs.size(); ++i) {
+          const auto& shape = computation->outputs[i].shape();
+          if (shape.dims() <= 0) {
+            f_status = errors::InvalidArgument(
+                "Output must be at least rank 1 when batching is enabled");
+            break;
+          }
+
+          if (size != shape.dim_size(0)) {
+            f_status = errors::InvalidArgument(
+                "All outputs must have the same batch size "
+                "as the inputs when batching is enabled, expected: ",
+                size, " was: ", shape.dim_size(0));
+            break;
+          }
+        }
+      }
+
+      // Parallel call all callbacks with their slice of outputs in.
+      // Make sure computation is freed once callbacks are done.
+      std::shared_ptr<Computation> done_computation;
+      done_computation.reset(computation);
+      int prev_batch_limit = -1;
+      std::vector<std::pair<int, int>> batch_bounds;
+      for (int j = 0; j < size; j++) {
+        if (!computation->callbacks[j]) continue;
+        batch_bounds.push_back(std::make_pair(prev_batch_limit + 1, j + 1));
+        prev_batch_limit = j;
+      }
+
+      const int work_unit_size =
+          (batch_bounds.size() + workers_thread_pools - 1) /
+          workers_thread_pools;
+      for (int j = 0; j < batch_bounds.size(); j += work_unit_size) {
+        const int limit =
+            std::min<int>(j + work_unit_size, batch_bounds.size());
+        tp_->Schedule([j, done_computation, f_status, limit, batch_bounds,
+                       args_batched]() {
+          for (int x = j; x < limit; x++) {
+            const int batch_start = batch_bounds[x].first;
+            const int batch_limit = batch_bounds[x].second;
+            std::vector<Tensor> rets;
+            if (f_status.ok()) {
+              rets.reserve(done_computation->outputs.size());
+              // Pass the slice of the batched outputs to the return vector.
+              for (unsigned int i = 0; i < done_computation->outputs.size();
+                   ++i) {
+                if (args_batched) {
+                  rets.push_back(done_computation->outputs[i].Slice(
+                      batch_start, batch_limit));
+                } else {
+                  rets.push_back(
+                      done_computation->outputs[i].SubSlice(batch_start));
+                }
+              }
+            }
+            // Callbacks are populated for the last slice in the batch.
+            done_computation->callbacks[batch_limit - 1](f_status, rets);
+          }
+        });
+      }
+    };
+    lib_->Run(f_opts, f_handle_, computation->request, &computation->outputs,
+              f_callback);
+    // Refill empty_computations_.
+    Computation* refill_comp = BuildEmptyComputation();
+    {
+      mutex_lock lock(*mu_);
+      empty_computations_.push_back(refill_comp);
+      if (batch_stats_.size() >= kMaxBatchStats) {
+        batch_stats_.pop_front();
+      }
+      batch_stats_.emplace_back(size, queueing_time);
+    }
+  }
+
   bool DirectCall(ServerContext* server_ctx, gtl::ArraySlice<Tensor> args,
     std::function<void(Status, std::vector<Tensor>)> callback) {
     Status status = verify_args(input_types_, input_shapes_,
@@ -839,6 +983,7 @@ class DynamicFn : public FnType {
       c->request.push_back(t);
     }
     c->callbacks.resize(batch_size_);
+    c->size = batch_size_;
     return c;
   }
 
@@ -851,13 +996,25 @@ class DynamicFn : public FnType {
   const std::vector<Tensor> captures_;
   GrpcServerResource* resource_;
   const int32 batch_size_;
+  // Maximal time a batch waits to be filled, 0 waits for a full batch.
+  const int64 batch_timeout_micros_;
 
   // HACK: A shared_ptr to make type copyable for std::function.
   thread::ThreadPool* tp_;
   std::shared_ptr<mutex> mu_;
+  // Shared with the pending batch timeouts. A timeout holds timeout_mu_ from
+  // its destroyed_ check until its partial batch is launched, and destroyed_
+  // is set under timeout_mu_ once this object is being deleted. Acquired
+  // before mu_.
+  std::shared_ptr<mutex> timeout_mu_;
+  std::shared_ptr<bool> destroyed_ ABSL_GUARDED_BY(timeout_mu_);
   int64 next_index_ ABSL_GUARDED_BY(mu_) = 0;
+  // Identifies current_computation_, used to match batch timeouts.
+  int64 batch_id_ ABSL_GUARDED_BY(mu_) = 0;
   std::vector<Computation*> empty_computations_ ABSL_GUARDED_BY(mu_);
   Computation* current_computation_ ABSL_GUARDED_BY(mu_) = nullptr;
+  // (batch size, queueing time in seconds) of the batches run.
+  std::deque<std::pair<int32, float>> batch_stats_ ABSL_GUARDED_BY(mu_);
 };
 
 class GrpcServerBindOp : public OpKernel {
@@ -877,6 +1034,8 @@ class GrpcServerBindOp : public OpKernel {
                     output_spec_string));
 
     OP_REQUIRES_OK(ctx, ctx->GetAttr("first_bind", &first_bind_));
+    OP_REQUIRES_OK(ctx,
+                   ctx->GetAttr("batch_timeout_micros", &batch_timeout_micros_));
     batched_ = CanBatch(output_shapes);
   }
 
@@ -940,7 +1099,8 @@ class GrpcServerBindOp : public OpKernel {
     std::unique_ptr<FnType> func;
     func.reset(static_cast<FnType*>(new DynamicFn(
         lib, f_handle, std::move(input_types), std::move(input_shapes_),
-        std::move(captures), resource, resource->func_tp.get(), batched_)));
+        std::move(captures), resource, resource->func_tp.get(), batched_,
+        batch_timeout_micros_)));
     OP_REQUIRES_OK(ctx, resource->tensor_handler()->Bind(
         fn_name_, output_specs_, std::move(func), first_bind_));
   }
@@ -977,6 +1137,7 @@ class GrpcServerBindOp : public OpKernel {
   tensorflow::StructuredValue output_specs_;
   bool batched_;
   bool first_bind_;
+  int64 batch_timeout_micros_;
 
   TF_DISALLOW_COPY_AND_ASSIGN(GrpcServerBindOp);
 };
@@ -1022,6 +1183,47 @@ class GrpcServerShutdownOp : public OpKernel {
 REGISTER_KERNEL_BUILDER(Name("GrpcServerShutdown").Device(DEVICE_CPU),
                         GrpcServerShutdownOp);
 
+class GrpcServerBatchStatsOp : public OpKernel {
+ public:
+  explicit GrpcServerBatchStatsOp(OpKernelConstruction* ctx) : OpKernel(ctx) {
+    OP_REQUIRES_OK(ctx, ctx->GetAttr("fn_name", &fn_name_));
+  }
+
+  void Compute(OpKernelContext* ctx) override {
+    GrpcServerResource* resource;
+    OP_REQUIRES_OK(ctx,
+                   LookupResource(ctx, HandleFromInput(ctx, 0), &resource));
+    core::ScopedUnref scoped_unref(resource);
+    std::vector<int32> batch_sizes;
+    std::vector<float> queueing_times;
+    OP_REQUIRES_OK(ctx, resource->tensor_handler()->DrainBatchStats(
+                            fn_name_, &batch_sizes, &queueing_times));
+
+    Tensor* batch_sizes_t;
+    OP_REQUIRES_OK(ctx, ctx->allocate_output(
+                            0, TensorShape({static_cast<int64>(
+                                   batch_sizes.size())}),
+                            &batch_sizes_t));
+    Tensor* queueing_times_t;
+    OP_REQUIRES_OK(ctx, ctx->allocate_output(
+                            1, TensorShape({static_cast<int64>(
+                                   queueing_times.size())}),
+                            &queueing_times_t));
+    std::copy(batch_sizes.begin(), batch_sizes.end(),
+              batch_sizes_t->vec<int32>().data());
+    std::copy(queueing_times.begin(), queueing_times.end(),
+              queueing_times_t->vec<float>().data());
+  }
+
+ private:
+  string fn_name_;
+
+  TF_DISALLOW_COPY_AND_ASSIGN(GrpcServerBatchStatsOp);
+};
+
+REGISTER_KERNEL_BUILDER(Name("GrpcServerBatchStats").Device(DEVICE_CPU),
+                        GrpcServerBatchStatsOp);
+
 class GrpcClientResource : public ResourceBase {
  public:
   typedef grpc::ClientReaderWriter<seed_rl::CallRequest, seed_rl::CallResponse>
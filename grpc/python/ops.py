@@ -33,6 +33,16 @@ from tensorflow.python.ops import resource_variable_ops
 from tensorflow.python.saved_model import nested_structure_coder
 
 
+def _is_batched(input_shapes):
+  """Whether the server batches calls for these input shapes."""
+  return all(shape.rank and shape[0] == input_shapes[0][0]
+             for shape in input_shapes)
+
+
+def _without_batch_size(spec):
+  return tf.TensorSpec([None] + spec.shape[1:].as_list(), spec.dtype,
+                       spec.name)
+
 
 class Server(object):
   """A TensorFlow gRPC server."""
@@ -58,7 +68,7 @@ class Server(object):
     # from being deallocated.
     self._keep_alive = []
 
-  def bind(self, fn):
+  def bind(self, fn, batch_timeout_ms=0):
     """Binds a tf.function to the server.
 
      If the first dimension of all
@@ -69,10 +79,17 @@ class Server(object):
      If the signature of parameters provided by the client matches
      `input_signature`, `fn` is executed immediatelly without batching.
 
+     With a positive `batch_timeout_ms`, a batch that is still not full that
+     many milliseconds after its first call arrived is run with the calls
+     received so far. `fn` is then traced with a dynamic batch dimension, so
+     it must support batches smaller than N.
+
     Args:
       fn: The @tf.function wrapped function or a list of such functions, with
         `input_signature` set. When a list of functions is provided,
         they are called in a round-robin manner.
+      batch_timeout_ms: Maximal time in milliseconds a batch waits to be
+        filled. 0 waits for full batches.
 
     Returns:
       A tf.Operation.
@@ -87,10 +104,13 @@ class Server(object):
       self._keep_alive.append(f.python_function)
 
       fn_name = f.__name__
+      input_shapes = [t.shape for t in tf.nest.flatten(f.input_signature)]
+      if batch_timeout_ms > 0 and _is_batched(input_shapes):
+        f = tf.function(
+            f.python_function,
+            input_signature=tf.nest.map_structure(_without_batch_size,
+                                                  f.input_signature))
       f = f.get_concrete_function()
-      input_shapes = [
-          t.shape for t in tf.nest.flatten(f.structured_input_signature)
-      ]
       if f.structured_outputs is None:
         output_specs = None
       else:
@@ -106,7 +126,21 @@ class Server(object):
           first_bind=(i == 0),
           input_shapes=input_shapes,
           output_shapes=tf.nest.flatten(f.output_shapes),
-          output_specs=output_specs_proto.SerializeToString())
+          output_specs=output_specs_proto.SerializeToString(),
+          batch_timeout_micros=int(batch_timeout_ms * 1000))
+
+  def batch_stats(self, fn_name):
+    """Returns and clears the statistics of the batches run for `fn_name`.
+
+    Args:
+      fn_name: Name of the bound function.
+
+    Returns:
+      A tuple of two vectors: the number of calls in each batch and the time in
+      seconds each batch waited to be filled.
+    """
+    return gen_grpc_ops.grpc_server_batch_stats(
+        handle=self._handle, fn_name=fn_name)
 
   def start(self):
     return gen_grpc_ops.grpc_server_start(handle=self._handle)
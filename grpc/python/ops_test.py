@@ -798,6 +798,28 @@ class OpsTest(tf.test.TestCase, parameterized.TestCase):
 
     server.shutdown()
 
+  def test_batch_timeout(self):
+    address = self.get_unix_address()
+    server = ops.Server([address])
+
+    @tf.function(input_signature=[tf.TensorSpec([4], tf.int32)])
+    def foo(x):
+      return x + 1
+
+    server.bind(foo, batch_timeout_ms=100)
+    server.start()
+
+    client = ops.Client(address)
+    # Only 3 of the 4 calls of a batch arrive, they are run after the timeout.
+    with futures.ThreadPoolExecutor(max_workers=3) as executor:
+      fs = [executor.submit(client.foo, i) for i in range(3)]
+      self.assertCountEqual([1, 2, 3], [f.result() for f in fs])
+
+    batch_sizes, queueing_times = server.batch_stats('foo')
+    self.assertAllEqual([3], batch_sizes)
+    self.assertGreaterEqual(queueing_times[0], 0.1)
+    server.shutdown()
+
 
 if __name__ == '__main__':
   tf.test.main()
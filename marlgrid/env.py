@@ -20,6 +20,7 @@ from absl import logging
 
 import gym
 from marlgrid.agents import GridAgentInterface
+import numpy as np
 from seed_rl.common import common_flags
 from seed_rl.common import env_wrappers
 from seed_rl.marlgrid import observation
@@ -28,9 +29,28 @@ from marlgrid import envs
 from gym.envs.registration import register as gym_register
 
 from marlgrid.envs import CollectorMultiGrid
+from marlgrid.envs import VectorCollectorMultiGrid
 
 this_module = sys.modules[__name__]
 
+FLAGS = flags.FLAGS
+
+# Normalization of image observations, x * OBSERVATION_SCALE.
+OBSERVATION_SCALE = 1 / 255.
+
+flags.DEFINE_enum('observation_style', 'image', ['image', 'symbolic'],
+                  'Whether agents observe rendered RGB tiles or the uint8 '
+                  '(type, color, state) encoding of the cells in view.')
+flags.DEFINE_bool('raw_observations', False,
+                  'Whether actors send image observations as rendered uint8 '
+                  'RGB tiles, normalized by the agent network on the learner, '
+                  'instead of normalized float32 observations (4x larger on '
+                  'the wire and in the learner buffers).')
+flags.DEFINE_bool('vectorized_env', False,
+                  'Whether actors step their whole environment batch with '
+                  'VectorCollectorMultiGrid instead of one CollectorMultiGrid '
+                  'per environment.')
+
 
 def register_marl_env(
         env_name,
@@ -41,6 +61,7 @@ def register_marl_env(
         view_tile_size=1,
         view_offset=0,
         agent_color=None,
+        observation_style='image',
         env_kwargs={},
 ):
   colors = ["red", "blue", "purple", "orange", "olive", "pink"]
@@ -57,6 +78,7 @@ def register_marl_env(
             view_size=view_size,
             view_tile_size=view_tile_size,
             view_offset=view_offset,
+            observation_style=observation_style,
           )
           for c in colors[:n_agents]
         ],
@@ -84,11 +106,40 @@ def create_environment(_):
     grid_size=15,
     view_size=7,
     view_tile_size=1,
+    observation_style=FLAGS.observation_style,
     env_kwargs={'clutter_density': 0.15, 'n_random_bonuses': 6, 'fixed_players': True}
   )
 
   # task = 'LunarLander-v2'
   logging.info('Creating environment: %s', task)
   env = gym.make(task)
-  normalization = lambda x: x / 255.
+  if FLAGS.observation_style == 'symbolic' or FLAGS.raw_observations:
+    # Symbolic observations are embedded, raw ones normalized by the agent
+    # network.
+    return env_wrappers.MultiWrapper(env, dtype=np.uint8)
+  normalization = lambda x: x * OBSERVATION_SCALE
   return env_wrappers.MultiWrapper(env, normalization=normalization)
+
+
+def create_batched_environment(batch_size, id_offset):
+  """Returns VectorCollectorMultiGrid worlds matching create_environment."""
+  logging.info('Creating %d vectorized collector environments', batch_size)
+  if FLAGS.observation_style == 'symbolic' or FLAGS.raw_observations:
+    normalization, dtype = None, np.uint8
+  else:
+    normalization, dtype = (lambda x: x * OBSERVATION_SCALE), np.float32
+  return VectorCollectorMultiGrid(
+      batch_size,
+      n_agents=3,
+      grid_size=15,
+      view_size=7,
+      observation_style=FLAGS.observation_style,
+      clutter_density=0.15,
+      n_random_bonuses=6,
+      fixed_players=True,
+      # A fresh seed per actor run, logged with the episodes like the SMAC
+      # ones. id_offset alone would replay the same worlds on every restart.
+      seed=np.random.randint(np.iinfo(np.int32).max),
+      id_offset=id_offset,
+      normalization=normalization,
+      dtype=dtype)
@@ -82,13 +82,42 @@ class SimpleNetwork(tf.Module):
     return x
 
 
+class SymbolicEmbedding(tf.Module):
+  """Embeds uint8 (type, color, state) grid encodings.
+
+  Each of the three channels has its own table of 256 entries, looked up with a
+  single gather; the embeddings of a cell are concatenated.
+  """
+
+  def __init__(self, embedding_dim=8):
+    super(SymbolicEmbedding, self).__init__(name='symbolic_embedding')
+    self._embedding_dim = embedding_dim
+    self._embedding = tf.keras.layers.Embedding(3 * 256, embedding_dim)
+
+  def __call__(self, grid):
+    ids = tf.cast(grid, tf.int32) + tf.constant([0, 256, 512])
+    embedded = self._embedding(ids)
+    return tf.reshape(embedded, tf.concat(
+        [tf.shape(grid)[:-1], [3 * self._embedding_dim]], axis=0))
+
+
 class GFootball(tf.Module):
   """Agent with ResNet, but without LSTM and additional inputs.
 
   Four blocks instead of three in ImpalaAtariDeep.
   """
 
-  def __init__(self, parametric_action_distribution):
+  def __init__(self, parametric_action_distribution, symbolic=False,
+               observation_scale=None):
+    """Creates the agent.
+
+    Args:
+      parametric_action_distribution: Distribution of the actions of all the
+        agents.
+      symbolic: Whether observations are uint8 symbolic encodings to embed.
+      observation_scale: If set, observations are raw (typically uint8) and are
+        multiplied by this scale in the network.
+    """
     super(GFootball, self).__init__(name='gfootball')
 
     # Parameters and layers for unroll.
@@ -97,6 +126,9 @@ class GFootball(tf.Module):
 
     self.actor = SimpleNetwork()
     self.critic = SimpleNetwork()
+    # Symbolic observations are embedded, image ones are used as is.
+    self._embedding = SymbolicEmbedding() if symbolic else None
+    self._observation_scale = observation_scale
 
     self.final_flatten = tf.keras.layers.Flatten()
 
@@ -113,6 +145,10 @@ class GFootball(tf.Module):
 
   def _torso(self, unused_prev_action, env_output):
     _, _, frame, _, _ = env_output
+    if self._embedding is not None:
+      frame = self._embedding(frame)
+    elif self._observation_scale is not None:
+      frame = tf.cast(frame, tf.float32) * self._observation_scale
     # print('frame', frame.shape)
     # print('single frame', frame[:, 0])
 
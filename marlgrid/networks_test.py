@@ -0,0 +1,92 @@
+# coding=utf-8
+# Copyright 2019 The SEED Authors
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for networks.py."""
+
+from absl import flags
+from absl.testing import flagsaver
+from absl.testing import parameterized
+import numpy as np
+from seed_rl.agents.vtrace import learner
+from seed_rl.common import parametric_distribution
+from seed_rl.common import utils
+from seed_rl.marlgrid import env
+from seed_rl.marlgrid import vtrace_main
+import tensorflow as tf
+
+FLAGS = flags.FLAGS
+
+UNROLL_LENGTH = 4
+
+
+class LearnerLossTest(tf.test.TestCase, parameterized.TestCase):
+
+  def setUp(self):
+    super(LearnerLossTest, self).setUp()
+    FLAGS.mark_as_parsed()
+
+  def _unroll(self, environment):
+    """Returns [T, 1] rewards, dones and observations of random actions."""
+    rewards, dones, observations = [], [], [environment.reset()]
+    for _ in range(UNROLL_LENGTH - 1):
+      observation, reward, done, _ = environment.step(
+          environment.action_space.sample())
+      rewards.append(reward)
+      dones.append(done)
+      observations.append(observation)
+    add_batch = lambda x: np.array(x)[:, None]
+    return (add_batch([0.] + rewards).astype(np.float32),
+            add_batch([False] + dones), add_batch(observations))
+
+  @parameterized.parameters(
+      ('image', True, 255),
+      ('image', False, 1),
+      ('symbolic', False, None),
+  )
+  def test_compute_loss(self, observation_style, raw_observations,
+                        max_input_abs):
+    with flagsaver.flagsaver(observation_style=observation_style,
+                             raw_observations=raw_observations):
+      environment = env.create_environment(0)
+      distribution = (
+          parametric_distribution.get_parametric_distribution_for_action_space(
+              environment.action_space))
+      agent = vtrace_main.create_agent(None, None, distribution)
+      # Set up by learner_loop.
+      agent.entropy_cost = lambda: tf.constant(FLAGS.entropy_cost)
+      reward, done, observation = self._unroll(environment)
+      self.assertEqual(
+          np.uint8 if raw_observations or observation_style == 'symbolic'
+          else np.float32, observation.dtype)
+      env_outputs = utils.EnvOutput(
+          reward=tf.constant(reward), done=tf.constant(done),
+          observation=tf.constant(observation),
+          abandoned=tf.zeros_like(done),
+          episode_step=tf.zeros(reward.shape, tf.int32))
+      prev_actions = tf.zeros(
+          reward.shape + environment.action_space.shape, tf.int32)
+      agent_outputs, _ = agent(prev_actions, env_outputs, (), unroll=True,
+                               is_training=True, postprocess_action=False)
+      logger = utils.ProgressLogger()
+      loss, session = learner.compute_loss(
+          logger, distribution, agent, (), prev_actions, env_outputs,
+          agent_outputs)
+      logs = dict(zip(logger.log_keys, session))
+      self.assertTrue(np.isfinite(loss))
+      if max_input_abs is not None:
+        self.assertAllClose(max_input_abs, logs['policy/max_input_abs'])
+
+
+if __name__ == '__main__':
+  tf.test.main()
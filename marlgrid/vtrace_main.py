@@ -36,7 +36,11 @@ flags.DEFINE_float('learning_rate', 0.005, 'Learning rate.')
 
 def create_agent(unused_action_space, unused_env_observation_space,
                  parametric_action_distribution):
-  return networks.GFootball(parametric_action_distribution)
+  return networks.GFootball(
+      parametric_action_distribution,
+      symbolic=FLAGS.observation_style == 'symbolic',
+      observation_scale=(env.OBSERVATION_SCALE if FLAGS.raw_observations
+                         else None))
 
 
 def create_optimizer(unused_final_iteration):
@@ -49,7 +53,9 @@ def main(argv):
   if len(argv) > 1:
     raise app.UsageError('Too many command-line arguments.')
   if FLAGS.run_mode == 'actor':
-    actor.actor_loop(env.create_environment)
+    actor.actor_loop(
+        env.create_environment,
+        env.create_batched_environment if FLAGS.vectorized_env else None)
   elif FLAGS.run_mode == 'learner':
     learner.learner_loop(env.create_environment,
                          create_agent,
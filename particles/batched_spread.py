@@ -0,0 +1,198 @@
+# coding=utf-8
+# Copyright 2019 The SEED Authors
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Batched numpy implementation of the simple_spread particle environment."""
+
+import numpy as np
+
+# Constants of multiagent.core.World and of the simple_spread scenario.
+DIM_P = 2
+DIM_C = 2
+DT = 0.1
+DAMPING = 0.25
+CONTACT_FORCE = 1e2
+CONTACT_MARGIN = 1e-3
+AGENT_SIZE = 0.15
+LANDMARK_SIZE = 0.05
+ACCEL = 5.0
+
+AGENT_COLOR = (89, 89, 217)
+LANDMARK_COLOR = (64, 64, 64)
+
+
+class BatchedSimpleSpread(object):
+  """A batch of simple_spread worlds, stepped together with array operations.
+
+  Positions and velocities of the agents and landmarks of all the worlds are
+  kept in [batch_size, num_entities, 2] arrays, and forces, collisions,
+  rewards and observations are computed for the whole batch at once instead of
+  per entity.
+
+  The class has the interface of env_wrappers.BatchedEnvironment, and matches
+  a batch of ParticleWrapper(MultiAgentEnv(simple_spread)): actions are the
+  concatenated binary movement vectors of the agents, observations stack the
+  observations of all the agents, the reward is the shared reward divided by
+  100, and episodes end after `step_limit` steps.
+
+  Observations are written to a preallocated buffer and returned as views of
+  it, so they are only valid until the next call to step(), reset() or
+  reset_if_done().
+  """
+
+  def __init__(self, batch_size, id_offset, num_agents=3, num_landmarks=3,
+               step_limit=25, seed=None):
+    """Creates the worlds.
+
+    Args:
+      batch_size: The number of worlds.
+      id_offset: The offset for environment ids. Worlds receive sequential ids
+        starting from this offset.
+      num_agents: Number of agents of each world.
+      num_landmarks: Number of landmarks of each world.
+      step_limit: Length of the episodes.
+      seed: Seed of the random positions of the worlds.
+    """
+    self._batch_size = batch_size
+    self._env_ids = np.arange(id_offset, id_offset + batch_size,
+                              dtype=np.int32)
+    self.num_agents = num_agents
+    self.num_landmarks = num_landmarks
+    self.step_limit = step_limit
+    self._random = np.random.RandomState(seed)
+
+    self.agent_pos = np.zeros((batch_size, num_agents, DIM_P))
+    self.agent_vel = np.zeros((batch_size, num_agents, DIM_P))
+    self.landmark_pos = np.zeros((batch_size, num_landmarks, DIM_P))
+    self.n_step = np.zeros(batch_size, np.int32)
+
+    # others[i] are the indices of the agents other than i, in order.
+    self._others = np.array([[j for j in range(num_agents) if j != i]
+                             for i in range(num_agents)], np.int32)
+    # Velocity, position, landmarks, other agents and their (silent)
+    # communication.
+    self.observation_dim = (2 * DIM_P + num_landmarks * DIM_P +
+                            (num_agents - 1) * (DIM_P + DIM_C))
+    self._obs = np.zeros((batch_size, num_agents, self.observation_dim),
+                         np.float32)
+
+  @property
+  def env_ids(self):
+    return self._env_ids
+
+  def _reset_worlds(self, index):
+    n = len(index)
+    self.agent_pos[index] = self._random.uniform(
+        -1, +1, (n, self.num_agents, DIM_P))
+    self.agent_vel[index] = 0
+    self.landmark_pos[index] = self._random.uniform(
+        -1, +1, (n, self.num_landmarks, DIM_P))
+    self.n_step[index] = 0
+
+  def _agent_distances(self):
+    """Returns the [batch_size, agent, other agent] deltas and distances."""
+    delta = self.agent_pos[:, :, None] - self.agent_pos[:, None, :]
+    return delta, np.sqrt(np.sum(np.square(delta), axis=-1))
+
+  def _write_observations(self):
+    pos = self.agent_pos
+    obs = self._obs
+    o = 0
+    obs[..., o:o + DIM_P] = self.agent_vel
+    o += DIM_P
+    obs[..., o:o + DIM_P] = pos
+    o += DIM_P
+    size = self.num_landmarks * DIM_P
+    obs[..., o:o + size] = (self.landmark_pos[:, None] -
+                            pos[:, :, None]).reshape(pos.shape[:2] + (size,))
+    o += size
+    size = (self.num_agents - 1) * DIM_P
+    obs[..., o:o + size] = (pos[:, self._others] -
+                            pos[:, :, None]).reshape(pos.shape[:2] + (size,))
+    # Agents are silent, their communication state stays zero.
+    return obs
+
+  def reset(self):
+    """Resets all the worlds."""
+    self._reset_worlds(np.arange(self._batch_size))
+    return self._write_observations()
+
+  def reset_if_done(self, done):
+    """Resets the worlds for which 'done' is True.
+
+    Args:
+      done: An array that specifies which worlds are 'done', meaning their
+        episode is terminated.
+    Returns:
+      Observations for all worlds.
+    """
+    self._reset_worlds(np.flatnonzero(done))
+    return self._write_observations()
+
+  def step(self, action_batch):
+    """Does one step of all the worlds.
+
+    Args:
+      action_batch: [batch_size, num_agents * 5] array of binary actions. For
+        every agent, entries 1 - 2 and 3 - 4 give the x and y acceleration.
+    Returns:
+      Tuple of the observations, rewards, dones and infos of all the worlds.
+    """
+    action = np.reshape(action_batch, (self._batch_size, self.num_agents, -1))
+    force = ACCEL * np.stack([action[..., 1] - action[..., 2],
+                              action[..., 3] - action[..., 4]], axis=-1)
+
+    # Soft contact forces between agents (landmarks don't collide).
+    delta, dist = self._agent_distances()
+    not_self = ~np.eye(self.num_agents, dtype=np.bool)
+    penetration = np.logaddexp(
+        0, -(dist - 2 * AGENT_SIZE) / CONTACT_MARGIN) * CONTACT_MARGIN
+    contact = CONTACT_FORCE * delta * (
+        penetration / np.where(not_self, dist, 1))[..., None]
+    force = force + np.sum(contact * not_self[..., None], axis=2)
+
+    # Agents have unit mass and no maximal speed.
+    self.agent_vel *= 1 - DAMPING
+    self.agent_vel += force * DT
+    self.agent_pos += self.agent_vel * DT
+    self.n_step += 1
+
+    # The scenario reward of every agent is the same, except for its
+    # collisions, which include the agent with itself. The shared reward is
+    # their sum.
+    _, dist = self._agent_distances()
+    landmark_dist = np.sqrt(np.sum(np.square(
+        self.landmark_pos[:, :, None] - self.agent_pos[:, None]), axis=-1))
+    coverage = np.sum(np.min(landmark_dist, axis=2), axis=1)
+    collisions = np.sum(dist < 2 * AGENT_SIZE, axis=(1, 2))
+    rewards = (-self.num_agents * coverage - collisions) / 100
+
+    dones = self.n_step >= self.step_limit
+    infos = [{} for _ in range(self._batch_size)]
+    return (self._write_observations(), rewards.astype(np.float32), dones,
+            infos)
+
+  def render(self, mode='rgb_array', size=400):
+    """Returns an image of the first world, with the [-1, 1] square in view."""
+    del mode
+    ys, xs = np.mgrid[1:-1:size * 1j, -1:1:size * 1j]
+    image = np.full((size, size, 3), 255, np.uint8)
+    entities = [(self.landmark_pos[0], LANDMARK_SIZE, LANDMARK_COLOR),
+                (self.agent_pos[0], AGENT_SIZE, AGENT_COLOR)]
+    for positions, radius, color in entities:
+      for x, y in positions:
+        image[np.square(xs - x) + np.square(ys - y) < radius**2] = color
+    return image
+
+  def close(self):
+    pass
@@ -0,0 +1,91 @@
+# coding=utf-8
+# Copyright 2019 The SEED Authors
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for batched_spread."""
+
+import numpy as np
+from seed_rl.particles import batched_spread as bs
+import tensorflow as tf
+
+
+def _reference_step(pos, vel, landmarks, action):
+  """One step of a single world, following multiagent.core.World.step."""
+  n = len(pos)
+  force = [bs.ACCEL * np.array([a[1] - a[2], a[3] - a[4]], np.float64)
+           for a in np.reshape(action, (n, -1))]
+  for a in range(n):
+    for b in range(a + 1, n):
+      delta = pos[a] - pos[b]
+      dist = np.sqrt(np.sum(np.square(delta)))
+      k = bs.CONTACT_MARGIN
+      penetration = np.logaddexp(0, -(dist - 2 * bs.AGENT_SIZE) / k) * k
+      f = bs.CONTACT_FORCE * delta / dist * penetration
+      force[a] = f + force[a]
+      force[b] = -f + force[b]
+  for a in range(n):
+    vel[a] = vel[a] * (1 - bs.DAMPING) + force[a] * bs.DT
+    pos[a] = pos[a] + vel[a] * bs.DT
+
+  rewards = []
+  observations = []
+  for agent in range(n):
+    rew = 0
+    for l in landmarks:
+      rew -= min(np.sqrt(np.sum(np.square(p - l))) for p in pos)
+    for p in pos:
+      if np.sqrt(np.sum(np.square(p - pos[agent]))) < 2 * bs.AGENT_SIZE:
+        rew -= 1
+    rewards.append(rew)
+    others = [pos[o] - pos[agent] for o in range(n) if o != agent]
+    comm = [np.zeros(bs.DIM_C) for o in range(n) if o != agent]
+    observations.append(np.concatenate(
+        [vel[agent], pos[agent]] + [l - pos[agent] for l in landmarks] +
+        others + comm))
+  return np.stack(observations), np.sum(rewards) / 100
+
+
+class BatchedSimpleSpreadTest(tf.test.TestCase):
+
+  def test_matches_reference(self):
+    env = bs.BatchedSimpleSpread(4, 10, seed=0)
+    self.assertAllEqual([10, 11, 12, 13], env.env_ids)
+    obs = env.reset()
+    self.assertEqual((4, 3, 18), obs.shape)
+    # Agents close to each other, to exercise collisions.
+    env.agent_pos *= 0.2
+    rng = np.random.RandomState(1)
+    for step in range(1, 26):
+      pos = env.agent_pos.copy()
+      vel = env.agent_vel.copy()
+      landmarks = env.landmark_pos.copy()
+      action = rng.randint(0, 2, size=(4, 15))
+      obs, rewards, dones, _ = env.step(action)
+      for i in range(4):
+        expected_obs, expected_reward = _reference_step(
+            pos[i], vel[i], landmarks[i], action[i])
+        self.assertAllClose(expected_obs, obs[i], atol=1e-5)
+        self.assertAllClose(expected_reward, rewards[i], atol=1e-5)
+      self.assertAllEqual([step == 25] * 4, dones)
+
+    before = obs.copy()
+    obs = env.reset_if_done([True, False, True, False])
+    self.assertAllEqual([0, 25, 0, 25], env.n_step)
+    self.assertAllEqual(np.zeros((3, 2)), obs[0, :, :2])
+    self.assertNotAllClose(before[0], obs[0])
+    self.assertAllEqual(before[1], obs[1])
+    self.assertEqual((400, 400, 3), env.render().shape)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -22,11 +22,19 @@ import gym
 from marlgrid.agents import GridAgentInterface
 from seed_rl.common import common_flags
 from seed_rl.common import env_wrappers
+from seed_rl.particles import batched_spread
 from seed_rl.particles import observation
 
 from multiagent.environment import MultiAgentEnv
 import multiagent.scenarios as scenarios
 
+FLAGS = flags.FLAGS
+
+flags.DEFINE_bool('vectorized_env', False,
+                  'Whether actors step their whole environment batch with '
+                  'BatchedSimpleSpread instead of one MultiAgentEnv per '
+                  'environment.')
+
 
 def make_particle_env(scenario_name, benchmark=False):
   scenario = scenarios.load(scenario_name + ".py").Scenario()
@@ -45,3 +53,9 @@ def create_environment(_):
   logging.info('Creating environment: %s', task)
   env = make_particle_env(task)
   return env_wrappers.ParticleWrapper(env)
+
+
+def create_batched_environment(batch_size, id_offset):
+  """Returns BatchedSimpleSpread worlds matching create_environment."""
+  logging.info('Creating %d vectorized simple_spread environments', batch_size)
+  return batched_spread.BatchedSimpleSpread(batch_size, id_offset)
@@ -50,7 +50,9 @@ def main(argv):
   if len(argv) > 1:
     raise app.UsageError('Too many command-line arguments.')
   if FLAGS.run_mode == 'actor':
-    actor.actor_loop(env.create_environment)
+    actor.actor_loop(
+        env.create_environment,
+        env.create_batched_environment if FLAGS.vectorized_env else None)
   elif FLAGS.run_mode == 'learner':
     learner.learner_loop(env.create_environment,
                          create_agent,
@@ -19,6 +19,7 @@ from absl import flags
 from absl import logging
 
 import gym
+import numpy as np
 from seed_rl.common import common_flags
 from seed_rl.common import env_wrappers
 from seed_rl.starcraft import observation
@@ -29,6 +30,9 @@ FLAGS = flags.FLAGS
 
 # Environment settings.
 flags.DEFINE_string('task_name', '3m', 'Task name.')
+flags.DEFINE_bool('structured_observation', False,
+                  'Whether observations are a dict with a single copy of the '
+                  'global state instead of a row per agent repeating it.')
 
 
 def create_environment(_):
@@ -36,5 +40,9 @@ def create_environment(_):
   task = FLAGS.task_name
 
   logging.info('Creating environment: %s', task)
-  env = StarCraft2Env(map_name=task, replay_dir=FLAGS.replay_dir)
-  return env_wrappers.SCWrapper(env)
+  # An explicit seed (SC2 draws its own otherwise) is logged with the episodes,
+  # so they can be replayed.
+  env = StarCraft2Env(map_name=task, replay_dir=FLAGS.replay_dir,
+                      seed=np.random.randint(np.iinfo(np.int32).max))
+  return env_wrappers.SCWrapper(env,
+                                structured=FLAGS.structured_observation)
@@ -127,23 +127,33 @@ class StarcraftAgentNetwork(tf.Module):
   def initial_state(self, batch_size):
     return ()
 
-  def _torso(self, prev_action, env_output):
-    _, _, frame_and_actions_and_state, _, _ = env_output
+  def _split_observation(self, observation):
+    """Returns per-agent frames, available actions and the global state."""
+    if isinstance(observation, dict):
+      # Structured observation with a single copy of the state.
+      avail_actions = tf.reshape(observation['avail_actions'],
+                                 [-1, self.num_agents * self.num_actions])
+      return observation['observation'], avail_actions, observation['state']
 
     # Divide the environment output onto observations and available actions.
     # frame, avail_actions, state = frame_and_actions_and_state
-    state = frame_and_actions_and_state[:, 0, -self.state_dim:]
-    frame_and_actions = frame_and_actions_and_state[:, :, :-self.state_dim]
+    state = observation[:, 0, -self.state_dim:]
+    frame_and_actions = observation[:, :, :-self.state_dim]
 
     frame = tf.stack([
       frame_and_actions[:, i, :-self.num_actions]
       for i in range(self.num_agents)
     ], axis=1)
 
-    self.avail_actions = tf.concat([
+    avail_actions = tf.concat([
       frame_and_actions[:, i, -self.num_actions:]
       for i in range(self.num_agents)
     ], axis=1)
+    return frame, avail_actions, state
+
+  def _torso(self, prev_action, env_output):
+    _, _, observation, _, _ = env_output
+    frame, self.avail_actions, state = self._split_observation(observation)
 
     policy_outputs = [
       self.actor.eval(frame[:, i]) for i in range(self.num_agents)]
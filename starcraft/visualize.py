@@ -38,8 +38,9 @@ def visualize(create_env_fn, create_agent_fn, create_optimizer_fn):
   env_output_specs = utils.EnvOutput(
     tf.TensorSpec([], tf.float32, 'reward'),
     tf.TensorSpec([], tf.bool, 'done'),
-    tf.TensorSpec(env.observation_space.shape, env.observation_space.dtype,
-                  'observation'),
+    tf.nest.map_structure(
+      lambda s: tf.TensorSpec(s.shape, s.dtype, 'observation'),
+      env.observation_space.__dict__.get('spaces', env.observation_space)),
     tf.TensorSpec([], tf.bool, 'abandoned'),
     tf.TensorSpec([], tf.int32, 'episode_step'),
   )
@@ -103,7 +104,8 @@ def visualize(create_env_fn, create_agent_fn, create_optimizer_fn):
 
   def get_agent_action(obs):
     initial_agent_state = agent.initial_state(1)
-    shaped_obs = tf.reshape(tf.convert_to_tensor(obs), shape=(1,)+env.observation_space.shape)
+    shaped_obs = tf.nest.map_structure(
+      lambda o: tf.expand_dims(tf.convert_to_tensor(o), 0), obs)
     initial_env_output = (tf.constant([1.]), tf.constant([False]), shaped_obs,
                           tf.constant([False]), tf.constant([1], dtype=tf.float32),)
     agent_out = agent(tf.zeros([0], dtype=tf.float32), initial_env_output,
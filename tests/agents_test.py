@@ -16,9 +16,18 @@
 
 
 import os
+
+from absl import flags
+import gym
+import numpy as np
+from seed_rl.common import common_flags  # pylint: disable=unused-import
+from seed_rl.common import parametric_distribution
 from seed_rl.dmlab import networks
+from seed_rl.starcraft import networks as starcraft_networks
 import tensorflow as tf
 
+FLAGS = flags.FLAGS
+
 
 class AgentsTest(tf.test.TestCase):
 
@@ -47,6 +56,40 @@ class AgentsTest(tf.test.TestCase):
     self.assertNotAllEqual(output0[0].policy_logits, output1[0].policy_logits)
 
 
+class StarcraftAgentNetworkTest(tf.test.TestCase):
+
+  def test_structured_observation(self):
+    FLAGS.mark_as_parsed()
+    num_agents, num_actions, obs_dim, state_dim = 3, 4, 5, 6
+    agent = starcraft_networks.StarcraftAgentNetwork(
+        parametric_distribution.get_parametric_distribution_for_action_space(
+            gym.spaces.MultiDiscrete([num_actions] * num_agents)),
+        {'state_dim': state_dim})
+    rng = np.random.RandomState(0)
+    frame = rng.normal(size=(2, num_agents, obs_dim)).astype(np.float32)
+    avail_actions = rng.randint(0, 2, size=(2, num_agents, num_actions))
+    avail_actions = avail_actions.astype(np.float32)
+    state = rng.normal(size=(2, state_dim)).astype(np.float32)
+    flat = np.concatenate([
+        frame, avail_actions,
+        np.repeat(state[:, np.newaxis], num_agents, axis=1)], axis=-1)
+    structured = {'observation': frame, 'avail_actions': avail_actions,
+                  'state': state}
+
+    def run(observation):
+      env_output = (tf.zeros([2]), tf.zeros([2], tf.bool), observation,
+                    tf.zeros([2], tf.bool), tf.zeros([2], tf.int32))
+      outputs, _ = agent(tf.zeros([2, num_agents], tf.int32), env_output, (),
+                         postprocess_action=False)
+      return outputs
+
+    flat_outputs = run(flat)
+    structured_outputs = run(structured)
+    self.assertAllClose(flat_outputs.policy_logits,
+                        structured_outputs.policy_logits)
+    self.assertAllClose(flat_outputs.baseline, structured_outputs.baseline)
+
+
 def _run_actor(agent):
   initial_agent_state = agent.initial_state(1)
   observation = tf.ones(
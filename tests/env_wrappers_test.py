@@ -0,0 +1,226 @@
+# coding=utf-8
+# Copyright 2019 The SEED Authors
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for environment wrappers."""
+
+import types
+
+from absl import flags
+import gym
+import numpy as np
+from seed_rl.common import common_flags  # pylint: disable=unused-import
+from seed_rl.common import env_wrappers
+import tensorflow as tf
+
+FLAGS = flags.FLAGS
+
+
+class _CountingEnv(gym.Env):
+  """Env with a structured observation that depends on its id and step."""
+
+  def __init__(self, env_id):
+    self._env_id = env_id
+    self._step = 0
+    self.observation_space = gym.spaces.Dict({
+        'frame': gym.spaces.Box(0, np.inf, shape=(2, 3), dtype=np.float32),
+        'step': gym.spaces.Box(0, np.inf, shape=(), dtype=np.int32),
+    })
+    self.action_space = gym.spaces.Discrete(4)
+
+  def _obs(self):
+    return {
+        'frame': np.full((2, 3), 100 * self._env_id + self._step, np.float32),
+        'step': np.int32(self._step),
+    }
+
+  def reset(self):
+    self._step = 0
+    return self._obs()
+
+  def step(self, action):
+    self._step += 1
+    done = self._step == 2 + self._env_id % 3
+    info = {'env_id': self._env_id}
+    if self._env_id % 2:
+      info['score_reward'] = 10. * action
+    return self._obs(), float(action), done, info
+
+  def get_env_id(self):
+    return self._env_id
+
+
+class _InPlaceEnv(_CountingEnv):
+  """_CountingEnv writing its observations into `observation_buffer`."""
+
+  def __init__(self, env_id):
+    super().__init__(env_id)
+    self.observation_buffer = None
+
+  def _obs(self):
+    obs = super()._obs()
+    if self.observation_buffer is None:
+      return obs
+    for key, value in obs.items():
+      self.observation_buffer[key][...] = value
+    return self.observation_buffer
+
+
+def _create_env(env_id):
+  return _CountingEnv(env_id)
+
+
+def _create_in_place_env(env_id):
+  return _InPlaceEnv(env_id)
+
+
+class BatchedEnvironmentTest(tf.test.TestCase):
+
+  def test_reuses_buffers(self):
+    env = env_wrappers.BatchedEnvironment(_create_in_place_env, 3, 0)
+    obs = env.reset()
+    self.assertAllEqual([0, 100, 200], obs['frame'][:, 0, 0])
+    for env_id in range(3):
+      self.assertTrue(np.shares_memory(
+          obs['frame'], env.envs[env_id].observation_buffer['frame']))
+    new_obs, _, done, _ = env.step(np.array([1, 2, 3], np.int32))
+    self.assertAllEqual([1, 20, 3], env.raw_rewards)
+    self.assertIs(obs['frame'], new_obs['frame'])
+    self.assertAllEqual([1, 101, 201], obs['frame'][:, 1, 2])
+    self.assertAllEqual([1, 1, 1], obs['step'])
+    env.step(np.zeros(3, np.int32))
+    obs = env.reset_if_done(np.array([True, False, False]))
+    self.assertAllEqual([0, 102, 202], obs['frame'][:, 0, 0])
+    env.close()
+
+
+class ParallelBatchedEnvironmentTest(tf.test.TestCase):
+
+  def _assert_obs_equal(self, expected, obs):
+    tf.nest.map_structure(self.assertAllEqual, expected, obs)
+
+  def test_matches_batched_environment(self):
+    batch_size = 5
+    expected_env = env_wrappers.BatchedEnvironment(_create_env, batch_size, 3)
+    env = env_wrappers.ParallelBatchedEnvironment(_create_in_place_env,
+                                                  batch_size, 3,
+                                                  num_processes=2)
+    try:
+      self.assertAllEqual(expected_env.env_ids, env.env_ids)
+      self._assert_obs_equal(expected_env.reset(), env.reset())
+      for step in range(8):
+        action = np.arange(batch_size) + step
+        expected = expected_env.step(action)
+        result = env.step(action)
+        self._assert_obs_equal(expected[0], result[0])
+        self.assertAllEqual(expected[1], result[1])
+        self.assertAllEqual(expected[2], result[2])
+        self.assertEqual(expected[3], result[3])
+        self.assertAllEqual(expected_env.raw_rewards, env.raw_rewards)
+        self._assert_obs_equal(expected_env.reset_if_done(expected[2]),
+                               env.reset_if_done(result[2]))
+      self.assertEqual(7, env.envs[4].get_env_id())
+    finally:
+      env.close()
+      expected_env.close()
+
+
+class _FakeParticleEnv(object):
+  """Minimal multiagent.environment.MultiAgentEnv with two agents."""
+
+  def __init__(self):
+    self.action_space = [gym.spaces.Discrete(5) for _ in range(2)]
+    # The wrapper reshapes the observation space of the first agent in place,
+    # as the old gym versions used by the particle environments allow.
+    self.observation_space = [
+        types.SimpleNamespace(shape=(4,), dtype=np.float64) for _ in range(2)]
+    self.actions = None
+
+  def reset(self):
+    return [np.full(4, agent, np.float64) for agent in range(2)]
+
+  def step(self, actions):
+    self.actions = actions
+    return self.reset(), [50., 50.], [False, False], {'n': [{}, {}]}
+
+
+class ParticleWrapperTest(tf.test.TestCase):
+
+  def test_observations_and_actions(self):
+    particle_env = _FakeParticleEnv()
+    env = env_wrappers.ParticleWrapper(particle_env)
+    self.assertEqual((2, 4), env.observation_space.shape)
+    self.assertEqual(np.float32, env.observation_space.dtype)
+    obs = env.reset()
+    self.assertEqual(np.float32, obs.dtype)
+    self.assertAllEqual([[0] * 4, [1] * 4], obs)
+    action = np.arange(10)
+    for step in range(1, 26):
+      _, reward, done, _ = env.step(action)
+      self.assertEqual(0.5, reward)
+      self.assertEqual(step == 25, done)
+    self.assertAllEqual([np.arange(5), np.arange(5, 10)], particle_env.actions)
+
+
+class _FakeStarCraftEnv(object):
+  """Minimal StarCraft2Env with deterministic observations."""
+
+  def __init__(self):
+    self._step = 0
+
+  def get_env_info(self):
+    return {'n_agents': 2, 'n_actions': 3, 'obs_shape': 4, 'state_shape': 5}
+
+  def reset(self):
+    self._step = 0
+
+  def step(self, actions):
+    self._step += 1
+    return 1., False, {}
+
+  def get_obs(self):
+    return [np.full(4, 10 * agent + self._step, np.float32)
+            for agent in range(2)]
+
+  def get_avail_agent_actions(self, agent_id):
+    return [1, agent_id, self._step % 2]
+
+  def get_state(self):
+    return np.arange(5, dtype=np.float32) + self._step
+
+
+class SCWrapperTest(tf.test.TestCase):
+
+  def test_structured_matches_flat(self):
+    FLAGS.mark_as_parsed()
+    flat_env = env_wrappers.SCWrapper(_FakeStarCraftEnv())
+    env = env_wrappers.SCWrapper(_FakeStarCraftEnv(), structured=True)
+    flat, obs = flat_env.reset(), env.reset()
+    for step in range(4):
+      self.assertTrue(env.observation_space.contains(obs))
+      for agent in range(2):
+        expected_frames = [
+            np.full(4, 10 * agent + frame if frame >= 0 else 0)
+            for frame in range(step - FLAGS.frames_stacked + 1, step + 1)]
+        self.assertAllEqual(np.concatenate(expected_frames),
+                            obs['observation'][agent])
+      self.assertAllEqual(
+          flat,
+          np.concatenate([
+              obs['observation'], obs['avail_actions'],
+              np.tile(obs['state'], (2, 1))], axis=-1))
+      flat, obs = flat_env.step([0, 0])[0], env.step([0, 0])[0]
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -15,6 +15,9 @@
 """Tests for utils."""
 
 import collections
+import json
+import os
+import timeit
 
 from absl.testing import parameterized
 
@@ -23,7 +26,7 @@ from seed_rl.common import utils
 import tensorflow as tf
 
 
-class UnrollStoreTest(tf.test.TestCase):
+class UnrollStoreTest(tf.test.TestCase, parameterized.TestCase):
 
   def test_duplicate_actor_id(self):
     store = utils.UnrollStore(
@@ -144,12 +147,15 @@ class UnrollStoreTest(tf.test.TestCase):
             tf.zeros([num_envs, unroll_length + 1]),
             tf.zeros([num_envs, unroll_length + 1])), unrolls)
 
-  def test_overlap_2(self):
+  # With max_slab_leaf_bytes=0, the leaf has its own buffer.
+  @parameterized.parameters(1024, 0)
+  def test_overlap_2(self, max_slab_leaf_bytes):
     store = utils.UnrollStore(
         num_envs=2,
         unroll_length=2,
         timestep_specs=tf.TensorSpec([], tf.int32),
-        num_overlapping_steps=2)
+        num_overlapping_steps=2,
+        max_slab_leaf_bytes=max_slab_leaf_bytes)
 
     def gen():
       yield False, 0, 10
@@ -227,6 +233,80 @@ class UnrollStoreTest(tf.test.TestCase):
     self.assertAllEqual(tf.constant([[0, 0, 15, 16, 17]]), unrolls)
 
 
+  # All the leaves in the slab, frames (24 bytes) in their own buffer, all the
+  # leaves in their own buffers.
+  @parameterized.parameters(None, 8, 0)
+  def test_dtypes_and_wraparound(self, max_slab_leaf_bytes):
+    specs = {
+        'frame': tf.TensorSpec([2, 3], tf.float32),
+        'done': tf.TensorSpec([], tf.bool),
+        'step': tf.TensorSpec([], tf.int64),
+        'pixels': tf.TensorSpec([4], tf.uint8),
+    }
+    store = utils.UnrollStore(num_envs=2, unroll_length=3, timestep_specs=specs,
+                              num_overlapping_steps=1,
+                              max_slab_leaf_bytes=max_slab_leaf_bytes)
+    # The overlapping step of the first unrolls is zeros.
+    history = [[{'frame': np.zeros([2, 3], np.float32), 'done': False,
+                 'step': 0, 'pixels': np.zeros([4], np.uint8)}]
+               for _ in range(2)]
+    num_unrolls = 0
+    for step in range(1, 50):
+      values = {
+          'frame': np.full([2, 2, 3], step, np.float32) +
+                   np.array([[[.5]], [[-.5]]], np.float32),
+          'done': np.array([step % 2 == 0, step % 3 == 0]),
+          'step': np.array([step, 2**40 + step], np.int64),
+          'pixels': np.full([2, 4], step % 256, np.uint8),
+      }
+      completed_ids, unrolls = store.append(tf.constant([0, 1]), values)
+      for env_id in range(2):
+        history[env_id].append(tf.nest.map_structure(lambda v: v[env_id],
+                                                     values))
+      for k, env_id in enumerate(completed_ids.numpy()):
+        num_unrolls += 1
+        expected = history[env_id][-5:]
+        for name in specs:
+          self.assertAllEqual(np.stack([e[name] for e in expected]),
+                              unrolls[name][k])
+    self.assertEqual(2 * 16, num_unrolls)
+
+
+class UnrollStoreBenchmark(tf.test.Benchmark):
+  """Measures the cost of UnrollStore.append per inference call.
+
+  Run with `python tests/utils_test.py --benchmark_filter=UnrollStoreBenchmark`.
+  """
+
+  def _benchmark(self, num_envs, observation_size, batch_size=64,
+                 unroll_length=100, iters=300):
+    specs = (tf.TensorSpec([3], tf.int32, 'action'),
+             tf.TensorSpec([], tf.float32, 'reward'),
+             tf.TensorSpec([], tf.bool, 'done'),
+             tf.TensorSpec([observation_size], tf.float32, 'observation'))
+    store = utils.UnrollStore(num_envs, unroll_length, specs)
+    values = (tf.zeros([batch_size, 3], tf.int32),
+              tf.zeros([batch_size], tf.float32),
+              tf.zeros([batch_size], tf.bool),
+              tf.zeros([batch_size, observation_size], tf.float32))
+    # Inference calls cycle over the environments, as actors do.
+    batches = [tf.range(i, i + batch_size) % num_envs
+               for i in range(0, num_envs, batch_size)]
+    for env_ids in batches:
+      store.append(env_ids, values)
+    start = timeit.default_timer()
+    for i in range(iters):
+      store.append(batches[i % len(batches)], values)
+    self.report_benchmark(
+        name='unroll_store_envs{}_obs{}'.format(num_envs, observation_size),
+        iters=iters, wall_time=(timeit.default_timer() - start) / iters)
+
+  def benchmark_append(self):
+    for num_envs in (64, 1024):
+      for observation_size in (16, 4096):
+        self._benchmark(num_envs, observation_size)
+
+
 class AggregatorTest(tf.test.TestCase):
 
   def test_full(self):
@@ -242,6 +322,66 @@ class AggregatorTest(tf.test.TestCase):
     self.assertAllEqual([1, 43, 2, 0], agg.read([0, 1, 2, 3]))
 
 
+class NestNumBytesTest(tf.test.TestCase):
+
+  def test_nest(self):
+    nest = (tf.zeros([2, 3], tf.float32), [tf.zeros([5], tf.uint8)],
+            {'a': tf.zeros([], tf.int64)})
+    self.assertEqual(2 * 3 * 4 + 5 + 8, utils.nest_num_bytes(nest).numpy())
+    self.assertEqual(0, utils.nest_num_bytes(()).numpy())
+
+
+class EpisodeStatsTest(tf.test.TestCase):
+
+  def test_full(self):
+    stats = utils.EpisodeStats(3)
+
+    finished = stats.step(np.array([1., 2., 3.], np.float32),
+                          np.array([False, False, False]),
+                          [None, {}, {'score_reward': 30.}],
+                          np.array([1., 2., 30.], np.float32))
+    self.assertAllEqual([], finished)
+    self.assertAllEqual([1, 2, 30], stats.raw_reward)
+    self.assertAllEqual([1, 1, 1], stats.episode_step)
+
+    finished = stats.step(np.array([1., 2., 3.], np.float32),
+                          np.array([False, True, True]),
+                          [{'battle_won': True}, {'battle_won': True},
+                           {'score_reward': 30.}],
+                          np.array([1., 2., 30.], np.float32))
+    self.assertAllEqual([1, 2], finished)
+    stats.end_episodes(finished)
+    self.assertAllEqual([2, 0, 0], stats.episode_step)
+    self.assertAllEqual([2, 0, 0], stats.episode_return)
+    self.assertAllEqual([2, 0, 0], stats.episode_raw_return)
+    self.assertEqual(2, stats.num_episodes)
+    self.assertEqual(4, stats.step_sum)
+    self.assertEqual(4, stats.total_steps)
+    self.assertEqual(10, stats.return_sum)
+    self.assertEqual(64, stats.raw_return_sum)
+    self.assertEqual(1, stats.won_sum)
+
+    stats.reset_report()
+    self.assertEqual(0, stats.num_episodes)
+    self.assertEqual(4, stats.total_steps)
+
+  def test_abandoned(self):
+    stats = utils.EpisodeStats(1)
+    stats.step(np.array([1.], np.float32), np.array([True]),
+               [{'abandoned': True}])
+    self.assertAllEqual([True], stats.abandoned)
+    # Infos of episodes that go on are not read.
+    stats.step(np.array([1.], np.float32), np.array([False]),
+               [{'abandoned': True}])
+    self.assertAllEqual([False], stats.abandoned)
+
+  def test_default_raw_reward(self):
+    stats = utils.EpisodeStats(2)
+    stats.step(np.array([1., 2.], np.float32), np.array([False, False]),
+               [{'score_reward': 30.}, None])
+    self.assertAllEqual([1, 2], stats.raw_reward)
+
+
 class BatchApplyTest(tf.test.TestCase):
 
   def test_simple(self):
@@ -361,6 +501,83 @@ class PrioritizedReplayTest(tf.test.TestCase):
     self._check_weights(weights, sampled_values, expected_weights)
 
 
+class SumTreePrioritizedReplayTest(tf.test.TestCase):
+
+  def test_sampling_probabilities(self):
+    tf.random.set_seed(5)
+    rb = utils.SumTreePrioritizedReplay(
+        size=5,
+        specs=tf.TensorSpec([], tf.int32),
+        importance_sampling_exponent=.3,
+        priority_exp=.7)
+    rb.insert(tf.constant([0, 1, 2]), tf.constant([0.3, 0.9, 2.]))
+
+    num_sampled = 3000
+    indices, weights, sampled_values = rb.sample(num_sampled, .7)
+    self.assertAllEqual(indices, sampled_values)
+    # Stratified sampling draws every item almost exactly in proportion.
+    probs = np.array([0.3, 0.9, 2.]) ** .7
+    probs /= np.sum(probs)
+    counted_values = collections.Counter(sampled_values.numpy())
+    for value in range(3):
+      self.assertNear(counted_values[value], num_sampled * probs[value], 1)
+    expected_weights = (1 / 3 / probs) ** .3
+    expected_weights /= np.max(expected_weights)
+    self.assertAllClose(expected_weights[sampled_values.numpy()], weights)
+
+  def test_wraparound_and_update_priorities(self):
+    rb = utils.SumTreePrioritizedReplay(
+        size=3,
+        specs=tf.TensorSpec([], tf.int32),
+        importance_sampling_exponent=.5,
+        priority_exp=.9)
+    rb.insert(tf.constant([1, 2]), tf.constant([1., 1.]))
+    insert_indices = rb.insert(tf.constant([3, 4]), tf.constant([1., 1.]))
+    self.assertAllEqual([2, 0], insert_indices)
+
+    rb.update_priorities(tf.constant([0, 2], tf.int64), tf.constant([0., 0.]))
+    _, weights, sampled_values = rb.sample(10, .9)
+    self.assertAllEqual([2] * 10, sampled_values)
+    self.assertAllEqual([1.] * 10, weights)
+
+    _, weights, _ = rb.sample(10, 0)
+    self.assertAllEqual([1.] * 10, weights)
+    with self.assertRaises(ValueError):
+      rb.sample(10, .5)
+
+
+class PrioritizedReplayBenchmark(tf.test.Benchmark):
+  """Compares PrioritizedReplay and SumTreePrioritizedReplay.
+
+  Run with
+  `python tests/utils_test.py --benchmark_filter=PrioritizedReplayBenchmark`.
+  """
+
+  def _benchmark(self, replay_cls, size, batch_size=256, iters=20):
+    kwargs = {}
+    if replay_cls is utils.SumTreePrioritizedReplay:
+      kwargs['priority_exp'] = .9
+    rb = replay_cls(size, tf.TensorSpec([], tf.int32),
+                    importance_sampling_exponent=.6, **kwargs)
+    rb.insert(tf.range(size), tf.random.uniform([size]))
+    priorities = tf.random.uniform([batch_size])
+    indices, _, _ = rb.sample(batch_size, .9)
+    rb.update_priorities(indices, priorities)
+    start = timeit.default_timer()
+    for _ in range(iters):
+      indices, _, _ = rb.sample(batch_size, .9)
+      rb.update_priorities(indices, priorities)
+    self.report_benchmark(
+        name='{}_size{}'.format(replay_cls.__name__, size), iters=iters,
+        wall_time=(timeit.default_timer() - start) / iters)
+
+  def benchmark_sample_and_update(self):
+    for size in (10**5, 10**6, 10**7):
+      for replay_cls in (utils.PrioritizedReplay,
+                         utils.SumTreePrioritizedReplay):
+        self._benchmark(replay_cls, size)
+
+
 
 
 class HindsightExperienceReplayTest(tf.test.TestCase):
@@ -561,6 +778,20 @@ class MakeTimeMajorTest(tf.test.TestCase):
     self.assertAllEqual(a, tf.constant([[1, 3], [2, 4]]))
     self.assertAllEqual(b, tf.constant([[1, 2]]))
 
+  def test_without_xla_in_dataset(self):
+    queue = utils.StructuredFIFOQueue(
+        -1, (tf.TensorSpec([3, 2], tf.uint8), tf.TensorSpec([3], tf.bool)))
+    queue.enqueue_many(
+        (tf.cast(tf.reshape(tf.range(12), [2, 3, 2]), tf.uint8),
+         tf.constant([[True, False, False], [False, True, False]])))
+    dataset = tf.data.Dataset.from_tensors(0).map(
+        lambda _: utils.make_time_major(queue.dequeue_many(2), use_xla=False))
+    observations, dones = next(iter(dataset))
+    self.assertEqual([3, 2, 2], dataset.element_spec[0].shape)
+    self.assertAllEqual([[0, 1], [6, 7]], observations[0])
+    self.assertAllEqual([[4, 5], [10, 11]], observations[2])
+    self.assertAllEqual([[True, False], [False, True], [False, False]], dones)
+
 
 class MinimizeTest(tf.test.TestCase, parameterized.TestCase):
 
@@ -629,5 +860,95 @@ class ProgressLoggerTest(tf.test.TestCase):
     logger.shutdown()
 
 
+class _UnavailableSink(object):
+
+  def __init__(self):
+    self.available = False
+    self.points = []
+
+  def write(self, points):
+    if not self.available:
+      return False
+    self.points.extend(points)
+    return True
+
+
+class MetricReporterTest(tf.test.TestCase):
+
+  def test_file_sink(self):
+    path = os.path.join(self.get_temp_dir(), 'metrics.tsv')
+    reporter = utils.MetricReporter(utils.FileMetricSink(path),
+                                    flush_period=0.01)
+    reporter.start()
+    reporter.log_metric('win rate', x=1, y=0.5)
+    reporter.log_metric('win rate', x=2, y=0.75)
+    reporter.shutdown()
+    with open(path) as f:
+      self.assertEqual(['win rate\t1\t0.5', 'win rate\t2\t0.75'],
+                       f.read().splitlines())
+
+  def test_coalesce_until_sink_available(self):
+    sink = _UnavailableSink()
+    reporter = utils.MetricReporter(sink, max_queue_size=3)
+    for x in range(4):
+      reporter.log_metric('a', x=x, y=x)
+    reporter.log_metric('b', x=0, y=0)
+    reporter.flush()
+    reporter.log_metric('b', x=1, y=1)
+    reporter.log_metric('c', x=0, y=0)
+    reporter.log_metric('d', x=0, y=0)
+    sink.available = True
+    reporter.flush()
+    self.assertEqual([('b', 1, 1), ('c', 0, 0), ('d', 0, 0)],
+                     [tuple(p) for p in sink.points])
+    self.assertEqual(5, reporter.num_dropped)
+
+
+class EpisodeLogWriterTest(tf.test.TestCase):
+
+  def test_chunks(self):
+    log_dir = os.path.join(self.get_temp_dir(), 'episodes')
+    writer = utils.EpisodeLogWriter(log_dir, chunk_size=3)
+    writer.start()
+    for step in range(7):
+      writer.append(np.array([step, -step]), float(step), step == 4)
+    writer.shutdown()
+    self.assertEqual(3, writer.num_chunks)
+    chunks = [np.load(os.path.join(log_dir, 'chunk_{:06d}.npz'.format(i)))
+              for i in range(3)]
+    self.assertAllEqual([[s, -s] for s in range(7)],
+                        np.concatenate([c['actions'] for c in chunks]))
+    self.assertAllEqual(range(7),
+                        np.concatenate([c['rewards'] for c in chunks]))
+    self.assertAllEqual([False] * 4 + [True] + [False] * 2,
+                        np.concatenate([c['dones'] for c in chunks]))
+
+  def test_episodes(self):
+    log_dir = os.path.join(self.get_temp_dir(), 'episode_metadata')
+    writer = utils.EpisodeLogWriter(log_dir, chunk_size=3,
+                                    metadata={'map': '3m'})
+    writer.start()
+    writer.start_episode(123, seed=7)
+    for step in range(5):
+      writer.append(step, 0., step == 2)
+      if step == 2:
+        writer.start_episode(123)
+    # The last, partial chunk is written on flush.
+    writer.flush()
+    writer.start_episode(456, seed=8)
+    writer.shutdown()
+    self.assertEqual(2, writer.num_chunks)
+    with open(os.path.join(log_dir, 'metadata.json')) as f:
+      self.assertEqual({'map': '3m'}, json.load(f))
+    chunks = [np.load(os.path.join(log_dir, 'chunk_{:06d}.npz'.format(i)))
+              for i in range(2)]
+    self.assertAllEqual([0], chunks[0]['episode_starts'])
+    self.assertAllEqual([123], chunks[0]['run_ids'])
+    self.assertAllEqual([7], chunks[0]['seeds'])
+    self.assertAllEqual([0], chunks[1]['episode_starts'])
+    self.assertAllEqual([123], chunks[1]['run_ids'])
+    self.assertAllEqual([-1], chunks[1]['seeds'])
+
+
 if __name__ == '__main__':
   tf.test.main()
@@ -21,12 +21,18 @@ Importance Weighted Actor-Learner Architectures"
 by Espeholt, Soyer, Munos et al.
 """
 
+import timeit
+
+from absl import flags
 from absl.testing import parameterized
 import numpy as np
+from seed_rl.common import common_flags  # pylint: disable=unused-import
 from seed_rl.common import vtrace
 from seed_rl.common.parametric_distribution import CategoricalDistribution
 import tensorflow as tf
 
+FLAGS = flags.FLAGS
+
 
 def _shaped_arange(*shape):
   """Runs np.arange, converts to float and reshapes."""
@@ -114,9 +120,28 @@ class LogProbsFromLogitsAndActionsTest(tf.test.TestCase,
     self.assertAllClose(ground_truth_v, action_log_probs_tensor)
 
 
+def _random_inputs(seq_len, shape, seed=0):
+  """Returns random from_importance_weights inputs of shape [seq_len, ...]."""
+  rng = np.random.RandomState(seed)
+  shape = (seq_len,) + shape
+  return {
+      'behaviour_action_log_probs': rng.uniform(-2, 0, shape),
+      'target_action_log_probs': rng.uniform(-2, 0, shape),
+      'discounts': 0.99 * (rng.uniform(size=shape) > 0.05),
+      'rewards': rng.normal(size=shape),
+      'values': rng.normal(size=shape),
+      'bootstrap_value': rng.normal(size=shape[1:]),
+  }
+
+
 class VtraceTest(tf.test.TestCase, parameterized.TestCase):
 
-  def test_vtrace(self):
+  def setUp(self):
+    super(VtraceTest, self).setUp()
+    FLAGS.mark_as_parsed()
+
+  @parameterized.parameters(*vtrace.IMPLEMENTATIONS)
+  def test_vtrace(self, implementation):
     """Tests V-trace against ground truth data calculated in python."""
     batch_size = 5
     seq_len = 5
@@ -139,10 +164,77 @@ class VtraceTest(tf.test.TestCase, parameterized.TestCase):
         'clip_pg_rho_threshold': 2.2,
     }
 
-    output = vtrace.from_importance_weights(**values)
+    output = vtrace.from_importance_weights(implementation=implementation,
+                                            **values)
     ground_truth_v = _ground_truth_calculation(**values)
     self.assertAllClose(output, ground_truth_v)
 
+  @parameterized.parameters(
+      ('scan', 1, (4,)),
+      ('scan', 100, (8, 3)),
+      ('associative_scan', 1, (4,)),
+      ('associative_scan', 7, (4,)),
+      ('associative_scan', 100, (8, 3)),
+      ('associative_scan', 128, (8,)),
+  )
+  def test_matches_loop(self, implementation, seq_len, shape):
+    inputs = _random_inputs(seq_len, shape)
+
+    @tf.function
+    def compute(implementation):
+      return vtrace.from_importance_weights(lambda_=0.95,
+                                            implementation=implementation,
+                                            **inputs)
+
+    expected = compute('loop')
+    output = compute(implementation)
+    self.assertAllClose(expected.vs, output.vs, rtol=1e-5, atol=1e-5)
+    self.assertAllClose(expected.pg_advantages, output.pg_advantages,
+                        rtol=1e-5, atol=1e-5)
+
+
+class VtraceBenchmark(tf.test.Benchmark):
+  """Compares the V-trace implementations.
+
+  Run with `python tests/vtrace_test.py --benchmark_filter=VtraceBenchmark`.
+  """
+
+  def _benchmark(self, implementation, seq_len, batch_size=32, num_agents=3,
+                 iters=50):
+    FLAGS.mark_as_parsed()
+    inputs = tf.nest.map_structure(
+        lambda x: tf.constant(x, tf.float32),
+        _random_inputs(seq_len, (batch_size, num_agents)))
+
+    @tf.function
+    def compute():
+      return vtrace.from_importance_weights(implementation=implementation,
+                                            **inputs)
+
+    # The first call traces and compiles the function.
+    start = timeit.default_timer()
+    compute()
+    compile_time = timeit.default_timer() - start
+    start = timeit.default_timer()
+    for _ in range(iters):
+      compute()
+    step_time = (timeit.default_timer() - start) / iters
+    self.report_benchmark(
+        name='vtrace_{}_T{}'.format(implementation, seq_len), iters=iters,
+        wall_time=step_time, extras={'compile_time_s': compile_time})
+
+  def benchmark_loop(self):
+    for seq_len in (20, 100, 400):
+      self._benchmark('loop', seq_len)
+
+  def benchmark_scan(self):
+    for seq_len in (20, 100, 400):
+      self._benchmark('scan', seq_len)
+
+  def benchmark_associative_scan(self):
+    for seq_len in (20, 100, 400):
+      self._benchmark('associative_scan', seq_len)
+
 
 if __name__ == '__main__':
   tf.test.main()
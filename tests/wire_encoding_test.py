@@ -0,0 +1,75 @@
+# coding=utf-8
+# Copyright 2019 The SEED Authors
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for wire_encoding."""
+
+from absl.testing import parameterized
+import numpy as np
+from seed_rl.common import wire_encoding
+import tensorflow as tf
+
+
+class WireEncodingTest(tf.test.TestCase, parameterized.TestCase):
+
+  @parameterized.parameters(
+      ('none', False, 0.),
+      ('fp16', False, 1e-2),
+      ('uint8', False, 2e-2),
+      ('none', True, 1e-5),
+      ('fp16', True, 1e-2),
+      ('uint8', True, 2e-2),
+  )
+  def test_roundtrip(self, encoding, delta, atol):
+    num_envs = 5
+    specs = {
+        'frame': tf.TensorSpec([3, 4], tf.float32),
+        'mask': tf.TensorSpec([2], tf.int32),
+    }
+    encoder = wire_encoding.ObservationEncoder(encoding, delta,
+                                               keyframe_period=3)
+    decoder = wire_encoding.ObservationDecoder(num_envs, specs, encoding,
+                                               delta)
+    wire_specs = wire_encoding.encoded_specs(specs, encoding, delta)
+
+    @tf.function
+    def decode(env_ids, encoded):
+      return decoder(env_ids, encoded)
+
+    env_ids = np.array([3, 0, 4], np.int32)
+    rng = np.random.RandomState(0)
+    frame = rng.uniform(-2, 2, size=(3, 3, 4)).astype(np.float32)
+    for step in range(6):
+      frame += rng.uniform(-.1, .1, size=frame.shape).astype(np.float32)
+      observation = {
+          'frame': frame,
+          'mask': np.full((3, 2), step, np.int32),
+      }
+      keyframe = np.array([step == 4, False, False])
+      encoded = encoder.encode(observation, keyframe)
+      tf.nest.map_structure(
+          lambda s, x: self.assertEqual(s.dtype, tf.as_dtype(x.dtype)),
+          wire_specs, encoded)
+      decoded = decode(env_ids, encoded)
+      self.assertAllClose(frame, decoded['frame'], atol=atol)
+      self.assertAllEqual(observation['mask'], decoded['mask'])
+
+  def test_uint8_size(self):
+    encoder = wire_encoding.ObservationEncoder('uint8')
+    encoded = encoder.encode(np.zeros((2, 100), np.float32), None)
+    self.assertEqual(np.uint8, encoded.quantized.dtype)
+    self.assertAllEqual([2], encoded.scale.shape)
+
+
+if __name__ == '__main__':
+  tf.test.main()